@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+This script measures the sftp throughput to the host machines of a configuration file
+with different ssh transport settings. The results can be used to choose the
+SSHTransport settings of the hosts in the configuration file.
+
+Arguments:
+1. - The path to a configuration json file.
+--host - The id of a host machine that is measured. All ssh hosts are measured if this is not given.
+--file - The local file that is uploaded and downloaded. The default is the agent.jar file.
+--repetitions - The number of transfers that are made with each profile.
+"""
+
+import os
+import sys
+import copy
+import time
+import argparse
+import tempfile
+from pathlib import PurePath
+
+# Add the script path to the python path
+_SCRIPT_DIR = PurePath(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(str(_SCRIPT_DIR))
+
+import config_data
+import connections
+
+
+_BENCHMARK_FILE_NAME = 'cpfmachines-transport-benchmark.bin'
+
+
+def _get_profiles(host_info):
+    """
+    Returns a list of (name, SSHTransportConfig) tuples with the settings that are compared.
+    """
+    default_profile = config_data.SSHTransportConfig()
+
+    # Large windows keep the link busy when the latency is small compared to the bandwidth.
+    lan_profile = config_data.SSHTransportConfig()
+    lan_profile.ciphers = ['aes128-gcm@openssh.com', 'aes128-ctr']
+    lan_profile.window_size = 16 * 1024 * 1024
+
+    # Compression helps when the link is slower than the cpus on both ends.
+    wan_profile = config_data.SSHTransportConfig()
+    wan_profile.compression = True
+    wan_profile.ciphers = ['aes128-gcm@openssh.com', 'aes128-ctr']
+    wan_profile.window_size = 4 * 1024 * 1024
+
+    return [
+        ('default', default_profile),
+        ('configured', host_info.ssh_transport),
+        ('lan', lan_profile),
+        ('wan', wan_profile),
+    ]
+
+
+def main(config_file, machine_ids=None, source_file=None, repetitions=3):
+    """
+    Entry point of the script.
+    """
+    config_dict = config_data.read_json_file(config_file)
+    config = config_data.ConfigData(config_dict)
+    if source_file is None:
+        source_file = _SCRIPT_DIR.joinpath('agent.jar')
+    file_size = os.path.getsize(str(source_file))
+
+    host_infos = [info for info in config.host_machine_infos if not info.is_localhost()]
+    if machine_ids:
+        host_infos = [info for info in host_infos if info.machine_id in machine_ids]
+
+    row_format = '{0:<20} {1:<12} {2:>14} {3:>16}'
+    print('Transferring {0} ({1:.1f} MiB) {2} times per profile.'.format(source_file, file_size / (1024 * 1024), repetitions))
+    print(row_format.format('Host', 'Profile', 'Upload [MiB/s]', 'Download [MiB/s]'))
+    for host_info in host_infos:
+        connections.prompt_for_missing_password(host_info)
+        for profile_name, profile in _get_profiles(host_info):
+            upload_rate, download_rate = _measure_throughput(host_info, profile, source_file, file_size, repetitions)
+            print(row_format.format(host_info.machine_id, profile_name, '{0:.1f}'.format(upload_rate), '{0:.1f}'.format(download_rate)))
+
+
+def _measure_throughput(host_info, profile, source_file, file_size, repetitions):
+    """
+    Returns the upload and download rates in MiB/s for a host with the given transport settings.
+    The time for opening the connection is not included.
+    """
+    profile_info = copy.copy(host_info)
+    profile_info.ssh_transport = profile
+    connection = connections.ConnectionHolder(profile_info)
+    remote_file = str(host_info.temp_dir.joinpath(_BENCHMARK_FILE_NAME))
+
+    upload_time = 0.0
+    download_time = 0.0
+    try:
+        sftp_client = connection.sftp_client
+        with tempfile.TemporaryDirectory() as temp_dir:
+            local_file = os.path.join(temp_dir, _BENCHMARK_FILE_NAME)
+            for _ in range(repetitions):
+                start_time = time.perf_counter()
+                sftp_client.put(str(source_file), remote_file)
+                upload_time += time.perf_counter() - start_time
+
+                start_time = time.perf_counter()
+                sftp_client.get(remote_file, local_file)
+                download_time += time.perf_counter() - start_time
+            sftp_client.remove(remote_file)
+    finally:
+        connection.remove()
+
+    transferred_mib = file_size * repetitions / (1024 * 1024)
+    return transferred_mib / upload_time, transferred_mib / download_time
+
+
+def _parse_arguments():
+    parser = argparse.ArgumentParser(description='Measures the sftp throughput to the host machines with different ssh transport settings.')
+    parser.add_argument('config_file', help='The path to a CPFMachines configuration json file.')
+    parser.add_argument('--host', action='append', dest='machine_ids', help='The id of a host machine that is measured. Can be given multiple times.')
+    parser.add_argument('--file', dest='source_file', help='The local file that is transferred.')
+    parser.add_argument('--repetitions', type=int, default=3, help='The number of transfers with each profile.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = _parse_arguments()
+    sys.exit(main(arguments.config_file, arguments.machine_ids, arguments.source_file, arguments.repetitions))
@@ -1,10 +1,16 @@
 #!/bin/sh
 
 # This script is used to compile and install CMake from source because the version of the debian package was too old.
+# If the CPF_BUILD_CACHE_DIR variable is set, the sources and the build tree are kept in that directory,
+# so later builds only need to compile the changed files.
+# If the CPF_INSTALL_ROOT variable is set, the files are installed below that directory instead of /.
+# If the CPF_DEPENDENCIES_ONLY variable is set, only the dependencies are installed.
 set -e
 
 echo -------------- Build CMake ---------------
 
+VERSION=v3.22.1
+
 # install dependencies for cmake build
 apt-get -y update && apt-get install -y \
 libcurl4 \
@@ -14,17 +20,36 @@ zlib1g \
 zlib1g-dev \
 libssl-dev
 
+# Images that copy the installed files from a prebuilt toolchain image only need the dependencies.
+if [ -n "$CPF_DEPENDENCIES_ONLY" ]; then
+    exit 0
+fi
 
-CMAKE_BUILD_DIR=TempCMakeBuild
+if [ -n "$CPF_BUILD_CACHE_DIR" ]; then
+    CMAKE_BUILD_DIR=$CPF_BUILD_CACHE_DIR/cmake
+else
+    CMAKE_BUILD_DIR=TempCMakeBuild
+fi
 
-git clone https://gitlab.kitware.com/cmake/cmake.git $CMAKE_BUILD_DIR
+if [ -d $CMAKE_BUILD_DIR/.git ]; then
+    git -C $CMAKE_BUILD_DIR fetch --tags
+else
+    git clone https://gitlab.kitware.com/cmake/cmake.git $CMAKE_BUILD_DIR
+fi
 
 cd $CMAKE_BUILD_DIR
-git checkout v3.22.1
+git checkout $VERSION
 
 # hunter needs the --system-curl option to enable downloading with https.
-./bootstrap --system-curl
+# A cached build tree that was configured for the same version does not need to be bootstrapped again.
+if [ ! -f Makefile ] || [ "$(cat .cpf-bootstrapped-version 2>/dev/null)" != "$VERSION" ]; then
+    ./bootstrap --system-curl
+    echo $VERSION > .cpf-bootstrapped-version
+fi
 make -j$(nproc)
-make install
+make install DESTDIR=$CPF_INSTALL_ROOT
 cd ..
-rm -r $CMAKE_BUILD_DIR
\ No newline at end of file
+
+if [ -z "$CPF_BUILD_CACHE_DIR" ]; then
+    rm -r $CMAKE_BUILD_DIR
+fi
@@ -1,6 +1,10 @@
 #!/bin/sh
 
 # This script downloads the git sources, builds and installs
+# If the CPF_BUILD_CACHE_DIR variable is set, the source package and the build tree are kept in that directory,
+# so later builds do not need to download and compile them again.
+# If the CPF_INSTALL_ROOT variable is set, the files are installed below that directory instead of /.
+# If the CPF_DEPENDENCIES_ONLY variable is set, only the dependencies are installed.
 set -e
 
 echo -------------- Build Git ---------------
@@ -17,22 +21,37 @@ gettext \
 zlib1g-dev \
 libssl-dev
 
+# Images that copy the installed files from a prebuilt toolchain image only need the dependencies.
+if [ -n "$CPF_DEPENDENCIES_ONLY" ]; then
+    exit 0
+fi
 
 PACKAGE_NAME=v$VERSION.tar.gz
 BUILD_DIR=git-$VERSION
 
+if [ -n "$CPF_BUILD_CACHE_DIR" ]; then
+    mkdir -p $CPF_BUILD_CACHE_DIR/git
+    cd $CPF_BUILD_CACHE_DIR/git
+fi
+
 # get source package
-wget https://github.com/git/git/archive/$PACKAGE_NAME
-tar -zxf $PACKAGE_NAME
+if [ ! -d $BUILD_DIR ]; then
+    wget https://github.com/git/git/archive/$PACKAGE_NAME
+    tar -zxf $PACKAGE_NAME
+    rm $PACKAGE_NAME
+fi
 
 cd $BUILD_DIR
 
-make configure
-./configure --prefix=/usr
+if [ ! -f config.status ]; then
+    make configure
+    ./configure --prefix=/usr
+fi
 make all -j$(nproc)
-make install
+make install DESTDIR=$CPF_INSTALL_ROOT
 
 # clean the build dir
 cd ..
-rm -rf $BUILD_DIR
-rm $PACKAGE_NAME
+if [ -z "$CPF_BUILD_CACHE_DIR" ]; then
+    rm -rf $BUILD_DIR
+fi
@@ -0,0 +1,123 @@
+"""
+Contains functions that work on the local files of docker build contexts.
+"""
+
+import os
+import re
+import hashlib
+import io
+import tarfile
+from pathlib import PurePath
+
+
+# The label that holds the hash of the build inputs of the images that are built by the setup script.
+CONTEXT_HASH_LABEL = 'cpfmachines.context-hash'
+
+# Changing this invalidates the hashes of all existing images.
+_HASH_FORMAT_VERSION = '1'
+
+_FROM_PATTERN = re.compile(r'^\s*FROM\s+(?:--\S+\s+)*(\S+)', re.IGNORECASE)
+_ARG_PATTERN = re.compile(r'^\s*ARG\s+([A-Za-z_][A-Za-z0-9_]*)(?:=(\S*))?', re.IGNORECASE)
+_VARIABLE_PATTERN = re.compile(r'\$\{([A-Za-z_][A-Za-z0-9_]*)\}|\$([A-Za-z_][A-Za-z0-9_]*)')
+
+
+def normalize_line_endings(data):
+    """
+    Removes the carriage returns of windows line endings from the bytes of a text file.
+    """
+    return data.replace(b'\r', b'')
+
+
+def read_context_file(source_dir, file_path, is_text_file):
+    """
+    Returns the bytes of a file as they are used in the build context on the Linux host.
+    """
+    with open(str(PurePath(source_dir).joinpath(file_path)), 'rb') as file:
+        data = file.read()
+    if is_text_file:
+        data = normalize_line_endings(data)
+    return data
+
+
+def compute_context_hash(source_dir, docker_file, build_args, text_files, binary_files=[], base_image_ids=[]):
+    """
+    Returns a sha256 hex digest over everything that determines the result of a docker build.
+    These are the dockerfile name, the build arguments, the paths and contents of the context
+    files and the ids of the images that are used in the FROM lines of the dockerfile.
+    """
+    sha = hashlib.sha256()
+
+    def add(value):
+        # The length prefix keeps the concatenated values unambiguous.
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        sha.update(str(len(value)).encode('ascii') + b':' + value)
+
+    add(_HASH_FORMAT_VERSION)
+    add(str(docker_file))
+    for arg in build_args:
+        add(arg)
+    for base_image_id in base_image_ids:
+        add(base_image_id)
+
+    files = [(str(PurePath(path).as_posix()), True) for path in text_files]
+    files += [(str(PurePath(path).as_posix()), False) for path in binary_files]
+    for path, is_text_file in sorted(files):
+        add(path)
+        add(read_context_file(source_dir, path, is_text_file))
+
+    return sha.hexdigest()
+
+
+def create_context_tar(source_dir, text_files, binary_files=[]):
+    """
+    Returns the bytes of an uncompressed tar archive that contains the context files
+    with their relative paths. The line endings of the text files are normalized.
+    The archive does not depend on the timestamps of the local files, so the same
+    files always give the same archive.
+    """
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w', format=tarfile.GNU_FORMAT) as archive:
+        files = [(path, True) for path in text_files] + [(path, False) for path in binary_files]
+        for path, is_text_file in files:
+            data = read_context_file(source_dir, path, is_text_file)
+            info = tarfile.TarInfo(PurePath(path).as_posix())
+            info.size = len(data)
+            info.mode = 0o644
+            archive.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def get_base_images(dockerfile_content, build_args=[]):
+    """
+    Returns the images that are used by the FROM lines of a dockerfile in the order of the lines.
+    Variables in the image names are replaced with the values of the build arguments
+    or the default values of the ARG lines. Names of previous build stages and the empty
+    scratch image are not returned.
+    """
+    arg_values = {}
+    for line in dockerfile_content.splitlines():
+        match = _ARG_PATTERN.match(line)
+        if match and match.group(2) is not None:
+            arg_values.setdefault(match.group(1), match.group(2))
+    for arg in build_args:
+        name, _, value = arg.partition('=')
+        arg_values[name] = value
+
+    def substitute(match):
+        return arg_values.get(match.group(1) or match.group(2), '')
+
+    base_images = []
+    stage_names = set()
+    for line in dockerfile_content.splitlines():
+        match = _FROM_PATTERN.match(line)
+        if not match:
+            continue
+        image = _VARIABLE_PATTERN.sub(substitute, match.group(1))
+        if image not in stage_names and image not in base_images and image.lower() != 'scratch':
+            base_images.append(image)
+        stage_match = re.search(r'\s+AS\s+(\S+)\s*$', line, re.IGNORECASE)
+        if stage_match:
+            stage_names.add(stage_match.group(1))
+
+    return base_images
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+This module contains automated tests for the build_context module.
+"""
+
+import unittest
+import tempfile
+import os
+import io
+import tarfile
+
+from build_context import *
+
+
+class TestBuildContext(unittest.TestCase):
+    """
+    Fixture class for testing the build_context functions.
+    """
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.source_dir = self._temp_dir.name
+        self._write_file('Dockerfile', b'FROM ubuntu:20.04\r\nCOPY script.sh /\r\n')
+        self._write_file('script.sh', b'echo hello\n')
+        self._write_file('agent.jar', b'\x00\x01\r\n')
+
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+
+    def _write_file(self, name, data):
+        with open(os.path.join(self.source_dir, name), 'wb') as file:
+            file.write(data)
+
+
+    def _compute_hash(self, build_args=[], base_image_ids=['sha256:abc']):
+        return compute_context_hash(self.source_dir, 'Dockerfile', build_args, ['Dockerfile', 'script.sh'], ['agent.jar'], base_image_ids)
+
+
+    def test_context_hash_changes_with_the_build_inputs(self):
+        """
+        Changes of a file, a build argument or a base image change the hash.
+        """
+        # setup
+        original_hash = self._compute_hash()
+
+        # execute
+        changed_arg_hash = self._compute_hash(build_args=['VERSION=2'])
+        changed_base_hash = self._compute_hash(base_image_ids=['sha256:def'])
+        self._write_file('script.sh', b'echo world\n')
+        changed_file_hash = self._compute_hash()
+
+        # verify
+        self.assertEqual(len(set([original_hash, changed_arg_hash, changed_base_hash, changed_file_hash])), 4)
+
+
+    def test_context_hash_ignores_windows_line_endings_of_text_files(self):
+        """
+        The text files are normalized before they are hashed, because they are normalized in the build context.
+        Binary files are hashed unchanged.
+        """
+        # setup
+        original_hash = self._compute_hash()
+
+        # execute
+        self._write_file('Dockerfile', b'FROM ubuntu:20.04\nCOPY script.sh /\n')
+        text_changed_hash = self._compute_hash()
+        self._write_file('agent.jar', b'\x00\x01\n')
+        binary_changed_hash = self._compute_hash()
+
+        # verify
+        self.assertEqual(original_hash, text_changed_hash)
+        self.assertNotEqual(original_hash, binary_changed_hash)
+
+
+    def test_get_base_images_resolves_build_arguments(self):
+        """
+        The base image of the jenkins master is given as a build argument.
+        """
+        # setup
+        dockerfile = (
+            'ARG JENKINS_BASE_IMAGE\n'
+            'ARG TOOLS_IMAGE=ubuntu:20.04\n'
+            'FROM ${TOOLS_IMAGE} AS tools\n'
+            'FROM $JENKINS_BASE_IMAGE\n'
+            'COPY --from=tools /bin/tool /bin/\n'
+            'FROM tools\n'
+        )
+
+        # execute
+        base_images = get_base_images(dockerfile, ['JENKINS_BASE_IMAGE=jenkins-image-2.319.2'])
+
+        # verify
+        self.assertEqual(base_images, ['ubuntu:20.04', 'jenkins-image-2.319.2'])
+
+
+    def test_get_base_images_ignores_the_scratch_image(self):
+        """
+        The toolchain images start from scratch, which is not an image that can be inspected or pulled.
+        """
+        # setup
+        dockerfile = (
+            'ARG BASE_IMAGE\n'
+            'FROM ${BASE_IMAGE} AS build\n'
+            'FROM scratch\n'
+            'COPY --from=build /toolchain /\n'
+        )
+
+        # execute
+        base_images = get_base_images(dockerfile, ['BASE_IMAGE=ubuntu:20.04'])
+
+        # verify
+        self.assertEqual(base_images, ['ubuntu:20.04'])
+
+
+    def test_context_tar_contains_the_normalized_files(self):
+        """
+        Happy case test for creating the build context archive.
+        """
+        # execute
+        data = create_context_tar(self.source_dir, ['Dockerfile', 'script.sh'], ['agent.jar'])
+
+        # verify
+        with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+            self.assertEqual(archive.getnames(), ['Dockerfile', 'script.sh', 'agent.jar'])
+            self.assertEqual(archive.extractfile('Dockerfile').read(), b'FROM ubuntu:20.04\nCOPY script.sh /\n')
+            self.assertEqual(archive.extractfile('agent.jar').read(), b'\x00\x01\r\n')
+        self.assertEqual(data, create_context_tar(self.source_dir, ['Dockerfile', 'script.sh'], ['agent.jar']))
@@ -10,6 +10,7 @@ Can we add comments to the KEY definitions that are visible in the docs?
 """
 
 import json
+import re
 import collections
 import pprint
 
@@ -27,6 +28,17 @@ KEY_USER = 'User'
 KEY_PASSWORD = 'Password'
 KEY_OSTYPE = 'OSType'
 KEY_TEMPDIR = 'TemporaryDirectory'
+KEY_TRANSPORT = 'Transport'
+
+# values of the KEY_TRANSPORT key
+TRANSPORT_SSH = 'ssh'               # The host is accessed over an ssh connection.
+TRANSPORT_LOCALHOST = 'localhost'   # The host is the machine that runs the setup script. Commands are run as local processes.
+
+KEY_SSH_TRANSPORT = 'SSHTransport'
+KEY_COMPRESSION = 'Compression'
+KEY_CIPHERS = 'Ciphers'
+KEY_WINDOW_SIZE = 'WindowSize'
+KEY_MAX_PACKET_SIZE = 'MaxPacketSize'
 
 KEY_JENKINS_MASTER_HOST = 'JenkinsMasterHost'
 KEY_HOST_JENKINS_MASTER_SHARE = 'HostJenkinsMasterShare'
@@ -36,9 +48,23 @@ KEY_SSH_DIR = 'SSHDir'
 
 KEY_HTTPS_REPOSITORY_HOSTS = 'HTTPSRepositoryHosts'
 
+KEY_IMAGE_BUILDER_HOST = 'ImageBuilderHost'
+
+KEY_CONTAINER_STOP_TIMEOUT = 'ContainerStopTimeout'
+
+KEY_DOCKER_REGISTRY = 'DockerRegistry'
+KEY_REGISTRY_PORT = 'Port'
+KEY_REGISTRY_STORAGE_DIR = 'StorageDirectory'
+
 KEY_JENKINS_SLAVES = 'JenkinsSlaves'
 KEY_EXECUTORS = "Executors"
 KEY_CONTAINER_NAME = "ContainerName"
+KEY_RESOURCES = 'Resources'
+KEY_CPUS = 'Cpus'
+KEY_CPUSET_CPUS = 'CpusetCpus'
+KEY_MEMORY = 'Memory'
+KEY_SHM_SIZE = 'ShmSize'
+CPUSET_AUTO = 'auto'
 
 KEY_JENKINS_CONFIG = 'JenkinsConfig'
 KEY_USE_UNCONFIGURED_JENKINS = 'UseUnconfiguredJenkins'
@@ -85,6 +111,9 @@ class ConfigData:
         self.https_repository_accesses = []
         self.jenkins_slave_configs = []
         self.jenkins_config = JenkinsConfig()
+        self.image_builder_machine_id = ''       # The host that builds the images that are used on multiple hosts. Empty if each host builds its own images.
+        self.docker_registry_config = None       # A DockerRegistryConfig object if the images are distributed with a private registry.
+        self.container_stop_timeout = None       # The seconds that running containers get to shut down before they are removed. None if they are killed right away.
 
         # internal
         self._config_file_dict = config_dict
@@ -158,6 +187,9 @@ class ConfigData:
         self._read_https_repository_host_configs()
         self._read_jenkins_slave_configs()
         self._read_jenkins_master_config()
+        self._read_image_builder_host()
+        self._read_docker_registry_config()
+        self._read_container_stop_timeout()
 
 
     def _read_host_machine_data(self):
@@ -217,10 +249,43 @@ class ConfigData:
             slave_config = JenkinsSlaveConfig()
             slave_config.machine_id = get_checked_value(config_dict, KEY_MACHINE_ID)
             slave_config.executors = int(get_checked_value(config_dict, KEY_EXECUTORS))
+            if KEY_RESOURCES in config_dict:
+                slave_config.resources = ContainerResources.from_dict(config_dict[KEY_RESOURCES], slave_config.machine_id)
 
             self.jenkins_slave_configs.append(slave_config)
 
 
+    def _read_image_builder_host(self):
+        """
+        Reads the optional KEY_IMAGE_BUILDER_HOST key.
+        """
+        if KEY_IMAGE_BUILDER_HOST in self._config_file_dict:
+            self.image_builder_machine_id = self._config_file_dict[KEY_IMAGE_BUILDER_HOST]
+
+
+    def _read_container_stop_timeout(self):
+        """
+        Reads the optional KEY_CONTAINER_STOP_TIMEOUT key.
+        """
+        if KEY_CONTAINER_STOP_TIMEOUT in self._config_file_dict:
+            self.container_stop_timeout = self._config_file_dict[KEY_CONTAINER_STOP_TIMEOUT]
+
+
+    def _read_docker_registry_config(self):
+        """
+        Reads the information under the optional KEY_DOCKER_REGISTRY key.
+        """
+        if KEY_DOCKER_REGISTRY not in self._config_file_dict:
+            return
+
+        config_dict = self._config_file_dict[KEY_DOCKER_REGISTRY]
+        self.docker_registry_config = DockerRegistryConfig()
+        self.docker_registry_config.machine_id = get_checked_value(config_dict, KEY_MACHINE_ID)
+        self.docker_registry_config.storage_dir = PurePosixPath(get_checked_value(config_dict, KEY_REGISTRY_STORAGE_DIR))
+        if KEY_REGISTRY_PORT in config_dict: # the port is optional
+            self.docker_registry_config.port = int(config_dict[KEY_REGISTRY_PORT])
+
+
     def _read_jenkins_master_config(self):
         """
         Reads the information under the KEY_JENKINS_CONFIG key.
@@ -292,6 +357,10 @@ class ConfigData:
         self._check_host_ids_are_unique()
         self._check_accounts_are_unique()
         self._check_jenkins_slave_executor_number()
+        self._check_jenkins_slave_resources()
+        self._check_image_builder_host()
+        self._check_docker_registry_host()
+        self._check_container_stop_timeout()
 
 
     def _check_file_version(self):
@@ -346,6 +415,12 @@ class ConfigData:
         for job_config in self.jenkins_config.cpf_job_configs:
             used_machines.append(job_config.webserver_config.machine_id)
 
+        if self.image_builder_machine_id:
+            used_machines.append(self.image_builder_machine_id)
+
+        if self.docker_registry_config:
+            used_machines.append(self.docker_registry_config.machine_id)
+
         # now check if all defined hosts are within the used machines list
         for host_config in self.host_machine_infos:
             found = next((x for x in used_machines if x == host_config.machine_id ), None)
@@ -353,6 +428,44 @@ class ConfigData:
                 raise Exception("Config file Error! The host machine with id {0} is not used.".format(host_config.machine_id))
 
 
+    def _check_image_builder_host(self):
+        """
+        The images are built with docker on the builder host, so it must be a Linux machine.
+        """
+        if not self.image_builder_machine_id:
+            return
+
+        host_info = self.get_host_info(self.image_builder_machine_id)
+        if host_info is None:
+            raise Exception("Config file Error! The {0} {1} is not defined in the {2} list.".format(KEY_IMAGE_BUILDER_HOST, self.image_builder_machine_id, KEY_LOGIN_DATA))
+        if not host_info.is_linux_machine():
+            raise Exception("Config file Error! The {0} must be a Linux machine.".format(KEY_IMAGE_BUILDER_HOST))
+
+
+    def _check_container_stop_timeout(self):
+        """
+        The timeout is passed to docker stop, which needs a number of seconds.
+        """
+        if self.container_stop_timeout is None:
+            return
+        if isinstance(self.container_stop_timeout, bool) or not isinstance(self.container_stop_timeout, int) or self.container_stop_timeout < 0:
+            raise Exception("Config file Error! The {0} must be a non negative number of seconds.".format(KEY_CONTAINER_STOP_TIMEOUT))
+
+
+    def _check_docker_registry_host(self):
+        """
+        The registry runs in a docker container, so its host must be a Linux machine.
+        """
+        if not self.docker_registry_config:
+            return
+
+        host_info = self.get_host_info(self.docker_registry_config.machine_id)
+        if host_info is None:
+            raise Exception("Config file Error! The host {0} of the {1} is not defined in the {2} list.".format(self.docker_registry_config.machine_id, KEY_DOCKER_REGISTRY, KEY_LOGIN_DATA))
+        if not host_info.is_linux_machine():
+            raise Exception("Config file Error! The host of the {0} must be a Linux machine.".format(KEY_DOCKER_REGISTRY))
+
+
     def _check_host_ids_are_unique(self):
         host_ids = []
         for host_config in self.host_machine_infos:
@@ -380,6 +493,15 @@ class ConfigData:
                 raise  Exception("Config file Error! Values for key {0} must be larger than zero.".format(KEY_EXECUTORS) )
 
 
+    def _check_jenkins_slave_resources(self):
+        """
+        The resource limits are options of the docker containers of the linux slaves.
+        """
+        for slave_config in self.jenkins_slave_configs:
+            if slave_config.resources is not None and not self.is_linux_machine(slave_config.machine_id):
+                raise Exception("Config file Error! The {0} of the jenkins slave on host {1} can only be set for Linux machines.".format(KEY_RESOURCES, slave_config.machine_id))
+
+
     def _configure_container(self):
         """
         Sets values to the member variables that hold container names and ips.
@@ -409,6 +531,8 @@ class ConfigData:
                 slave_config.container_conf.container_user = 'jenkins'
                 ip_index += 1
                 slave_config.container_conf.container_image_name = self._LINUX_SLAVE_BASE_NAME + '-image'
+                if slave_config.resources is not None:
+                    slave_config.container_conf.resources = slave_config.resources
 
             elif self.is_windows_machine(slave_config.machine_id):
                 slave_config.slave_name = 'CPF-{0}-windows-slave-{1}'.format(cpfmachines_version.CPFMACHINES_VERSION, windows_name_index)
@@ -479,12 +603,73 @@ class HostMachineInfo:
         else:
             raise Exception('Function needs to be extended to handle os type ' + self.os_type)
 
+        self.transport = TRANSPORT_SSH
+        if KEY_TRANSPORT in host_info_dict: # transport is optional
+            self.transport = host_info_dict[KEY_TRANSPORT]
+        if self.transport not in [TRANSPORT_SSH, TRANSPORT_LOCALHOST]:
+            raise Exception('Config file Error! The {0} of host {1} must be "{2}" or "{3}".'.format(KEY_TRANSPORT, self.machine_id, TRANSPORT_SSH, TRANSPORT_LOCALHOST))
+        if self.transport == TRANSPORT_LOCALHOST and not self.is_linux_machine():
+            raise Exception('Config file Error! The {0} "{1}" is only supported for Linux hosts.'.format(KEY_TRANSPORT, TRANSPORT_LOCALHOST))
+
+        self.ssh_transport = SSHTransportConfig()
+        if KEY_SSH_TRANSPORT in host_info_dict: # the tuning of the ssh transport is optional
+            self.ssh_transport = SSHTransportConfig.from_dict(host_info_dict[KEY_SSH_TRANSPORT], self.machine_id)
+
     def is_windows_machine(self):
         return self.os_type == "Windows"
 
     def is_linux_machine(self):
         return self.os_type == "Linux"
 
+    def is_localhost(self):
+        return self.transport == TRANSPORT_LOCALHOST
+
+
+class SSHTransportConfig:
+    """
+    Data class that holds the optional settings of the ssh transport of a host from the KEY_SSH_TRANSPORT key.
+    Settings that are None keep the paramiko defaults.
+    """
+    def __init__(self):
+        self.compression = False    # Compresses the transferred data. This can help on slow links but costs cpu time.
+        self.ciphers = None         # A list with the names of the allowed ciphers in the order of preference.
+        self.window_size = None     # The size of the ssh flow control window of each channel in bytes.
+        self.max_packet_size = None # The maximum size of the ssh packets in bytes.
+
+    @staticmethod
+    def from_dict(transport_dict, machine_id):
+        config = SSHTransportConfig()
+        if KEY_COMPRESSION in transport_dict:
+            config.compression = transport_dict[KEY_COMPRESSION]
+            if not isinstance(config.compression, bool):
+                raise Exception('Config file Error! The {0} value of the {1} of host {2} must be true or false.'.format(KEY_COMPRESSION, KEY_SSH_TRANSPORT, machine_id))
+
+        if KEY_CIPHERS in transport_dict:
+            config.ciphers = transport_dict[KEY_CIPHERS]
+            if not isinstance(config.ciphers, list) or not config.ciphers:
+                raise Exception('Config file Error! The {0} value of the {1} of host {2} must be a non empty list of cipher names.'.format(KEY_CIPHERS, KEY_SSH_TRANSPORT, machine_id))
+
+        for key, attribute in [(KEY_WINDOW_SIZE, 'window_size'), (KEY_MAX_PACKET_SIZE, 'max_packet_size')]:
+            if key in transport_dict:
+                value = transport_dict[key]
+                if not isinstance(value, int) or isinstance(value, bool) or value <= 0:
+                    raise Exception('Config file Error! The {0} value of the {1} of host {2} must be a positive number of bytes.'.format(key, KEY_SSH_TRANSPORT, machine_id))
+                setattr(config, attribute, value)
+
+        return config
+
+
+class DockerRegistryConfig:
+    """
+    Data class that holds the information from the KEY_DOCKER_REGISTRY key.
+    """
+    CONTAINER_NAME = 'cpf-docker-registry'
+
+    def __init__(self):
+        self.machine_id = ''                    # The host machine on which the registry container is run.
+        self.port = 5000                        # The port on the host under which the registry is reachable.
+        self.storage_dir = PurePosixPath()      # The directory on the host that holds the images of the registry.
+
 
 class JenkinsMasterHostConfig:
     """
@@ -507,6 +692,45 @@ class ContainerConfig:
         self.published_ports = {}           # The key is the port on the host, the value the port in the container.
         self.host_volumes = {}              # The key is the path on the host, the value the path in the container.
         self.envvar_definitions = []        # Environment variables that are defined in the container.
+        self.resources = ContainerResources()   # The limits of the cpus and the memory that the container can use.
+
+
+class ContainerResources:
+    """
+    Data class that holds the optional resource limits of a container from the KEY_RESOURCES key.
+    Settings that are None are not limited.
+    """
+    _SIZE_PATTERN = re.compile(r'^[0-9]+[bkmgBKMG]?$')
+    _CPUSET_PATTERN = re.compile(r'^[0-9]+(-[0-9]+)?(,[0-9]+(-[0-9]+)?)*$')
+
+    def __init__(self):
+        self.cpus = None            # The number of cpus that the container can use, e.g. 4 or 1.5.
+        self.cpuset_cpus = None     # The cpus on which the container runs in the cpuset format, e.g. "0-3,8-11". CPUSET_AUTO splits the cpus of the host between its slaves.
+        self.cpuset_mems = None     # The NUMA nodes from which the container gets memory. This is set with the automatically assigned cpus.
+        self.memory = None          # The memory limit with an optional unit, e.g. "8g".
+        self.shm_size = None        # The size of /dev/shm with an optional unit, e.g. "1g".
+
+    @staticmethod
+    def from_dict(resources_dict, machine_id):
+        resources = ContainerResources()
+        if KEY_CPUS in resources_dict:
+            resources.cpus = resources_dict[KEY_CPUS]
+            if not isinstance(resources.cpus, (int, float)) or isinstance(resources.cpus, bool) or resources.cpus <= 0:
+                raise Exception('Config file Error! The {0} value of the {1} of the slave on host {2} must be a positive number.'.format(KEY_CPUS, KEY_RESOURCES, machine_id))
+
+        if KEY_CPUSET_CPUS in resources_dict:
+            resources.cpuset_cpus = resources_dict[KEY_CPUSET_CPUS]
+            if resources.cpuset_cpus != CPUSET_AUTO and not ContainerResources._CPUSET_PATTERN.match(str(resources.cpuset_cpus)):
+                raise Exception('Config file Error! The {0} value of the {1} of the slave on host {2} must be a list of cpus like "0-3,8" or "{3}".'.format(KEY_CPUSET_CPUS, KEY_RESOURCES, machine_id, CPUSET_AUTO))
+
+        for key, attribute in [(KEY_MEMORY, 'memory'), (KEY_SHM_SIZE, 'shm_size')]:
+            if key in resources_dict:
+                value = resources_dict[key]
+                if not ContainerResources._SIZE_PATTERN.match(str(value)):
+                    raise Exception('Config file Error! The {0} value of the {1} of the slave on host {2} must be a size like "512m" or "8g".'.format(key, KEY_RESOURCES, machine_id))
+                setattr(resources, attribute, str(value))
+
+        return resources
 
 
 class SSHRepositoryConfig:
@@ -539,6 +763,7 @@ class JenkinsSlaveConfig:
         self.slave_name = ''
         self.executors = ''
         self.container_conf = None
+        self.resources = None           # A ContainerResources object if the KEY_RESOURCES key is given.
 
 
 class JenkinsConfig:
@@ -633,7 +858,13 @@ def get_example_config_dict():
                 KEY_USER : 'fritz',
                 KEY_PASSWORD : '1234password',
                 KEY_OSTYPE : 'Linux',
-                KEY_TEMPDIR : '/home/fritz/temp'
+                KEY_TEMPDIR : '/home/fritz/temp',
+                KEY_SSH_TRANSPORT : {
+                    KEY_COMPRESSION : False,
+                    KEY_CIPHERS : ['aes128-gcm@openssh.com', 'aes128-ctr'],
+                    KEY_WINDOW_SIZE : 16777216,
+                    KEY_MAX_PACKET_SIZE : 32768
+                }
             },
             {
                 KEY_MACHINE_ID : 'MyWindowsSlave',
@@ -672,7 +903,12 @@ def get_example_config_dict():
         KEY_JENKINS_SLAVES : [
             {
                 KEY_MACHINE_ID : 'MyLinuxSlave',
-                KEY_EXECUTORS : '2'
+                KEY_EXECUTORS : '2',
+                KEY_RESOURCES : {
+                    KEY_CPUSET_CPUS : CPUSET_AUTO,
+                    KEY_MEMORY : '16g',
+                    KEY_SHM_SIZE : '1g'
+                }
             },
             {
                 KEY_MACHINE_ID : 'MyMaster',
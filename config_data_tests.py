@@ -38,6 +38,11 @@ class TestConfigData(unittest.TestCase):
         self.assertEqual( sut.host_machine_infos[1].user_password, '1234password' )
         self.assertEqual( sut.host_machine_infos[1].os_type, 'Linux' )
         self.assertEqual( sut.host_machine_infos[1].temp_dir, PurePosixPath('/home/fritz/temp') )
+        self.assertEqual( sut.host_machine_infos[1].ssh_transport.compression, False )
+        self.assertEqual( sut.host_machine_infos[1].ssh_transport.ciphers, ['aes128-gcm@openssh.com', 'aes128-ctr'] )
+        self.assertEqual( sut.host_machine_infos[1].ssh_transport.window_size, 16777216 )
+        self.assertEqual( sut.host_machine_infos[1].ssh_transport.max_packet_size, 32768 )
+        self.assertEqual( sut.host_machine_infos[0].ssh_transport.window_size, None )
 
         self.assertEqual( sut.host_machine_infos[2].machine_id, 'MyWindowsSlave' )
         self.assertEqual( sut.host_machine_infos[2].host_name, 'whost12' )
@@ -310,6 +315,52 @@ class TestConfigData(unittest.TestCase):
         self.assertRaises(Exception, ConfigData, config_dict)
 
 
+    def test_reading_the_slave_resources(self):
+        """
+        The resource limits are set on the container config of the slave.
+        """
+        # setup
+        config_dict = get_example_config_dict()
+        config_dict[KEY_JENKINS_SLAVES][1][KEY_RESOURCES] = {
+            KEY_CPUS : 1.5,
+            KEY_CPUSET_CPUS : '0-3,8',
+            KEY_MEMORY : '512m'
+        }
+
+        # execute
+        sut = ConfigData(config_dict)
+
+        # verify
+        auto_resources = sut.jenkins_slave_configs[0].container_conf.resources
+        self.assertEqual(auto_resources.cpuset_cpus, CPUSET_AUTO)
+        self.assertEqual(auto_resources.memory, '16g')
+        self.assertEqual(auto_resources.shm_size, '1g')
+        self.assertIsNone(auto_resources.cpus)
+        resources = sut.jenkins_slave_configs[1].container_conf.resources
+        self.assertEqual(resources.cpus, 1.5)
+        self.assertEqual(resources.cpuset_cpus, '0-3,8')
+        self.assertEqual(resources.memory, '512m')
+        self.assertIsNone(resources.shm_size)
+        self.assertIsNone(sut.jenkins_master_host_config.container_conf.resources.memory)
+
+
+    def test_validation_checks_slave_resources(self):
+        """
+        The values must have the docker formats and can only be used for Linux slaves.
+        """
+        # setup
+        invalid_values = [(KEY_CPUS, 0), (KEY_CPUS, '2'), (KEY_CPUSET_CPUS, '0-3;5'), (KEY_MEMORY, '8 GB'), (KEY_SHM_SIZE, '-1g')]
+        windows_config_dict = get_example_config_dict()
+        windows_config_dict[KEY_JENKINS_SLAVES][2][KEY_RESOURCES] = {KEY_MEMORY : '8g'}
+
+        # execute
+        for key, value in invalid_values:
+            config_dict = get_example_config_dict()
+            config_dict[KEY_JENKINS_SLAVES][0][KEY_RESOURCES] = {key : value}
+            self.assertRaises(Exception, ConfigData, config_dict)
+        self.assertRaises(Exception, ConfigData, windows_config_dict)
+
+
     def test_validation_checks_that_container_hosts_have_temp_dir(self):
         """
         We need a temporary directory for the build-context when building
@@ -321,3 +372,123 @@ class TestConfigData(unittest.TestCase):
         # execute
         self.assertRaises(Exception, ConfigData, config_dict)
 
+
+
+    def test_host_transport_defaults_to_ssh(self):
+        """
+        Hosts without a transport entry are accessed over ssh.
+        """
+        # setup
+        config_dict = get_example_config_dict()
+        config_dict[KEY_LOGIN_DATA][1][KEY_TRANSPORT] = TRANSPORT_LOCALHOST
+
+        # execute
+        sut = ConfigData(config_dict)
+
+        # verify
+        self.assertEqual( sut.host_machine_infos[0].transport, TRANSPORT_SSH )
+        self.assertFalse( sut.host_machine_infos[0].is_localhost() )
+        self.assertEqual( sut.host_machine_infos[1].transport, TRANSPORT_LOCALHOST )
+        self.assertTrue( sut.host_machine_infos[1].is_localhost() )
+
+
+    def test_validation_checks_host_transport(self):
+        """
+        Only Linux hosts can be accessed with the localhost transport and
+        unknown transports are rejected.
+        """
+        # setup
+        config_dict = get_example_config_dict()
+        config_dict[KEY_LOGIN_DATA][1][KEY_TRANSPORT] = 'telnet'
+        windows_config_dict = get_example_config_dict()
+        windows_config_dict[KEY_LOGIN_DATA][2][KEY_TRANSPORT] = TRANSPORT_LOCALHOST
+
+        # execute
+        self.assertRaises(Exception, ConfigData, config_dict)
+        self.assertRaises(Exception, ConfigData, windows_config_dict)
+
+
+    def test_validation_checks_ssh_transport_settings(self):
+        """
+        The sizes of the ssh transport must be positive numbers and compression a boolean.
+        """
+        # setup
+        size_config_dict = get_example_config_dict()
+        size_config_dict[KEY_LOGIN_DATA][1][KEY_SSH_TRANSPORT][KEY_WINDOW_SIZE] = 0
+        compression_config_dict = get_example_config_dict()
+        compression_config_dict[KEY_LOGIN_DATA][1][KEY_SSH_TRANSPORT][KEY_COMPRESSION] = 'yes'
+
+        # execute
+        self.assertRaises(Exception, ConfigData, size_config_dict)
+        self.assertRaises(Exception, ConfigData, compression_config_dict)
+
+
+    def test_validation_checks_image_builder_host(self):
+        """
+        The image builder host must be a defined Linux machine.
+        """
+        # setup
+        config_dict = get_example_config_dict()
+        config_dict[KEY_IMAGE_BUILDER_HOST] = 'MyLinuxSlave'
+        unknown_host_config_dict = get_example_config_dict()
+        unknown_host_config_dict[KEY_IMAGE_BUILDER_HOST] = 'MyBuildServer'
+        windows_host_config_dict = get_example_config_dict()
+        windows_host_config_dict[KEY_IMAGE_BUILDER_HOST] = 'MyWindowsSlave'
+
+        # execute
+        sut = ConfigData(config_dict)
+        self.assertRaises(Exception, ConfigData, unknown_host_config_dict)
+        self.assertRaises(Exception, ConfigData, windows_host_config_dict)
+
+        # verify
+        self.assertEqual(sut.image_builder_machine_id, 'MyLinuxSlave')
+        self.assertEqual(ConfigData(get_example_config_dict()).image_builder_machine_id, '')
+
+
+    def test_validation_checks_container_stop_timeout(self):
+        """
+        The stop timeout is optional and must be a number of seconds.
+        """
+        # setup
+        config_dict = get_example_config_dict()
+        config_dict[KEY_CONTAINER_STOP_TIMEOUT] = 5
+        negative_config_dict = get_example_config_dict()
+        negative_config_dict[KEY_CONTAINER_STOP_TIMEOUT] = -1
+        string_config_dict = get_example_config_dict()
+        string_config_dict[KEY_CONTAINER_STOP_TIMEOUT] = '5'
+
+        # execute
+        sut = ConfigData(config_dict)
+        self.assertRaises(Exception, ConfigData, negative_config_dict)
+        self.assertRaises(Exception, ConfigData, string_config_dict)
+
+        # verify
+        self.assertEqual(sut.container_stop_timeout, 5)
+        self.assertIsNone(ConfigData(get_example_config_dict()).container_stop_timeout)
+
+
+    def test_reading_the_docker_registry_config(self):
+        """
+        The registry is optional and its port defaults to the registry default port.
+        """
+        # setup
+        config_dict = get_example_config_dict()
+        config_dict[KEY_DOCKER_REGISTRY] = {
+            KEY_MACHINE_ID : 'MyLinuxSlave',
+            KEY_REGISTRY_STORAGE_DIR : '/home/fritz/registry'
+        }
+        windows_host_config_dict = get_example_config_dict()
+        windows_host_config_dict[KEY_DOCKER_REGISTRY] = {
+            KEY_MACHINE_ID : 'MyWindowsSlave',
+            KEY_REGISTRY_STORAGE_DIR : 'C:/registry'
+        }
+
+        # execute
+        sut = ConfigData(config_dict)
+        self.assertRaises(Exception, ConfigData, windows_host_config_dict)
+
+        # verify
+        self.assertEqual(sut.docker_registry_config.machine_id, 'MyLinuxSlave')
+        self.assertEqual(sut.docker_registry_config.port, 5000)
+        self.assertEqual(sut.docker_registry_config.storage_dir, PurePosixPath('/home/fritz/registry'))
+        self.assertEqual(ConfigData(get_example_config_dict()).docker_registry_config, None)
@@ -6,42 +6,306 @@ import paramiko
 import getpass
 import weakref
 import time
+import threading
+import contextlib
+import functools
+import concurrent.futures
+import collections
+import select
+import uuid
+import subprocess
+import queue
+import os
+import shutil
 
 
 import config_data
+import tracing
+
+
+STDOUT = 'stdout'
+STDERR = 'stderr'
+
+# A line of the output of a command. stream is either STDOUT or STDERR.
+OutputLine = collections.namedtuple('OutputLine', ['stream', 'text'])
+# A piece of the undecoded output of a command as it was received.
+OutputChunk = collections.namedtuple('OutputChunk', ['stream', 'data'])
+
+_READ_SIZE = 32768
+_SELECT_TIMEOUT = 1.0
+# The number of output chunks of a local process that are buffered before its pipes are no longer read.
+_MAX_BUFFERED_CHUNKS = 64
+
+
+class MultiHostError(Exception):
+    """
+    An exception that collects the errors of an operation that was executed on multiple hosts.
+    The errors member is a dictionary with the machine ids as keys and the exceptions as values.
+    The results member holds the results of the hosts on which the operation succeeded.
+    """
+    def __init__(self, operation, errors, results=None):
+        self.errors = errors
+        self.results = results if results is not None else {}
+        message = '{0} failed on {1} host(s):'.format(operation, len(errors))
+        for machine_id, error in errors.items():
+            message += '\n[{0}] {1}'.format(machine_id, error)
+        super().__init__(message)
+
+
+class CommandError(Exception):
+    """
+    Is raised when a command returns a non zero return code.
+    """
+    def __init__(self, command, machine_id, return_code):
+        self.command = command
+        self.machine_id = machine_id
+        self.return_code = return_code
+        super().__init__('Command "{0}" executed on host {1} returned error code {2}.'.format(command, machine_id, str(return_code)))
+
+
+class ConnectionLostError(Exception):
+    """
+    Is raised when the connection to a host drops while a command is running.
+    """
 
 
 class ConnectionsHolder:
     """
     This class holds the ssh connections to all the host machines in the CPF infrastucture.
+
+    When parallel is set, the connections are opened concurrently by a pool of max_workers threads.
+    When lazy is set, no connections are opened during construction. The connection to a host
+    is opened when it is requested for the first time.
     """
 
-    def __init__(self, host_machine_infos):
+    def __init__(self, host_machine_infos, parallel=False, max_workers=None, use_shell_sessions=False, lazy=False):
         self._connection_holders = {}
-        self._establish_host_machine_connections(host_machine_infos)
+        self.connect_latencies = {}     # The time in seconds it took to connect to each host.
+        self._host_machine_infos = collections.OrderedDict((info.machine_id, info) for info in host_machine_infos)
+        self._max_workers = max_workers
+        self._use_shell_sessions = use_shell_sessions
+        self._lock = threading.Lock()
+
+        if lazy:
+            return
+
+        if parallel:
+            try:
+                self._establish_host_machine_connections_in_parallel(host_machine_infos, max_workers)
+            except MultiHostError:
+                self.remove_all()
+                raise
+        else:
+            self._establish_host_machine_connections(host_machine_infos)
 
 
     def _establish_host_machine_connections(self, host_machine_infos):
         """
-        Reads the machine login date from a config file dictionary.
-        Returns a map that contains machine ids as keys and HostMachineInfo objects as values.
+        Opens the connections to the given hosts one after another.
         """
         for info in host_machine_infos:
-            self._connection_holders[info.machine_id] = ConnectionHolder(info)
+            start_time = time.monotonic()
+            self._connection_holders[info.machine_id] = create_connection(info, self._use_shell_sessions)
+            self.connect_latencies[info.machine_id] = time.monotonic() - start_time
+
+
+    def _establish_host_machine_connections_in_parallel(self, host_machine_infos, max_workers):
+        """
+        Opens the connections to all given hosts at the same time.
+        Missing passwords are prompted before the connections are opened, so
+        the worker threads do not block on user input.
+        All hosts are tried, even if some of them fail. The failures are raised
+        together in a MultiHostError afterwards.
+        """
+        for info in host_machine_infos:
+            prompt_for_missing_password(info)
+
+        if not host_machine_infos:
+            return
+
+        errors = {}
+        if max_workers is None:
+            max_workers = len(host_machine_infos)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(_timed_connect, info, self._use_shell_sessions) : info for info in host_machine_infos}
+            for future in concurrent.futures.as_completed(futures):
+                info = futures[future]
+                try:
+                    connection, latency = future.result()
+                except Exception as err:
+                    errors[info.machine_id] = err
+                else:
+                    self._connection_holders[info.machine_id] = connection
+                    self.connect_latencies[info.machine_id] = latency
+                    print('[{0}] Connected in {1:.2f} seconds.'.format(info.machine_id, latency))
+
+        if errors:
+            raise MultiHostError('Connecting', errors)
 
 
     def get_connection(self, machine_id):
-        return self._connection_holders[machine_id]
+        """
+        Returns the connection to the given host and opens it if this was not done yet.
+        """
+        with self._lock:
+            if machine_id not in self._connection_holders:
+                self._establish_host_machine_connections([self._host_machine_infos[machine_id]])
+            return self._connection_holders[machine_id]
+
+
+    def connect(self, machine_ids):
+        """
+        Opens the connections to the given hosts concurrently, if they are not open yet.
+        """
+        with self._lock:
+            missing_infos = [self._host_machine_infos[machine_id] for machine_id in set(machine_ids) if machine_id not in self._connection_holders]
+            self._establish_host_machine_connections_in_parallel(missing_infos, self._max_workers)
 
 
-class ConnectionHolder:
+    def run_on_hosts(self, host_operations, max_workers=None, operation_name='Running operations', **kwargs):
+        """
+        Runs operations on multiple hosts at the same time.
+
+        host_operations is a list of (machine_id, operation) pairs. An operation is either a command
+        string that is executed with run_command(command, **kwargs), or a callable that
+        takes the ConnectionHolder of the host as argument.
+        The operations of one host are executed one after another in the given order, while
+        up to max_workers hosts are processed concurrently.
+
+        Returns a dictionary with the machine ids as keys and lists with the results of the
+        operations as values.
+        When an operation fails, the remaining operations of that host are skipped, but the other
+        hosts continue. The failures of all hosts are raised together in a MultiHostError.
+        """
+        operations_by_host = collections.OrderedDict()
+        for machine_id, operation in host_operations:
+            operations_by_host.setdefault(machine_id, []).append(operation)
+
+        if not operations_by_host:
+            return {}
+
+        # The connections are opened and looked up in the calling thread.
+        self.connect(operations_by_host.keys())
+        connections = {machine_id : self.get_connection(machine_id) for machine_id in operations_by_host}
+
+        results = {}
+        errors = {}
+        if max_workers is None:
+            max_workers = len(operations_by_host)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            for machine_id, operations in operations_by_host.items():
+                future = executor.submit(_run_host_operations, connections[machine_id], operations, kwargs)
+                futures[future] = machine_id
+            for future in concurrent.futures.as_completed(futures):
+                machine_id = futures[future]
+                try:
+                    results[machine_id] = future.result()
+                except Exception as err:
+                    errors[machine_id] = err
+
+        if errors:
+            raise MultiHostError(operation_name, errors, results)
+
+        return results
+
+
+    def remove_all(self):
+        """
+        Closes all open connections.
+        """
+        with self._lock:
+            for connection in self._connection_holders.values():
+                connection.remove()
+            self._connection_holders = {}
+
+
+def _run_host_operations(connection, operations, run_command_kwargs):
+    results = []
+    for operation in operations:
+        if callable(operation):
+            results.append(operation(connection))
+        else:
+            results.append(connection.run_command(operation, **run_command_kwargs))
+    return results
+
+
+def _timed_connect(host_info, use_shell_session):
+    start_time = time.monotonic()
+    connection = create_connection(host_info, use_shell_session)
+    return connection, time.monotonic() - start_time
+
+
+def create_connection(host_info, use_shell_session=False):
     """
-    This class stores a paramiko ssh and sftp connection and
-    closes them when deleted.
+    Returns a connection object for the host that uses the transport that is set in the host info.
     """
+    if host_info.is_localhost():
+        return LocalConnectionHolder(host_info, use_shell_session)
+    return ConnectionHolder(host_info, use_shell_session)
 
-    _CONNECTION_TIMEOUT = 10
-    _DEFAULT_SSH_PORT = 22
+
+def _create_transport(transport_config, sock, **kwargs):
+    """
+    Creates the paramiko transport of a ssh client with the window size, packet size and ciphers
+    from the given SSHTransportConfig. The keyword arguments are passed on from paramiko.SSHClient.connect().
+    """
+    window_size = transport_config.window_size
+    if window_size is None:
+        window_size = paramiko.common.DEFAULT_WINDOW_SIZE
+    max_packet_size = transport_config.max_packet_size
+    if max_packet_size is None:
+        max_packet_size = paramiko.common.DEFAULT_MAX_PACKET_SIZE
+
+    transport = paramiko.Transport(sock, default_window_size=window_size, default_max_packet_size=max_packet_size, **kwargs)
+    if transport_config.ciphers:
+        transport.get_security_options().ciphers = transport_config.ciphers
+    return transport
+
+
+def prompt_for_missing_password(host_info):
+    """
+    Asks the user for the password of the host account if it was not provided in the config file.
+    Local hosts need no password.
+    """
+    if not host_info.user_password and not host_info.is_localhost():
+        prompt_message = "Please enter the password for account {0}@{1}.".format(host_info.user_name, host_info.host_name)
+        host_info.user_password = getpass.getpass(prompt_message)
+
+
+class ChannelPool:
+    """
+    Hands out channels of one authenticated paramiko transport to multiple threads.
+
+    The number of channels that are open at the same time is limited to max_channels,
+    because ssh servers only allow a limited number of sessions per connection
+    (OpenSSH MaxSessions defaults to 10). Threads that request a channel while all are
+    in use block until one is returned.
+    """
+
+    def __init__(self, transport, max_channels):
+        self._transport = transport
+        self._channel_semaphore = threading.BoundedSemaphore(max_channels)
+
+
+    @contextlib.contextmanager
+    def channel(self, timeout=None):
+        """
+        Opens a new session channel and closes it when the context is left.
+        """
+        with self._channel_semaphore:
+            channel = self._transport.open_session(timeout=timeout)
+            try:
+                yield channel
+            finally:
+                channel.close()
+
+
+class _HostConnectionBase:
+    """
+    Implements the parts of the host connection interface that are the same for
+    all kinds of connections. Derived classes provide iter_command() and sftp_client.
+    """
 
     @property
     def removed(self):
@@ -49,121 +313,821 @@ class ConnectionHolder:
 
 
     def __init__(self, host_info):
+        self.info = host_info
+        self._print_lock = threading.Lock()
+
+
+    def remove(self):
+        self._finalizer()
+
+
+    def run_command(self, command, print_output=False, print_command=False, ignore_return_code=False, max_output_lines=None, spill_file=None, idempotent=False, stdin=None, trace_name=None):
+        """
+        The function runs a console command on the host machine.
+        The function returns the output of the command as a list of strings, where each element
+        in the list is a line in the output. 
+
+        The function throws if the return code is not zero and ignore_return_code is set to False.
+
+        The function can be called from multiple threads at the same time.
+
+        max_output_lines can be used to limit the memory used for commands with large outputs.
+        Only the last lines are kept in memory then and the returned list is incomplete.
+        The older lines are appended to the local spill_file if one is given.
+
+        Commands for which idempotent is set are executed again after reconnecting when the
+        connection is lost while they run. This is not done for commands with a stdin stream,
+        because the stream can not be read a second time. Before a command is run again, the
+        lines that the interrupted run wrote to the spill_file are removed and the printed output
+        gets a note that the following lines come from the new run.
+
+        stdin can be bytes or an iterable of bytes chunks that are written to the standard input of the command.
+
+        trace_name replaces the command in the trace file. Use it for commands that contain secrets.
+        """
+        if idempotent and (stdin is None or isinstance(stdin, bytes)):
+            spill_file_size = _get_file_size(spill_file)
+            return self._run_with_retries(
+                lambda: self.run_command(command, print_output, print_command, ignore_return_code, max_output_lines, spill_file, stdin=stdin, trace_name=trace_name),
+                'running "{0}"'.format(trace_name or command),
+                on_retry=lambda: self._prepare_command_retry(trace_name or command, print_output, spill_file, spill_file_size)
+            )
+
+        tail = CommandOutputTail(max_output_lines, spill_file)
+        try:
+            lines = self.iter_command(command, print_command=print_command, ignore_return_code=ignore_return_code, stdin=stdin, trace_name=trace_name)
+            for line in lines:
+                tail.append(line)
+                if print_output:
+                    self._print(self._prepend_machine_id(line.text))
+        except CommandError:
+            if not print_output:                         # always print the output in case of an error
+                self._print_output(tail.lines)
+            if tail.spilled_lines:
+                self._print(self._prepend_machine_id('{0} more lines of output were written to {1}'.format(tail.spilled_lines, spill_file)))
+            raise
+        finally:
+            tail.close()
+
+        return [line.text for line in tail.lines if line.stream == STDOUT]
+
+
+    def _run_with_retries(self, function, description, on_retry=None):
+        """
+        Calls the function. Derived classes can retry the function when the connection was lost.
+        They call on_retry before the function is called again.
+        """
+        return function()
+
+
+    def _prepare_command_retry(self, command, print_output, spill_file, spill_file_size):
+        """
+        Removes the output of the interrupted run from the spill file and marks the end of its printed output.
+        """
+        if spill_file is not None and os.path.exists(str(spill_file)):
+            os.truncate(str(spill_file), spill_file_size)
+        if print_output:
+            self._print(self._prepend_machine_id('----- The output above is from an interrupted run. Running "{0}" again.'.format(command)))
+
+
+    def _print_output(self, output_lines):
+        with self._print_lock:
+            for line in output_lines:
+                print(self._prepend_machine_id(line.text))
+
+
+    def _print(self, string, end='\n'):
+        with self._print_lock:
+            print(string, end=end)
+
+
+    def _prepend_machine_id(self, string):
+        return "[{0}] ".format(self.info.machine_id) + string
+
+
+class ConnectionHolder(_HostConnectionBase):
+    """
+    This class stores a paramiko ssh and sftp connection and
+    closes them when deleted.
+
+    The commands and sftp sessions of one object can be used from multiple threads.
+    They share the one authenticated ssh transport of the object.
+
+    If use_shell_session is set, commands on Linux hosts are executed in a long-lived remote shell
+    instead of opening a new channel for each command. Commands that are run while
+    the shell is busy with another thread's command still use their own channel.
+    """
+
+    _CONNECTION_TIMEOUT = 10
+    _DEFAULT_SSH_PORT = 22
+    # Leaves some sessions of the OpenSSH default MaxSessions=10 for the shell session and the sftp client.
+    _MAX_CHANNELS = 5
+    # Keepalive messages prevent firewalls from dropping idle connections during long setup phases.
+    _KEEPALIVE_INTERVAL = 30
+    # Retried operations wait _RETRY_BASE_DELAY * 2^n seconds before the n-th retry.
+    _MAX_RETRIES = 4
+    _RETRY_BASE_DELAY = 1
+
+    def __init__(self, host_info, use_shell_session=False):
         """
         Connections are opened during construction.
         """
-        self.info = host_info
-        self._ssh_client = paramiko.SSHClient()
+        super().__init__(host_info)
 
         # prompt for password if it was not provided in the file
-        if not self.info.user_password:
-            prompt_message = "Please enter the password for account {0}@{1}.".format(self.info.user_name, self.info.host_name)
-            self.info.user_password = getpass.getpass(prompt_message)
+        prompt_for_missing_password(self.info)
+
+        self._ssh_client = None
+        self._sftp_client = None
+        self._channel_pool = None
+        self._connection_lock = threading.RLock()
+        self._sftp_lock = threading.Lock()
+        # The session needs a posix shell on the host.
+        self._use_shell_session = use_shell_session and self.info.is_linux_machine()
+        self._shell_session = None
+        self._shell_session_lock = threading.Lock()
 
         # make the connection
-        self._ssh_client.load_system_host_keys()
+        self._connect()
+        
+        # object to close open connections when the object is destroyed
+        self._finalizer = weakref.finalize(self, self._close_connections)
+
+
+    def _connect(self):
+        ssh_client = paramiko.SSHClient()
+        ssh_client.load_system_host_keys()
         #connection.ssh_client.set_missing_host_key_policy(paramiko.WarningPolicy)
-        self._ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         try:
-            self._ssh_client.connect(
+            ssh_client.connect(
                 self.info.host_name,
                 port=self._DEFAULT_SSH_PORT,
                 username=self.info.user_name,
                 password=self.info.user_password,
-                timeout=self._CONNECTION_TIMEOUT
+                timeout=self._CONNECTION_TIMEOUT,
+                compress=self.info.ssh_transport.compression,
+                transport_factory=functools.partial(_create_transport, self.info.ssh_transport)
             )
         except Exception as err:
             print('Failed to connect to ssh account {0}@{1} with {2} seconds timeout'.format(self.info.user_name, self.info.host_name, self._CONNECTION_TIMEOUT))
             raise err
 
-        self.sftp_client = self._ssh_client.open_sftp()
-        
-        # object to close open connections when the object is destroyed
-        self._finalizer = weakref.finalize(self, self._close_connections)
+        transport = ssh_client.get_transport()
+        transport.set_keepalive(self._KEEPALIVE_INTERVAL)
+        self._ssh_client = ssh_client
+        self._channel_pool = ChannelPool(transport, self._MAX_CHANNELS)
 
 
     def _close_connections(self):
-        self.sftp_client.close()
+        if self._shell_session:
+            self._shell_session.close()
+            self._shell_session = None
+        if self._sftp_client:
+            self._sftp_client.close()
+            self._sftp_client = None
         self._ssh_client.close()
 
 
-    def remove(self):
-        self._finalizer()
+    def is_connected(self):
+        transport = self._ssh_client.get_transport()
+        return transport is not None and transport.is_active()
 
 
-    def run_command(self, command, print_output=False, print_command=False, ignore_return_code=False):
+    def _ensure_connected(self):
         """
-        The function runs a console command on the remote host machine via the paramiko ssh client.
-        The function returns the output of the command as a list of strings, where each element
-        in the list is a line in the output. 
+        Transparently reopens the connection if the transport was dropped.
+        """
+        if self.is_connected():
+            return
 
-        The function throws if the return code is not zero and ignore_return_code is set to False.
+        with self._connection_lock:
+            attempt = 0
+            while not self.is_connected():
+                self._print(self._prepend_machine_id('The connection was lost. Reconnecting ...'))
+                self._close_connections()
+                try:
+                    self._connect()
+                except Exception:
+                    if attempt >= self._MAX_RETRIES:
+                        raise
+                    time.sleep(self._RETRY_BASE_DELAY * 2**attempt)
+                    attempt += 1
+
+
+    def _run_with_retries(self, function, description, on_retry=None):
+        """
+        Calls the function and calls it again after reconnecting if it failed because the connection was lost.
+        This must only be used for idempotent operations, because the first call may have
+        been executed on the host before the connection was lost.
+        on_retry is called before each repeated call.
+        """
+        attempt = 0
+        while True:
+            self._ensure_connected()
+            try:
+                return function()
+            except CommandError:
+                raise
+            except Exception:
+                if self.is_connected() or attempt >= self._MAX_RETRIES:
+                    raise
+                delay = self._RETRY_BASE_DELAY * 2**attempt
+                self._print(self._prepend_machine_id('Lost the connection while {0}. Retrying in {1} seconds.'.format(description, delay)))
+                time.sleep(delay)
+                attempt += 1
+                if on_retry is not None:
+                    on_retry()
+
+
+    @property
+    def sftp_client(self):
+        """
+        The sftp subsystem is only opened when the first file operation needs it.
+        The returned client retries its operations after reconnecting when the connection was lost.
+        """
+        return _RetryingSFTPClient(self)
+
+
+    def _get_sftp_client(self):
+        self._ensure_connected()
+        with self._sftp_lock:
+            if self._sftp_client is None:
+                self._sftp_client = self._ssh_client.open_sftp()
+            return self._sftp_client
+
+
+    def iter_command(self, command, print_command=False, ignore_return_code=False, stdin=None, raw_output=False, trace_name=None):
+        """
+        Runs a command on the host machine and yields the lines of its stdout and stderr
+        as OutputLine objects as soon as they arrive.
+
+        Both streams are read without blocking, so commands that write a lot
+        to only one of them can not stall. 
+
+        stdin can be bytes or an iterable of bytes chunks. They are sent to the standard input
+        of the command by a separate thread while the output is read.
+
+        If raw_output is set, the output is yielded as OutputChunk objects with the undecoded
+        bytes as they arrive. This is used for commands that write binary data.
+
+        trace_name replaces the command in the trace file. Use it for commands that contain secrets.
+
+        The generator raises a CommandError after the last line if the return code
+        is not zero and ignore_return_code is set to False. Its return value is the
+        return code of the command.
         """
         if print_command:
-            print(self._prepend_machine_id(command))
+            self._print(self._prepend_machine_id(command))
 
-        stdin, stdout, stderr = self._ssh_client.exec_command(command, get_pty=False)
+        with tracing.span(trace_name or command, 'command', self.info.machine_id) as span:
+            self._ensure_connected()
+            # The shell session has no standard input for its commands.
+            if stdin is None and not raw_output and self._use_shell_session and self._shell_session_lock.acquire(blocking=False):
+                try:
+                    retcode = yield from _count_transferred_bytes(self._iter_shell_session_command(command), span)
+                finally:
+                    self._shell_session_lock.release()
+            else:
+                with self._channel_pool.channel(timeout=self._CONNECTION_TIMEOUT) as channel:
+                    channel.exec_command(command)
+                    writer = _StdinWriter(stdin, channel.sendall, channel.shutdown_write)
+                    yield from _count_transferred_bytes(_iter_output(_iter_channel_chunks(channel), raw_output), span)
+                    retcode = channel.recv_exit_status()
+                writer.finish(span)
 
+        # A channel that is closed by a dropped transport has no exit status.
+        if retcode == -1 and not self.is_connected():
+            raise ConnectionLostError('The connection to host {0} was lost while running the command "{1}".'.format(self.info.machine_id, command))
 
-        # print output as soon as it is produced
-        out_list = []
-        err_list = []
-        for line in iter(stdout.readline, ""):
-            
-            # add the line without line separators
-            out_list.append(line.rstrip()) 
-            err_list.append(stderr.readline())
+        if not ignore_return_code and retcode != 0:
+            raise CommandError(command, self.info.machine_id, retcode)
+        return retcode
 
-            if print_output:
-                print(self._prepend_machine_id(line), end="")
 
-            # Paramiko sometimes does not close the channel after the command is done.
-            # See https://github.com/paramiko/paramiko/issues/109
-            # The exit code is however set. With this we can close the channel
-            # and prevent infinite loops.
-            if stdout.channel.exit_status_ready():
-                stdout.channel.close()
-                stderr.channel.close()
+    def _iter_shell_session_command(self, command):
+        """
+        Runs the command in the shell session and opens the session if it does not exist yet.
+        A session that was closed because a command could not be stopped is replaced by a new one.
+        """
+        if self._shell_session is None or not self._shell_session.is_alive():
+            channel = self._ssh_client.get_transport().open_session(timeout=self._CONNECTION_TIMEOUT)
+            self._shell_session = ShellSession(channel)
+        return (yield from self._shell_session.iter_command(command))
+
+
+class LocalConnectionHolder(_HostConnectionBase):
+    """
+    Offers the interface of the ConnectionHolder class for the machine that runs the setup script.
+
+    Commands are run as local processes and file operations work directly on the
+    local file system, so no ssh connection is needed.
+    """
+
+    def __init__(self, host_info, use_shell_session=False):
+        """
+        The use_shell_session argument is accepted for compatibility with the ConnectionHolder class.
+        Starting a local process is cheap, so each command gets its own process.
+        """
+        super().__init__(host_info)
+        self._file_client = LocalFileClient(self.info.machine_id)
+        self._finalizer = weakref.finalize(self, self._file_client.close)
+
+
+    def is_connected(self):
+        return True
 
 
-        err_list = stderr.readlines()
-        err_list = self._remove_line_separators(err_list)
-        retcode = stdout.channel.recv_exit_status()
+    @property
+    def sftp_client(self):
+        return self._file_client
+
+
+    def iter_command(self, command, print_command=False, ignore_return_code=False, stdin=None, raw_output=False, trace_name=None):
+        """
+        Runs a command in a local sh process and yields the lines of its stdout and stderr
+        as OutputLine objects as soon as they arrive.
+        The behavior is the same as for ConnectionHolder.iter_command().
+        """
+        if print_command:
+            self._print(self._prepend_machine_id(command))
+
+        with tracing.span(trace_name or command, 'command', self.info.machine_id) as span:
+            stdin_pipe = subprocess.DEVNULL if stdin is None else subprocess.PIPE
+            process = subprocess.Popen(command, shell=True, stdin=stdin_pipe, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            writer = _StdinWriter(stdin, process.stdin.write if process.stdin else None, process.stdin.close if process.stdin else None)
+            try:
+                yield from _count_transferred_bytes(_iter_output(_iter_process_chunks(process), raw_output), span)
+            finally:
+                if process.poll() is None:                  # the output was not read to its end
+                    process.kill()
+                retcode = process.wait()
+            writer.finish(span)
 
         if not ignore_return_code and retcode != 0:
-            if not print_output:                         # always print the output in case of an error
-                self._print_output(out_list, err_list)
-            error = 'Command "{0}" executed on host {1} returned error code {2}.'.format(command, self.info.machine_id, str(retcode))
-            raise Exception(error)
+            raise CommandError(command, self.info.machine_id, retcode)
+        return retcode
 
-        return out_list
 
+def _count_transferred_bytes(lines, span):
+    """
+    Passes on the OutputLine or OutputChunk objects of a generator and adds their size to the given tracing span.
+    Returns the return value of the wrapped generator.
+    """
+    try:
+        while True:
+            try:
+                line = next(lines)
+            except StopIteration as stop:
+                return stop.value
+            if isinstance(line, OutputChunk):
+                span.bytes_transferred += len(line.data)
+            else:
+                span.bytes_transferred += len(line.text) + 1
+            yield line
+    finally:
+        lines.close()
 
-    def _remove_line_separators(self, stringlist):
-        new_list = []
-        for string in stringlist:
-            new_list.append(string.rstrip())
-        return new_list
 
+def _iter_output(chunks, raw_output):
+    """
+    Passes on the OutputChunk objects of a generator if raw_output is set and
+    splits them into OutputLine objects otherwise.
+    """
+    if raw_output:
+        return chunks
+    return _iter_lines(chunks)
 
-    def _print_output(self, out_list, err_list):
-        out_list = self._prepend_machine_ids(out_list)
-        _print_string_list(out_list)
-        err_list = self._prepend_machine_ids(err_list)
-        _print_string_list(err_list)
 
+def _iter_lines(chunks):
+    """
+    Splits the OutputChunk objects of the stdout and stderr streams into OutputLine objects.
+    """
+    buffers = {STDOUT : b'', STDERR : b''}
+    try:
+        for stream, data in chunks:
+            buffers[stream] += data
+            *lines, buffers[stream] = buffers[stream].split(b'\n')
+            for line in lines:
+                yield OutputLine(stream, _decode_line(line))
+    finally:
+        chunks.close()
 
-    def _prepend_machine_ids(self, stringlist):
-        return [ (self._prepend_machine_id(string)) for string in stringlist]
+    for stream, rest in buffers.items():
+        if rest:
+            yield OutputLine(stream, _decode_line(rest))
 
 
-    def _prepend_machine_id(self, string):
-        return "[{0}] ".format(self.info.machine_id) + string
+def _iter_channel_chunks(channel):
+    """
+    Demultiplexes the stdout and stderr streams of a channel on which a command was started.
+    Yields the received data as OutputChunk objects in the order in which it arrives until the channel is
+    closed or the exit status of the command was received and all output is read.
+    """
+    receivers = {STDOUT : (channel.recv_ready, channel.recv), STDERR : (channel.recv_stderr_ready, channel.recv_stderr)}
+
+    while True:
+        received_data = False
+        for stream, (is_ready, receive) in receivers.items():
+            if is_ready():
+                data = receive(_READ_SIZE)
+                if data:
+                    received_data = True
+                    yield OutputChunk(stream, data)
+
+        if received_data:
+            continue
+
+        # Paramiko sometimes does not close the channel after the command is done.
+        # See https://github.com/paramiko/paramiko/issues/109
+        # The exit status is sent after all output, so we can stop reading when it is set.
+        if channel.closed or channel.eof_received or channel.exit_status_ready():
+            if not channel.recv_ready() and not channel.recv_stderr_ready():
+                break
+
+        # Wait until more data arrives on one of the streams.
+        select.select([channel], [], [], _SELECT_TIMEOUT)
+
+
+class _StdinWriter:
+    """
+    Writes the stdin data of a command in a separate thread, so the output of the
+    command can be read at the same time. The input is closed after the last chunk.
+
+    Errors of the write function are ignored, because they happen when the command
+    exits without reading all input, which is reported by its return code.
+    Errors of the stdin iterable are raised by finish().
+    """
+    def __init__(self, stdin, write, close_input):
+        self.bytes_written = 0
+        self._error = None
+        self._thread = None
+        if stdin is None:
+            return
+        self._thread = threading.Thread(target=self._write_all, args=(stdin, write, close_input), daemon=True)
+        self._thread.start()
+
+    def _write_all(self, stdin, write, close_input):
+        chunks = _iter_stdin_chunks(stdin)
+        try:
+            while True:
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    break
+                except Exception as err:
+                    self._error = err
+                    break
+                write(chunk)
+                self.bytes_written += len(chunk)
+        except Exception:
+            pass
+        finally:
+            # Stops the producer of the input if the command did not read all of it.
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            try:
+                close_input()
+            except Exception:
+                pass
+
+    def finish(self, span):
+        """
+        Waits until all data is written and adds the number of written bytes to the tracing span.
+        """
+        if self._thread is None:
+            return
+        self._thread.join()
+        span.bytes_transferred += self.bytes_written
+        if self._error:
+            raise self._error
+
+
+def _iter_stdin_chunks(stdin):
+    if isinstance(stdin, bytes):
+        for offset in range(0, len(stdin), _READ_SIZE):
+            yield stdin[offset:offset + _READ_SIZE]
+    else:
+        yield from stdin
+
+
+def _iter_process_chunks(process):
+    """
+    Demultiplexes the stdout and stderr pipes of a local process.
+    Each pipe is read by its own thread, so a process that writes a lot to only one of them can not stall.
+    Yields the read data as OutputChunk objects in the order in which it arrives until both pipes are closed.
+    The buffer between the threads is bounded, so a process that writes faster than the output
+    is consumed is slowed down instead of filling the memory.
+    """
+    chunks = queue.Queue(maxsize=_MAX_BUFFERED_CHUNKS)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                chunks.put(item, timeout=_SELECT_TIMEOUT)
+                return
+            except queue.Full:
+                pass
+
+    def read_pipe(stream, pipe):
+        with pipe:
+            for data in iter(lambda: pipe.read1(_READ_SIZE), b''):
+                put(OutputChunk(stream, data))
+        put(None)
+
+    readers = [
+        threading.Thread(target=read_pipe, args=(STDOUT, process.stdout), daemon=True),
+        threading.Thread(target=read_pipe, args=(STDERR, process.stderr), daemon=True),
+    ]
+    for reader in readers:
+        reader.start()
+
+    try:
+        open_pipes = len(readers)
+        while open_pipes:
+            chunk = chunks.get()
+            if chunk is None:
+                open_pipes -= 1
+            else:
+                yield chunk
+    finally:
+        stopped.set()
+
+
+class _RetryingSFTPClient:
+    """
+    Forwards the method calls to the sftp client of a ConnectionHolder and repeats
+    them after reconnecting if the connection was lost.
+
+    Only the operations that give the same result when they are executed twice are repeated.
+    Operations like mkdir, remove or rename may have been executed on the host before the
+    connection was lost, so repeating them would fail with an error that hides the lost connection.
+    """
+
+    # The operations that are repeated after reconnecting.
+    _IDEMPOTENT_OPERATIONS = frozenset(['stat', 'lstat', 'listdir', 'listdir_attr', 'normalize', 'readlink', 'get', 'put', 'chmod'])
+
+    def __init__(self, connection):
+        self._connection = connection
+        self.machine_id = connection.info.machine_id
+
+    def __getattr__(self, name):
+        attribute = getattr(self._connection._get_sftp_client(), name)
+        if not callable(attribute) or name not in self._IDEMPOTENT_OPERATIONS:
+            return attribute
+
+        def call_with_retries(*args, **kwargs):
+            return self._connection._run_with_retries(
+                lambda: getattr(self._connection._get_sftp_client(), name)(*args, **kwargs),
+                'running the sftp operation {0}'.format(name)
+            )
+        return call_with_retries
+
+
+class LocalFileClient:
+    """
+    Implements the parts of the paramiko SFTPClient interface that are used by the
+    setup scripts on the local file system.
+    """
+    def __init__(self, machine_id=''):
+        self.machine_id = machine_id
+
+    def stat(self, path):
+        return paramiko.SFTPAttributes.from_stat(os.stat(path))
+
+    def lstat(self, path):
+        return paramiko.SFTPAttributes.from_stat(os.lstat(path))
+
+    def listdir(self, path='.'):
+        return os.listdir(path)
+
+    def listdir_attr(self, path='.'):
+        return [paramiko.SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)), name) for name in os.listdir(path)]
+
+    def mkdir(self, path, mode=0o777):
+        os.mkdir(path, mode)
+
+    def rmdir(self, path):
+        os.rmdir(path)
+
+    def remove(self, path):
+        os.remove(path)
+
+    def rename(self, oldpath, newpath):
+        os.rename(oldpath, newpath)
+
+    def chmod(self, path, mode):
+        os.chmod(path, mode)
+
+    def open(self, filename, mode='r', bufsize=-1):
+        if 'b' not in mode:                             # sftp files are always binary
+            mode += 'b'
+        return open(filename, mode, bufsize)
+
+    def put(self, localpath, remotepath, callback=None, confirm=True):
+        shutil.copyfile(localpath, remotepath)
+        return self.stat(remotepath)
+
+    def get(self, remotepath, localpath, callback=None):
+        shutil.copyfile(remotepath, localpath)
+
+    def close(self):
+        pass
+
+
+class ShellSession:
+    """
+    A long-lived sh process on a host machine that executes commands one after another.
+
+    This saves opening a channel and starting a process on the host for each command.
+    The end of the output of a command and its return code are detected with marker lines
+    that are printed to stdout and stderr after the command.
+    Each command is run with "$SHELL -c" like the commands of an exec channel, so it gets the shell
+    of the user and can not change the state of the session. The stdin of the commands is
+    /dev/null because the stdin of the session carries the commands.
+    """
+
+    # The seconds that a stopped command gets to end before the session is discarded.
+    _STOP_TIMEOUT = 10
+
+    def __init__(self, channel):
+        self._channel = channel
+        self._marker = '__CPFMACHINES_COMMAND_END_{0}__'.format(uuid.uuid4().hex)
+        # The session writes the process id of the running command to this file, so it can be stopped.
+        self._pid_file = '/tmp/cpfmachines-shell-session-{0}.pid'.format(uuid.uuid4().hex)
+        # The time until which the output of a stopped command is read.
+        self._deadline = None
+        self._channel.exec_command('sh')
+
+
+    def is_alive(self):
+        return not (self._channel.closed or self._channel.eof_received or self._channel.exit_status_ready())
+
+
+    def close(self):
+        self._channel.close()
+
+
+    def iter_command(self, command):
+        """
+        Yields the output lines of the command as OutputLine objects and returns its return code.
+
+        If the generator is closed before the command ended, the command is stopped and its
+        remaining output is read up to the markers, so the session can be used for the next command.
+        The session is closed if the command does not end within _STOP_TIMEOUT seconds.
+        """
+        quoted_command = "'" + command.replace("'", "'\\''") + "'"
+        script = (
+            '"${{SHELL:-/bin/sh}}" -c {0} < /dev/null &\n'
+            'echo $! > {2}\n'
+            'wait $!\n'
+            'retcode=$?\n'
+            'rm -f {2}\n'
+            'printf "\\n{1} %d\\n" $retcode\n'
+            'printf "\\n{1}\\n" >&2\n'
+        ).format(quoted_command, self._marker, self._pid_file)
+        self._channel.sendall(script.encode('utf-8'))
+
+        self._deadline = None
+        lines = self._iter_output(command)
+        try:
+            while True:
+                try:
+                    line = next(lines)
+                except StopIteration as stop:
+                    return stop.value
+                yield line
+        except GeneratorExit:
+            self._stop_command(lines)
+            raise
+        except Exception:
+            # The position of the session in the output is unknown after an error.
+            self.close()
+            raise
+
+
+    def _stop_command(self, lines):
+        """
+        Terminates the running command over a separate channel and discards its remaining output.
+        """
+        try:
+            stop_channel = self._channel.get_transport().open_session()
+            stop_channel.exec_command(
+                'for i in 1 2 3 4 5; do [ -f {0} ] && break; sleep 0.2; done; '
+                'pid=$(cat {0} 2>/dev/null) && {{ pkill -TERM -P $pid; kill -TERM $pid; }}'.format(self._pid_file)
+            )
+            stop_channel.recv_exit_status()
+            stop_channel.close()
+            self._deadline = time.monotonic() + self._STOP_TIMEOUT
+            for _ in lines:
+                pass
+        except Exception:
+            self.close()
+
+
+    def _iter_output(self, command):
+        """
+        Yields the output lines of the running command and returns its return code
+        when the markers arrived on both streams.
+        """
+        marker = self._marker.encode('utf-8')
+        buffers = {STDOUT : b'', STDERR : b''}
+        held_back_lines = {STDOUT : None, STDERR : None}
+        receivers = {STDOUT : (self._channel.recv_ready, self._channel.recv), STDERR : (self._channel.recv_stderr_ready, self._channel.recv_stderr)}
+        retcode = None
+        finished_streams = set()
+
+        while len(finished_streams) < 2:
+            received_data = False
+            for stream, (is_ready, receive) in receivers.items():
+                if stream in finished_streams or not is_ready():
+                    continue
+                data = receive(_READ_SIZE)
+                if not data:
+                    continue
+                received_data = True
+                buffers[stream] += data
+                *lines, buffers[stream] = buffers[stream].split(b'\n')
+                for line in lines:
+                    if stream in finished_streams:
+                        break
+                    if line.startswith(marker):
+                        # The marker is printed after a newline, which adds an empty line
+                        # if the output of the command ended with a newline.
+                        if stream == STDOUT:
+                            retcode = int(line[len(marker):])
+                        finished_streams.add(stream)
+                        continue
+                    # An empty line is only passed on when the next line arrives, so the
+                    # additional empty line before the marker can be removed.
+                    if held_back_lines[stream] is not None:
+                        yield OutputLine(stream, _decode_line(held_back_lines[stream]))
+                        held_back_lines[stream] = None
+                    if line:
+                        yield OutputLine(stream, _decode_line(line))
+                    else:
+                        held_back_lines[stream] = line
+
+            if received_data:
+                continue
+
+            if not self.is_alive() and not self._channel.recv_ready() and not self._channel.recv_stderr_ready():
+                raise Exception('The remote shell session terminated while running the command "{0}".'.format(command))
+            if self._deadline is not None and time.monotonic() > self._deadline:
+                raise Exception('The stopped command "{0}" did not end.'.format(command))
+
+            select.select([self._channel], [], [], _SELECT_TIMEOUT)
+
+        return retcode
+
+
+def _decode_line(line):
+    return line.decode('utf-8', errors='replace').rstrip()
+
+
+def _get_file_size(file_path):
+    """
+    Returns the size of the local file or 0 if there is no such file.
+    """
+    if file_path is None or not os.path.exists(str(file_path)):
+        return 0
+    return os.path.getsize(str(file_path))
+
+
+class CommandOutputTail:
+    """
+    Collects the output lines of a command.
+    If max_lines is set, only the last max_lines lines are kept in memory. The older lines are
+    appended to the local spill_file if one is given, or dropped otherwise.
+    """
+    def __init__(self, max_lines=None, spill_file=None):
+        self._lines = collections.deque(maxlen=max_lines)
+        self._spill_file_path = spill_file
+        self._spill_file = None
+        self.spilled_lines = 0
+
+    @property
+    def lines(self):
+        return list(self._lines)
+
+    def append(self, line):
+        if self._lines.maxlen is not None and len(self._lines) == self._lines.maxlen:
+            self._spill(self._lines[0])
+        self._lines.append(line)
 
+    def _spill(self, line):
+        self.spilled_lines += 1
+        if self._spill_file_path is None:
+            return
+        if self._spill_file is None:
+            self._spill_file = open(str(self._spill_file_path), 'a', encoding='utf-8')
+        self._spill_file.write('[{0}] {1}\n'.format(line.stream, line.text))
 
-def _print_string_list(list):
-    for string in list:
-        print(string)
+    def close(self):
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
 
 
     
\ No newline at end of file
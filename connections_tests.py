@@ -0,0 +1,526 @@
+#!/usr/bin/env python3
+"""
+This module contains automated tests for the connections module.
+"""
+
+import unittest
+import io
+import contextlib
+import tempfile
+import os
+import stat
+import re
+import select
+import shutil
+import subprocess
+import time
+
+from connections import *
+import config_data
+import tracing
+import connections
+
+
+def get_local_host_info(machine_id='MyLocalHost'):
+    return config_data.HostMachineInfo({
+        config_data.KEY_MACHINE_ID : machine_id,
+        config_data.KEY_HOST : 'localhost',
+        config_data.KEY_USER : 'fritz',
+        config_data.KEY_OSTYPE : 'Linux',
+        config_data.KEY_TEMPDIR : tempfile.gettempdir(),
+        config_data.KEY_TRANSPORT : config_data.TRANSPORT_LOCALHOST,
+    })
+
+
+class RetryOnceLocalConnection(LocalConnectionHolder):
+    """
+    Runs each retried operation a second time, as if the connection was lost after the first run.
+    """
+    def _run_with_retries(self, function, description, on_retry=None):
+        function()
+        on_retry()
+        return function()
+
+
+class TestLocalConnectionHolder(unittest.TestCase):
+    """
+    Fixture class for testing the LocalConnectionHolder class.
+    """
+    def test_run_command_returns_the_stdout_lines(self):
+        """
+        Happy case test for running a local command.
+        """
+        # setup
+        sut = create_connection(get_local_host_info())
+
+        # execute
+        output = sut.run_command('echo first; echo error >&2; echo second')
+
+        # verify
+        self.assertIsInstance(sut, LocalConnectionHolder)
+        self.assertEqual(output, ['first', 'second'])
+
+
+    def test_iter_command_yields_both_streams(self):
+        """
+        The lines of stdout and stderr are passed on with the stream they belong to.
+        """
+        # setup
+        sut = LocalConnectionHolder(get_local_host_info())
+
+        # execute
+        lines = list(sut.iter_command('echo out; echo err >&2', ignore_return_code=True))
+
+        # verify
+        self.assertIn(OutputLine(STDOUT, 'out'), lines)
+        self.assertIn(OutputLine(STDERR, 'err'), lines)
+
+
+    def test_run_command_raises_for_failing_commands(self):
+        """
+        A return code that is not zero is an error unless it is ignored.
+        """
+        # setup
+        sut = LocalConnectionHolder(get_local_host_info())
+
+        # execute
+        with self.assertRaises(CommandError) as context:
+            sut.run_command('exit 3')
+        sut.run_command('exit 3', ignore_return_code=True)
+
+        # verify
+        self.assertEqual(context.exception.return_code, 3)
+
+
+    def test_stdin_is_passed_to_the_command(self):
+        """
+        The stdin data can be given as bytes or as an iterable of chunks.
+        """
+        # setup
+        sut = LocalConnectionHolder(get_local_host_info())
+
+        # execute
+        bytes_output = sut.run_command('cat', stdin=b'first\nsecond\n')
+        chunks_output = sut.run_command('wc -c', stdin=(b'x' * 1000 for _ in range(100)))
+
+        # verify
+        self.assertEqual(bytes_output, ['first', 'second'])
+        self.assertEqual(chunks_output[0].strip(), '100000')
+
+
+    def test_raw_output_is_passed_on_undecoded(self):
+        """
+        Binary output can be read as chunks of bytes.
+        """
+        # setup
+        sut = LocalConnectionHolder(get_local_host_info())
+
+        # execute
+        chunks = list(sut.iter_command("printf 'a\\000b\\r\\n'; echo err >&2", raw_output=True))
+
+        # verify
+        stdout_data = b''.join(chunk.data for chunk in chunks if chunk.stream == STDOUT)
+        stderr_data = b''.join(chunk.data for chunk in chunks if chunk.stream == STDERR)
+        self.assertEqual(stdout_data, b'a\x00b\r\n')
+        self.assertEqual(stderr_data, b'err\n')
+
+
+    def test_old_output_lines_are_spilled_to_a_file(self):
+        """
+        Only the last max_output_lines lines are returned when the output is limited.
+        """
+        # setup
+        sut = LocalConnectionHolder(get_local_host_info())
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            spill_file = os.path.join(temp_dir, 'spill.log')
+
+            # execute
+            output = sut.run_command('seq 1 4; echo error >&2; echo 5', max_output_lines=2, spill_file=spill_file)
+            with open(spill_file) as file:
+                spilled_lines = file.read().splitlines()
+
+        # verify
+        self.assertEqual(output, ['5'])
+        self.assertEqual(spilled_lines, ['[stdout] 1', '[stdout] 2', '[stdout] 3', '[stdout] 4'])
+
+
+    def test_retried_command_replaces_the_spilled_lines(self):
+        """
+        The spill file only keeps the lines of the last run of a retried command
+        and the printed output marks where the repeated run starts.
+        """
+        # setup
+        sut = RetryOnceLocalConnection(get_local_host_info())
+        printed = io.StringIO()
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            spill_file = os.path.join(temp_dir, 'spill.log')
+            with open(spill_file, 'w') as file:
+                file.write('[stdout] earlier command\n')
+
+            # execute
+            with contextlib.redirect_stdout(printed):
+                output = sut.run_command('seq 1 3', print_output=True, max_output_lines=1, spill_file=spill_file, idempotent=True)
+            with open(spill_file) as file:
+                spilled_lines = file.read().splitlines()
+
+        # verify
+        self.assertEqual(output, ['3'])
+        self.assertEqual(spilled_lines, ['[stdout] earlier command', '[stdout] 1', '[stdout] 2'])
+        self.assertEqual(printed.getvalue().splitlines(), [
+            '[MyLocalHost] 1',
+            '[MyLocalHost] 2',
+            '[MyLocalHost] 3',
+            '[MyLocalHost] ----- The output above is from an interrupted run. Running "seq 1 3" again.',
+            '[MyLocalHost] 1',
+            '[MyLocalHost] 2',
+            '[MyLocalHost] 3',
+        ])
+
+
+    def test_output_tail_keeps_the_last_lines(self):
+        """
+        Without a spill file the older lines are only counted.
+        """
+        # setup
+        sut = CommandOutputTail(max_lines=3)
+
+        # execute
+        for number in range(10):
+            sut.append(OutputLine(STDOUT, str(number)))
+        sut.close()
+
+        # verify
+        self.assertEqual([line.text for line in sut.lines], ['7', '8', '9'])
+        self.assertEqual(sut.spilled_lines, 7)
+
+
+    def test_trace_name_hides_the_command_in_the_trace(self):
+        """
+        Commands with secrets can be recorded under another name.
+        """
+        # setup
+        sut = LocalConnectionHolder(get_local_host_info())
+
+        # execute
+        sut.run_command('echo secret-password', trace_name='update keys')
+
+        # verify
+        span_names = [span.name for span in tracing.get_tracer().spans]
+        self.assertIn('update keys', span_names)
+        self.assertFalse([name for name in span_names if 'secret-password' in name])
+
+
+    def test_file_client_works_on_the_local_file_system(self):
+        """
+        The file client offers the sftp operations that are used by the fileutil module.
+        """
+        # setup
+        sut = LocalConnectionHolder(get_local_host_info())
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            source_file = os.path.join(temp_dir, 'source.txt')
+            with open(source_file, 'w') as file:
+                file.write('bla')
+            sub_dir = os.path.join(temp_dir, 'sub')
+
+            # execute
+            sut.sftp_client.mkdir(sub_dir)
+            sut.sftp_client.put(source_file, os.path.join(sub_dir, 'target.txt'))
+            with sut.sftp_client.open(os.path.join(sub_dir, 'target.txt')) as file:
+                content = file.read()
+            attributes = sut.sftp_client.listdir_attr(temp_dir)
+
+            # verify
+            self.assertEqual(content, b'bla')
+            modes = {item.filename : item.st_mode for item in attributes}
+            self.assertTrue(stat.S_ISDIR(modes['sub']))
+            self.assertTrue(stat.S_ISREG(modes['source.txt']))
+            with self.assertRaises(IOError) as context:
+                sut.sftp_client.stat(os.path.join(temp_dir, 'missing'))
+            self.assertEqual(context.exception.errno, 2)
+
+
+class TestConnectionsHolder(unittest.TestCase):
+    """
+    Fixture class for testing the ConnectionsHolder class.
+    """
+    def test_run_on_hosts_reports_the_failures_of_all_hosts(self):
+        """
+        The hosts continue when another host fails and all failures are raised together.
+        """
+        # setup
+        host_infos = [get_local_host_info(machine_id) for machine_id in ['MyHost1', 'MyHost2', 'MyHost3']]
+        sut = ConnectionsHolder(host_infos, lazy=True)
+        skipped_operations = []
+
+        def raise_error(connection):
+            raise Exception('operation of {0} failed'.format(connection.info.machine_id))
+
+        # execute
+        with self.assertRaises(MultiHostError) as context:
+            sut.run_on_hosts([
+                ('MyHost1', 'exit 2'),
+                ('MyHost1', lambda connection: skipped_operations.append(connection)),
+                ('MyHost2', 'echo bla'),
+                ('MyHost2', raise_error),
+                ('MyHost3', 'echo blub'),
+                ('MyHost3', lambda connection: connection.info.machine_id),
+            ], operation_name='Testing')
+        sut.remove_all()
+
+        # verify
+        errors = context.exception.errors
+        self.assertEqual(sorted(errors.keys()), ['MyHost1', 'MyHost2'])
+        self.assertIsInstance(errors['MyHost1'], CommandError)
+        self.assertEqual(str(errors['MyHost2']), 'operation of MyHost2 failed')
+        self.assertEqual(context.exception.results, {'MyHost3' : [['blub'], 'MyHost3']})
+        self.assertEqual(skipped_operations, [])
+        self.assertTrue(str(context.exception).startswith('Testing failed on 2 host(s):'))
+
+
+class FakeRetryingConnection:
+    """
+    Records the operations for which the _RetryingSFTPClient uses the retry function.
+    """
+    def __init__(self):
+        self.info = get_local_host_info()
+        self.retried_operations = []
+        self._file_client = LocalFileClient()
+
+    def _get_sftp_client(self):
+        return self._file_client
+
+    def _run_with_retries(self, function, description, on_retry=None):
+        self.retried_operations.append(description)
+        return function()
+
+
+class TestRetryingSFTPClient(unittest.TestCase):
+    """
+    Fixture class for testing the _RetryingSFTPClient class.
+    """
+    def test_only_idempotent_operations_are_retried(self):
+        """
+        Operations that change the file system in a way that can not be repeated are called only once.
+        """
+        # setup
+        connection = FakeRetryingConnection()
+        sut = connections._RetryingSFTPClient(connection)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            sub_dir = os.path.join(temp_dir, 'sub')
+
+            # execute
+            sut.mkdir(sub_dir)
+            sut.stat(sub_dir)
+            sut.rename(sub_dir, sub_dir + '2')
+            sut.listdir(temp_dir)
+            sut.rmdir(sub_dir + '2')
+
+        # verify
+        self.assertEqual(connection.retried_operations, [
+            'running the sftp operation stat',
+            'running the sftp operation listdir',
+        ])
+
+
+class FakeShellChannel:
+    """
+    A channel that returns the given stdout and stderr output in chunks of chunk_size bytes
+    after a command was sent to it. The output can contain the placeholder {marker} for the end
+    marker of the shell session.
+    """
+    def __init__(self, stdout, stderr, chunk_size):
+        self.closed = False
+        self.eof_received = False
+        self.executed_commands = []
+        self._output = {STDOUT : stdout, STDERR : stderr}
+        self._chunk_size = chunk_size
+        self._chunks = {STDOUT : [], STDERR : []}
+
+    def exec_command(self, command):
+        self.executed_commands.append(command)
+
+    def exit_status_ready(self):
+        return False
+
+    def sendall(self, data):
+        marker = re.search('__CPFMACHINES_COMMAND_END_[0-9a-f]+__', data.decode('utf-8')).group(0)
+        for stream, output in self._output.items():
+            data = output.format(marker=marker).encode('utf-8')
+            self._chunks[stream] = [data[i:i + self._chunk_size] for i in range(0, len(data), self._chunk_size)]
+
+    def recv_ready(self):
+        return bool(self._chunks[STDOUT])
+
+    def recv(self, size):
+        return self._chunks[STDOUT].pop(0)
+
+    def recv_stderr_ready(self):
+        return bool(self._chunks[STDERR])
+
+    def recv_stderr(self, size):
+        return self._chunks[STDERR].pop(0)
+
+    def close(self):
+        self.closed = True
+
+
+class LocalProcessChannel:
+    """
+    Offers the parts of the paramiko channel interface that are used by the ShellSession class
+    for a local process, so the scripts of the session are tested with a real shell.
+    The commands get bash as login shell.
+    """
+    def __init__(self):
+        self.closed = False
+        self.eof_received = False
+        self._process = None
+
+    def exec_command(self, command):
+        environment = dict(os.environ, SHELL=shutil.which('bash'))
+        self._process = subprocess.Popen(command, shell=True, env=environment, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def get_transport(self):
+        return self
+
+    def open_session(self):
+        return LocalProcessChannel()
+
+    def exit_status_ready(self):
+        return self._process.poll() is not None
+
+    def recv_exit_status(self):
+        return self._process.wait()
+
+    def sendall(self, data):
+        self._process.stdin.write(data)
+        self._process.stdin.flush()
+
+    def recv_ready(self):
+        return bool(select.select([self._process.stdout], [], [], 0)[0])
+
+    def recv(self, size):
+        return os.read(self._process.stdout.fileno(), size)
+
+    def recv_stderr_ready(self):
+        return bool(select.select([self._process.stderr], [], [], 0)[0])
+
+    def recv_stderr(self, size):
+        return os.read(self._process.stderr.fileno(), size)
+
+    def fileno(self):
+        return self._process.stdout.fileno()
+
+    def close(self):
+        self.closed = True
+        self._process.kill()
+        self._process.wait()
+        for pipe in (self._process.stdin, self._process.stdout, self._process.stderr):
+            pipe.close()
+
+
+def run_session_command(session, command):
+    """
+    Returns the output lines and the return code of a command of the shell session.
+    """
+    lines = []
+    command_lines = session.iter_command(command)
+    while True:
+        try:
+            lines.append(next(command_lines))
+        except StopIteration as stop:
+            return lines, stop.value
+
+
+class TestShellSession(unittest.TestCase):
+    """
+    Fixture class for testing the ShellSession class.
+    """
+    def test_markers_that_are_split_between_reads_end_the_command(self):
+        """
+        The output and the return code are found even if the marker line arrives in pieces.
+        """
+        # setup
+        channel = FakeShellChannel('first\nsecond\n\n{marker} 3\n', 'error\n\n{marker}\n', chunk_size=7)
+        sut = ShellSession(channel)
+
+        # execute
+        lines = []
+        command = sut.iter_command('echo first; echo second; echo error >&2; exit 3')
+        while True:
+            try:
+                lines.append(next(command))
+            except StopIteration as stop:
+                retcode = stop.value
+                break
+
+        # verify
+        self.assertEqual(channel.executed_commands, ['sh'])
+        self.assertEqual([line.text for line in lines if line.stream == STDOUT], ['first', 'second'])
+        self.assertEqual([line.text for line in lines if line.stream == STDERR], ['error'])
+        self.assertEqual(retcode, 3)
+        self.assertTrue(sut.is_alive())
+
+
+    def test_commands_use_the_shell_of_the_user(self):
+        """
+        The commands are run like the commands of an exec channel.
+        """
+        # setup
+        sut = ShellSession(LocalProcessChannel())
+
+        # execute
+        shell_lines, shell_retcode = run_session_command(sut, '[[ -n "$BASH_VERSION" ]] && echo bash')
+        stdin_lines, _ = run_session_command(sut, 'cat; echo done')
+        error_lines, error_retcode = run_session_command(sut, "echo 'quoted text'; exit 4")
+        sut.close()
+
+        # verify
+        self.assertEqual(shell_lines, [OutputLine(STDOUT, 'bash')])
+        self.assertEqual(shell_retcode, 0)
+        self.assertEqual(stdin_lines, [OutputLine(STDOUT, 'done')])
+        self.assertEqual(error_lines, [OutputLine(STDOUT, 'quoted text')])
+        self.assertEqual(error_retcode, 4)
+
+
+    def test_closing_a_command_early_keeps_the_session(self):
+        """
+        A command whose output is not read to its end is stopped and the session can run the next command.
+        """
+        # setup
+        sut = ShellSession(LocalProcessChannel())
+        command_lines = sut.iter_command('echo first; sleep 30; echo never')
+
+        # execute
+        first_line = next(command_lines)
+        start_time = time.monotonic()
+        command_lines.close()
+        stop_duration = time.monotonic() - start_time
+        lines, retcode = run_session_command(sut, 'echo second')
+        is_alive = sut.is_alive()
+        sut.close()
+
+        # verify
+        self.assertEqual(first_line, OutputLine(STDOUT, 'first'))
+        self.assertLess(stop_duration, ShellSession._STOP_TIMEOUT)
+        self.assertTrue(is_alive)
+        self.assertEqual(lines, [OutputLine(STDOUT, 'second')])
+        self.assertEqual(retcode, 0)
+
+
+    def test_output_without_a_trailing_newline_is_kept(self):
+        """
+        The last line of a command whose output does not end with a newline is passed on.
+        """
+        # setup
+        channel = FakeShellChannel('no newline\n{marker} 0\n', '\n{marker}\n', chunk_size=1000)
+        sut = ShellSession(channel)
+
+        # execute
+        lines = list(sut.iter_command('printf "no newline"'))
+
+        # verify
+        self.assertEqual(lines, [OutputLine(STDOUT, 'no newline')])
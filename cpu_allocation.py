@@ -0,0 +1,90 @@
+"""
+Contains functions that split the cpus of a host between the containers that run on it.
+"""
+
+import collections
+
+
+# The command that prints the cpus of a linux host with their cores and NUMA nodes.
+LSCPU_COMMAND = 'lscpu --parse=CPU,CORE,NODE'
+
+
+class CpuSet:
+    """
+    Data class for the cpus that are assigned to one container.
+    """
+    def __init__(self, cpus, nodes):
+        self.cpus = cpus        # The ids of the logical cpus.
+        self.nodes = nodes      # The ids of the NUMA nodes to which the cpus belong.
+
+    def get_cpus_string(self):
+        """
+        Returns the cpus in the format of the docker --cpuset-cpus option.
+        """
+        return format_id_list(self.cpus)
+
+    def get_nodes_string(self):
+        """
+        Returns the NUMA nodes in the format of the docker --cpuset-mems option.
+        """
+        return format_id_list(self.nodes)
+
+
+def parse_lscpu_output(lines):
+    """
+    Returns a list of (cpu, core, node) tuples from the output lines of the LSCPU_COMMAND.
+    Hosts without NUMA information get node 0 for all cpus.
+    """
+    cpus = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split(',')
+        cpu = int(fields[0])
+        core = int(fields[1]) if len(fields) > 1 and fields[1] else cpu
+        node = int(fields[2]) if len(fields) > 2 and fields[2] else 0
+        cpus.append((cpu, core, node))
+    return cpus
+
+
+def split_cpus(cpus, container_count):
+    """
+    Splits the cpus from parse_lscpu_output() evenly between the given number of containers
+    and returns a CpuSet for each container.
+
+    The cpus are ordered by NUMA node and core before they are split into consecutive ranges,
+    so the hyper-threads of a core stay in the same container and each container gets cpus of
+    as few NUMA nodes as possible. If the cpus can not be divided evenly, the first containers
+    get one cpu more than the others.
+    """
+    if container_count < 1:
+        return []
+    if container_count > len(cpus):
+        raise Exception('The {0} cpus of the host can not be split between {1} containers.'.format(len(cpus), container_count))
+
+    ordered_cpus = sorted(cpus, key=lambda cpu: (cpu[2], cpu[1], cpu[0]))
+    cpus_per_container, remainder = divmod(len(ordered_cpus), container_count)
+
+    cpu_sets = []
+    start = 0
+    for index in range(container_count):
+        end = start + cpus_per_container + (1 if index < remainder else 0)
+        assigned_cpus = ordered_cpus[start:end]
+        nodes = collections.OrderedDict.fromkeys(cpu[2] for cpu in assigned_cpus)
+        cpu_sets.append(CpuSet(sorted(cpu[0] for cpu in assigned_cpus), list(nodes)))
+        start = end
+    return cpu_sets
+
+
+def format_id_list(ids):
+    """
+    Returns a list of ids in the range format of the linux cpusets, e.g. "0-3,8,10-11".
+    """
+    ranges = []
+    for value in sorted(set(ids)):
+        if ranges and ranges[-1][1] == value - 1:
+            ranges[-1][1] = value
+        else:
+            ranges.append([value, value])
+    return ','.join(str(first) if first == last else '{0}-{1}'.format(first, last) for first, last in ranges)
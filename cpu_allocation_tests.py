@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+This module contains automated tests for the cpu_allocation module.
+"""
+
+import unittest
+
+from cpu_allocation import *
+
+
+def get_two_node_lscpu_output():
+    """
+    The output of a host with two NUMA nodes, each with two cores that have two hyper-threads.
+    The siblings of the hyper-threads have the ids of the first threads plus four.
+    """
+    return [
+        '# The following is the parsable format, which can be fed to other',
+        '# programs. Each different item in every column has an unique ID',
+        '# starting from zero.',
+        '# CPU,Core,Node',
+        '0,0,0',
+        '1,1,0',
+        '2,2,1',
+        '3,3,1',
+        '4,0,0',
+        '5,1,0',
+        '6,2,1',
+        '7,3,1',
+    ]
+
+
+class TestCpuAllocation(unittest.TestCase):
+    """
+    Fixture class for testing the functions of the cpu_allocation module.
+    """
+    def test_each_container_gets_the_cpus_of_one_node(self):
+        """
+        Happy case test for splitting a NUMA host between two containers.
+        """
+        # setup
+        cpus = parse_lscpu_output(get_two_node_lscpu_output())
+
+        # execute
+        cpu_sets = split_cpus(cpus, 2)
+
+        # verify
+        self.assertEqual([cpu_set.get_cpus_string() for cpu_set in cpu_sets], ['0-1,4-5', '2-3,6-7'])
+        self.assertEqual([cpu_set.get_nodes_string() for cpu_set in cpu_sets], ['0', '1'])
+
+
+    def test_hyper_threads_of_a_core_stay_together(self):
+        """
+        The siblings of a core are assigned to the same container.
+        """
+        # setup
+        cpus = parse_lscpu_output(get_two_node_lscpu_output())
+
+        # execute
+        cpu_sets = split_cpus(cpus, 4)
+
+        # verify
+        self.assertEqual([cpu_set.cpus for cpu_set in cpu_sets], [[0, 4], [1, 5], [2, 6], [3, 7]])
+
+
+    def test_uneven_splits_give_the_first_containers_more_cpus(self):
+        """
+        Containers that do not fit into one node get the cpus of multiple nodes.
+        """
+        # setup
+        cpus = parse_lscpu_output(get_two_node_lscpu_output())
+
+        # execute
+        cpu_sets = split_cpus(cpus, 3)
+
+        # verify
+        self.assertEqual([len(cpu_set.cpus) for cpu_set in cpu_sets], [3, 3, 2])
+        self.assertEqual(cpu_sets[1].nodes, [0, 1])
+        self.assertRaises(Exception, split_cpus, cpus, 9)
+
+
+    def test_hosts_without_numa_information_use_node_zero(self):
+        """
+        lscpu prints an empty node column on hosts without NUMA support.
+        """
+        # execute
+        cpus = parse_lscpu_output(['# CPU,Core,Node', '0,0,', '1,1,'])
+
+        # verify
+        self.assertEqual(cpus, [(0, 0, 0), (1, 1, 0)])
+        self.assertEqual(format_id_list([5, 0, 1, 2, 7, 8]), '0-2,5,7-8')
@@ -38,8 +38,10 @@ def main(config_file):
     config_dict = config_data.read_json_file(config_file)
     config = hook_config.HookConfigData(config_dict)
 
+    # Connections are only opened to the machines that hold hooked repositories.
     print('----- Establish ssh connections to repository machines')
-    connections = ConnectionsHolder(config.repository_host_infos)
+    connections = ConnectionsHolder(config.repository_host_infos, lazy=True)
+    connections.connect([hook.machine_id for hook in config.hook_configs])
 
     script_template = _SCRIPT_DIR.joinpath('post-receive.in')
 
@@ -3,81 +3,582 @@ Contains functions for basic remote container operations.
 """
 
 import os
+import io
+import shlex
+import tarfile
 import socket
 import pprint
-
-from connections import ConnectionHolder
+import tempfile
+import json
+import weakref
+import threading
+import contextlib
+import copy
+import functools
+import collections
+import concurrent.futures
+import uuid
+from pathlib import PurePath, PurePosixPath
+
+from connections import ConnectionHolder, CommandError, STDERR
 import fileutil
+import build_context
+
+# The progress of image transfers is printed each time this number of bytes was transferred.
+_IMAGE_TRANSFER_PROGRESS_INTERVAL = 100 * 1024 * 1024
+# The image of the container that runs the private docker registry.
+_REGISTRY_IMAGE = 'registry:2'
+# The number of lines of the docker build output that are kept in memory.
+# Older lines are written to a log file in the local temp directory.
+_MAX_BUILD_OUTPUT_LINES = 1000
+# The id that _get_image_ids_and_context_hash() returns for images that do not exist on the host.
+_MISSING_IMAGE_ID = '<missing>'
 
 def container_exists(connection, container):
     """
     Returns true if the container exists on the host.
     """
-    all_container = get_all_docker_container(connection)
-    return container in all_container
+    return get_docker_host_state(connection).has_container(container)
 
 
 def get_all_docker_container(connection):
-    return connection.run_command("docker ps -a --format '{{.Names}}'")
+    return get_docker_host_state(connection).get_container()
 
 
 def container_is_running(connection, container):
     """
     Returns true if the container is running on its host.
     """
-    running_container = get_running_docker_container(connection)
-    return container in running_container
+    return get_docker_host_state(connection).is_running(container)
 
 
 def get_running_docker_container(connection):
-    return connection.run_command("docker ps --format '{{.Names}}'")
+    return get_docker_host_state(connection).get_container(running_only=True)
 
 
 def stop_docker_container(connection, container):
-    connection.run_command('docker stop ' + container)
+    with changing_docker_host_state(connection):
+        connection.run_command('docker stop ' + container, idempotent=True)
 
 
 def start_docker_container(connection, container):
-    connection.run_command('docker start ' + container)
+    with changing_docker_host_state(connection):
+        connection.run_command('docker start ' + container, idempotent=True)
 
 
 def remove_container(connection, container):
     """
     This removes a given docker container and will fail if the container is running.
     """
-    connection.run_command('docker rm -f ' + container)
+    with changing_docker_host_state(connection):
+        connection.run_command('docker rm -f ' + container)
+
+
+def remove_containers(connection, containers, stop_timeout=None):
+    """
+    Removes the given containers of the host with one docker command. Containers that do not exist are ignored.
+    If a stop_timeout is given, the running containers are first stopped together and get that
+    number of seconds to shut down. Otherwise they are killed right away.
+    """
+    state = get_docker_host_state(connection)
+    existing_containers = [container for container in containers if state.has_container(container)]
+    if not existing_containers:
+        return
+
+    with changing_docker_host_state(connection):
+        running_containers = [container for container in existing_containers if state.is_running(container)]
+        if stop_timeout is not None and running_containers:
+            connection.run_command('docker stop -t {0} {1}'.format(stop_timeout, ' '.join(running_containers)), idempotent=True)
+        try:
+            connection.run_command('docker rm -f ' + ' '.join(existing_containers), idempotent=True)
+        except CommandError:
+            # When the command was retried after a lost connection, the first run may have removed
+            # some of the containers and the second run fails for them.
+            invalidate_docker_host_state(connection)
+            state = get_docker_host_state(connection)
+            if any(state.has_container(container) for container in existing_containers):
+                raise
 
 
 def docker_container_image_exists(connection, image_name):
-    image_lines = connection.run_command('docker images')
-    for line in image_lines:
-        if image_name in line:
-            return True
-    return False
+    """
+    Returns true if an image with the exact name exists on the host.
+    Names without a tag refer to the latest tag.
+    """
+    return get_docker_host_state(connection).has_image(image_name)
 
 
-def build_docker_image(connection, image_name, context_source_dir, docker_file, build_args, text_files, binary_files=[]):
-    
-    context_target_dir = connection.info.temp_dir.joinpath(image_name)
-    fileutil.copy_local_files_to_host(connection, context_source_dir, context_target_dir, text_files, binary_files)
-    
+class DockerHostState:
+    """
+    A snapshot of the container and images on a docker host.
+    The snapshot is filled by one round trip to the host and answers the queries
+    without running further commands.
+    """
+
+    # Separates the container list from the image list in the output of the query command.
+    _SEPARATOR = '----- docker images -----'
+    QUERY_COMMAND = (
+        "docker ps -a --format '{{json .}}' && echo '" + _SEPARATOR + "' && docker images --format '{{json .}}'"
+    )
+
+    def __init__(self, query_output):
+        """
+        query_output is the list of output lines of the QUERY_COMMAND.
+        """
+        self._container_states = {}     # The state of each container by name, e.g. 'running' or 'exited'.
+        self._images = set()            # The repository:tag names of the images.
+
+        separator_index = query_output.index(self._SEPARATOR)
+        for line in query_output[:separator_index]:
+            container = json.loads(line)
+            for name in container['Names'].split(','):
+                self._container_states[name] = container.get('State', '')
+
+        for line in query_output[separator_index + 1:]:
+            image = json.loads(line)
+            if image['Repository'] != '<none>' and image['Tag'] != '<none>':
+                self._images.add(image['Repository'] + ':' + image['Tag'])
+
+    def has_container(self, container):
+        return container in self._container_states
+
+    def is_running(self, container):
+        return self._container_states.get(container) == 'running'
+
+    def get_container(self, running_only=False):
+        return [name for name, state in self._container_states.items() if state == 'running' or not running_only]
+
+    def has_image(self, image_name):
+        return _add_default_tag(image_name) in self._images
+
+
+def _add_default_tag(image_name):
+    """
+    Adds the latest tag to image names that have no tag.
+    The colon of a registry port is not a tag separator.
+    """
+    if ':' in image_name.rsplit('/', 1)[-1]:
+        return image_name
+    return image_name + ':latest'
+
+
+# The snapshots of the hosts for which no state changing command was run since they were taken.
+_HOST_STATES = weakref.WeakKeyDictionary()
+# Counts the invalidations of each host, so a query that overlaps with an invalidation is not stored.
+_HOST_STATE_GENERATIONS = weakref.WeakKeyDictionary()
+_HOST_STATES_LOCK = threading.Lock()
+
+
+def get_docker_host_state(connection):
+    """
+    Returns the DockerHostState of the host and queries it if there is no valid snapshot.
+    The result of the query is only kept as snapshot if the state was not invalidated while the query ran.
+    """
+    with _HOST_STATES_LOCK:
+        state = _HOST_STATES.get(connection)
+        generation = _HOST_STATE_GENERATIONS.get(connection, 0)
+    if state is None:
+        state = DockerHostState(connection.run_command(DockerHostState.QUERY_COMMAND, idempotent=True))
+        with _HOST_STATES_LOCK:
+            if _HOST_STATE_GENERATIONS.get(connection, 0) == generation:
+                _HOST_STATES[connection] = state
+    return state
+
+
+def invalidate_docker_host_state(connection):
+    """
+    Discards the snapshot of the host, so the next query runs the query command again.
+    """
+    with _HOST_STATES_LOCK:
+        _HOST_STATES.pop(connection, None)
+        _HOST_STATE_GENERATIONS[connection] = _HOST_STATE_GENERATIONS.get(connection, 0) + 1
+
+
+@contextlib.contextmanager
+def changing_docker_host_state(connection):
+    """
+    Commands that add, remove, start or stop container or images must be run in this context.
+    The snapshot of the host is discarded before and after the command, so queries that
+    are made while the command runs do not keep an outdated state.
+    """
+    invalidate_docker_host_state(connection)
+    try:
+        yield
+    finally:
+        invalidate_docker_host_state(connection)
+
+
+def build_docker_image(connection, image_name, context_source_dir, docker_file, build_args, text_files, binary_files=[], cache_image=''):
+    """
+    Builds the image on the host unless an image with the same name was already built
+    from the same dockerfile, build arguments, context files and base images.
+    The hash of these inputs is stored in the CONTEXT_HASH_LABEL label of the image.
+
+    The context files are packed into a tar archive on the local machine that is
+    piped to the standard input of docker build.
+
+    The image is built with BuildKit, so the dockerfiles can use cache mounts.
+    If a cache_image is given, its layers are used as build cache. This is the image in the
+    registry, which gets the cache metadata inlined, so other hosts can reuse its layers.
+    """
+    with open(str(PurePath(context_source_dir).joinpath(docker_file))) as file:
+        base_images = build_context.get_base_images(file.read(), build_args)
+    base_image_ids, current_hash = _get_image_ids_and_context_hash(connection, base_images, image_name)
+    missing_base_images = [image for image, image_id in zip(base_images, base_image_ids) if image_id == _MISSING_IMAGE_ID]
+    if missing_base_images:
+        # The base images are pulled before hashing. Otherwise docker build would pull them and
+        # the next setup run would get other ids for them and build the image again.
+        _pull_images(connection, missing_base_images)
+        base_image_ids, current_hash = _get_image_ids_and_context_hash(connection, base_images, image_name)
+    context_hash = build_context.compute_context_hash(context_source_dir, docker_file, build_args, text_files, binary_files, base_image_ids)
+    if context_hash == current_hash:
+        print('[{0}] The image {1} is up to date.'.format(connection.info.machine_id, image_name))
+        return
+
     build_args_string = ''
     for arg in build_args:
         build_args_string += ' --build-arg ' + arg
 
+    if cache_image:
+        # The inline cache is not part of the context hash, because it does not change the content of the image.
+        build_args_string += ' --cache-from ' + cache_image + ' --build-arg BUILDKIT_INLINE_CACHE=1'
+
+    command = (
+        'DOCKER_BUILDKIT=1 docker build' + build_args_string + ' -t ' + image_name +
+        ' --label ' + build_context.CONTEXT_HASH_LABEL + '=' + context_hash
+    )
+    # The dockerfile path is relative to the root of the archive.
+    command += ' -f ' + PurePath(docker_file).as_posix() + ' -'
+    stdin = build_context.create_context_tar(context_source_dir, text_files, binary_files)
+
+    build_log_file = os.path.join(tempfile.gettempdir(), 'cpfmachines-build-{0}-{1}.log'.format(connection.info.machine_id, image_name))
+    if os.path.isfile(build_log_file):
+        os.remove(build_log_file)
+    with changing_docker_host_state(connection):
+        connection.run_command(command, print_output=True, print_command=True, max_output_lines=_MAX_BUILD_OUTPUT_LINES, spill_file=build_log_file, idempotent=True, stdin=stdin)
+
+
+class ImageBuild:
+    """
+    Data class that holds the arguments of the build_docker_image() call for one image on one host.
+    """
+    def __init__(self, machine_id, image_name, context_source_dir, docker_file, build_args, text_files, binary_files=[]):
+        self.machine_id = machine_id                    # The host on which the image is built.
+        self.image_name = image_name
+        self.context_source_dir = context_source_dir    # The local directory that contains the context files.
+        self.docker_file = docker_file
+        self.build_args = list(build_args)
+        self.text_files = list(text_files)
+        self.binary_files = list(binary_files)
+
+    def get_inputs(self):
+        return (str(self.context_source_dir), str(self.docker_file), self.build_args, self.text_files, self.binary_files)
+
+
+def plan_image_builds(image_builds):
+    """
+    Returns one build for each pair of host and image in the order in which the pairs first appear.
+    Containers that share a host and an image need the image only once.
+    Raises an exception if two builds of the same image on the same host have different inputs.
+    """
+    planned_builds = collections.OrderedDict()
+    for image_build in image_builds:
+        key = (image_build.machine_id, image_build.image_name)
+        if key not in planned_builds:
+            planned_builds[key] = image_build
+        elif planned_builds[key].get_inputs() != image_build.get_inputs():
+            raise Exception('The image {0} is built with different inputs on host {1}.'.format(image_build.image_name, image_build.machine_id))
+    return list(planned_builds.values())
+
+
+def build_images(connections, image_builds, operation_name='Building the images', builder_machine_id='', registry_address=''):
+    """
+    Builds the planned images. The images of one host are built one after another
+    and different hosts build at the same time.
+
+    If a builder_machine_id is given, each image is only built on the builder host
+    and then copied to the hosts that need it.
+
+    If a registry_address is given, each image is only built on the builder host or on the first
+    host that needs it. It is pushed to the registry and pulled from there by the other hosts.
+    The upstream base images of the builds are also cached in the registry.
+    """
+    planned_builds = plan_image_builds(image_builds)
+    if not builder_machine_id and not registry_address:
+        _run_image_builds(connections, planned_builds, operation_name)
+        return
+
+    image_hosts = collections.OrderedDict()
+    builder_builds = collections.OrderedDict()
+    for image_build in planned_builds:
+        image_hosts.setdefault(image_build.image_name, []).append(image_build.machine_id)
+        if image_build.image_name not in builder_builds:
+            builder_build = copy.copy(image_build)
+            if builder_machine_id:
+                builder_build.machine_id = builder_machine_id
+            builder_builds[image_build.image_name] = builder_build
+
+    if registry_address:
+        _pull_base_images_through_registry(connections, builder_builds.values(), registry_address)
+    _run_image_builds(connections, builder_builds.values(), operation_name, registry_address)
+
+    for image_name, machine_ids in image_hosts.items():
+        source_machine_id = builder_builds[image_name].machine_id
+        if registry_address:
+            distribute_image_with_registry(connections, image_name, source_machine_id, machine_ids, registry_address)
+        else:
+            distribute_image(connections, image_name, source_machine_id, machine_ids)
+
+
+def _run_image_builds(connections, image_builds, operation_name, registry_address=''):
+    host_operations = [(image_build.machine_id, functools.partial(_run_image_build, image_build, registry_address)) for image_build in image_builds]
+    connections.run_on_hosts(host_operations, operation_name=operation_name)
+
+
+def _run_image_build(image_build, registry_address, connection):
+    cache_image = get_registry_image_name(registry_address, image_build.image_name) if registry_address else ''
+    build_docker_image(
+        connection,
+        image_build.image_name,
+        image_build.context_source_dir,
+        image_build.docker_file,
+        image_build.build_args,
+        image_build.text_files,
+        image_build.binary_files,
+        cache_image=cache_image
+    )
+
+
+def get_image_id_and_size(connection, image_name):
+    """
+    Returns the id and the size in bytes of an image on the host.
+    The id is empty if the image does not exist.
+    """
+    output = connection.run_command("docker image inspect --format '{{{{.Id}}}} {{{{.Size}}}}' {0} 2>/dev/null || true".format(image_name), idempotent=True)
+    if not output:
+        return '', 0
+    image_id, size = output[0].split()
+    return image_id, int(size)
+
+
+def distribute_image(connections, image_name, source_machine_id, target_machine_ids):
+    """
+    Copies an image from the source host to the target hosts. The output of docker save on the
+    source host is streamed through the local machine into docker load on each target host,
+    so the image is never written to a file. The transfers to the targets run at the same time.
+    Target hosts that already have an image with the same id are skipped.
+    """
+    source_connection = connections.get_connection(source_machine_id)
+    image_id, image_size = get_image_id_and_size(source_connection, image_name)
+    if not image_id:
+        raise Exception('The image {0} can not be distributed, because it does not exist on host {1}.'.format(image_name, source_machine_id))
+
+    host_operations = []
+    for machine_id in target_machine_ids:
+        if machine_id != source_machine_id:
+            host_operations.append((machine_id, functools.partial(_load_image_from_host, source_connection, image_name, image_id, image_size)))
+    connections.run_on_hosts(host_operations, operation_name='Distributing the image ' + image_name)
+
+
+def start_registry(connection, registry_config):
+    """
+    Starts the registry container on its host. The container is created if it does not exist.
+    The registry is not removed by the setup, so its images are kept between setup runs.
+    """
+    container = registry_config.CONTAINER_NAME
+    if container_is_running(connection, container):
+        return
+    if container_exists(connection, container):
+        start_docker_container(connection, container)
+        return
+
+    command = (
+        'docker run --detach --name {0} --restart unless-stopped '
+        '--publish {1}:5000 --volume {2}:/var/lib/registry {3}'
+    ).format(container, registry_config.port, registry_config.storage_dir, _REGISTRY_IMAGE)
+    with changing_docker_host_state(connection):
+        connection.run_command('mkdir -p ' + str(registry_config.storage_dir))
+        connection.run_command(command, print_command=True)
+
+
+def get_registry_image_name(registry_address, image_name):
+    return registry_address + '/' + _add_default_tag(image_name)
+
+
+def push_image_to_registry(connection, image_name, registry_address):
+    """
+    Pushes an image of the host to the registry. Layers that are already in the registry are not uploaded again.
+    """
+    registry_image = get_registry_image_name(registry_address, image_name)
+    command = 'docker tag {0} {1} && docker push {1}'.format(image_name, registry_image)
+    with changing_docker_host_state(connection):
+        connection.run_command(command, print_command=True, idempotent=True)
+
+
+def pull_image_from_registry(connection, image_name, registry_address):
+    """
+    Pulls an image from the registry and gives it its name without the registry address.
+    Only the layers that are missing on the host are downloaded.
+    """
+    registry_image = get_registry_image_name(registry_address, image_name)
+    command = 'docker pull {0} && docker tag {0} {1}'.format(registry_image, image_name)
+    with changing_docker_host_state(connection):
+        connection.run_command(command, print_command=True, idempotent=True)
+
+
+def distribute_image_with_registry(connections, image_name, source_machine_id, target_machine_ids, registry_address):
+    """
+    Pushes the image from the source host to the registry and pulls it on the target hosts at the same time.
+    Target hosts that already have an image with the same id are skipped.
+    """
+    source_connection = connections.get_connection(source_machine_id)
+    image_id, _ = get_image_id_and_size(source_connection, image_name)
+    push_image_to_registry(source_connection, image_name, registry_address)
+
+    host_operations = []
+    for machine_id in target_machine_ids:
+        if machine_id != source_machine_id:
+            host_operations.append((machine_id, functools.partial(_pull_image_if_outdated, image_name, image_id, registry_address)))
+    connections.run_on_hosts(host_operations, operation_name='Pulling the image ' + image_name)
+
+
+def _pull_image_if_outdated(image_name, image_id, registry_address, connection):
+    current_id, _ = get_image_id_and_size(connection, image_name)
+    if current_id == image_id:
+        print('[{0}] The image {1} is up to date.'.format(connection.info.machine_id, image_name))
+        return
+    pull_image_from_registry(connection, image_name, registry_address)
+
+
+def _pull_base_images_through_registry(connections, image_builds, registry_address):
+    """
+    Makes sure the upstream base images of the builds exist on their build hosts.
+    Missing base images are pulled from the registry. If the registry does not have them
+    yet, they are pulled from their upstream registry and pushed to the registry.
+    """
+    built_images = set(image_build.image_name for image_build in image_builds)
+    host_base_images = []
+    for image_build in image_builds:
+        with open(str(PurePath(image_build.context_source_dir).joinpath(image_build.docker_file))) as file:
+            base_images = build_context.get_base_images(file.read(), image_build.build_args)
+        for base_image in base_images:
+            if base_image not in built_images and (image_build.machine_id, base_image) not in host_base_images:
+                host_base_images.append((image_build.machine_id, base_image))
+
+    host_operations = [(machine_id, functools.partial(_pull_base_image_through_registry, base_image, registry_address)) for machine_id, base_image in host_base_images]
+    connections.run_on_hosts(host_operations, operation_name='Pulling the base images')
+
+
+def _pull_base_image_through_registry(base_image, registry_address, connection):
+    registry_image = get_registry_image_name(registry_address, base_image)
     command = (
-        'docker build' + build_args_string + ' -t ' + image_name +
-        ' -f ' + str(context_target_dir.joinpath(docker_file)) + ' ' + str(context_target_dir)
+        'docker image inspect {0} > /dev/null 2>&1 || '
+        '{{ docker pull {1} && docker tag {1} {0}; }} || '
+        '{{ docker pull {0} && docker tag {0} {1} && docker push {1}; }}'
+    ).format(base_image, registry_image)
+    with changing_docker_host_state(connection):
+        connection.run_command(command, print_command=True, idempotent=True)
+
+
+def _load_image_from_host(source_connection, image_name, image_id, image_size, connection):
+    current_id, _ = get_image_id_and_size(connection, image_name)
+    if current_id == image_id:
+        print('[{0}] The image {1} is up to date.'.format(connection.info.machine_id, image_name))
+        return
+
+    image_data = _iter_saved_image(source_connection, image_name, image_size, connection.info.machine_id)
+    with changing_docker_host_state(connection):
+        connection.run_command('docker load', print_output=True, print_command=True, stdin=image_data)
+
+
+def _iter_saved_image(source_connection, image_name, image_size, target_machine_id):
+    """
+    Yields the bytes of the image archive from docker save on the source host and prints
+    the progress of the transfer. The size of the image is used to estimate the progress.
+    The source channel only receives more data when the chunks were sent on to the target,
+    so the number of bytes that are buffered on the local machine is bounded.
+    """
+    transferred_bytes = 0
+    next_progress = _IMAGE_TRANSFER_PROGRESS_INTERVAL
+    for data in _iter_command_data(source_connection, 'docker save ' + image_name):
+        yield data
+        transferred_bytes += len(data)
+        if transferred_bytes >= next_progress:
+            next_progress += _IMAGE_TRANSFER_PROGRESS_INTERVAL
+            print('[{0}] Received {1:.0f} of about {2:.0f} MiB of the image {3}.'.format(
+                target_machine_id, transferred_bytes / (1024 * 1024), image_size / (1024 * 1024), image_name))
+
+
+def _pull_images(connection, images):
+    command = ' && '.join('docker pull ' + image for image in images)
+    with changing_docker_host_state(connection):
+        connection.run_command(command, print_command=True, idempotent=True)
+
+
+def _get_image_ids_and_context_hash(connection, base_images, image_name):
+    """
+    Returns the ids of the base images and the value of the context hash label of the image
+    with one command. Images that do not exist on the host get the id _MISSING_IMAGE_ID and
+    an empty hash.
+    """
+    missing = "echo '{0}'".format(_MISSING_IMAGE_ID)
+    commands = ["docker image inspect --format '{{{{.Id}}}}' {0} 2>/dev/null || {1}".format(image, missing) for image in base_images]
+    commands.append(
+        "docker image inspect --format '{{{{index .Config.Labels \"{0}\"}}}}' {1} 2>/dev/null || {2}".format(build_context.CONTEXT_HASH_LABEL, image_name, missing)
     )
-    connection.run_command(command, print_output=True, print_command=True)
+    output = connection.run_command('; '.join(commands), idempotent=True)
+    current_hash = output[-1] if output[-1] != _MISSING_IMAGE_ID else ''
+    return output[:-1], current_hash
 
 
-def docker_run_detached(host_connection, container_config, resolved_hosts=[]):
+class HostNameResolver:
+    """
+    Resolves host names to ip addresses on the local machine and keeps the addresses,
+    so each name is only looked up once during a setup run.
+    The object can be used from multiple threads at the same time.
+    """
+    def __init__(self, resolve_function=socket.gethostbyname):
+        self._resolve_function = resolve_function
+        self._addresses = {}
+        self._lock = threading.Lock()
+
+
+    def resolve(self, host_names):
+        """
+        Returns a dictionary with the ip addresses of the host names in the order of the names.
+        The names that were not resolved before are looked up concurrently.
+        Raises an exception that lists all names that can not be resolved.
+        """
+        host_names = list(collections.OrderedDict.fromkeys(host_names))
+        with self._lock:
+            missing_names = [host_name for host_name in host_names if host_name not in self._addresses]
+
+        if missing_names:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(missing_names)) as executor:
+                futures = collections.OrderedDict((host_name, executor.submit(self._resolve_function, host_name)) for host_name in missing_names)
+            errors = []
+            for host_name, future in futures.items():
+                try:
+                    address = future.result()
+                except OSError as err:
+                    errors.append('{0}: {1}'.format(host_name, err))
+                    continue
+                with self._lock:
+                    self._addresses[host_name] = address
+            if errors:
+                raise Exception('The following host names could not be resolved:\n' + '\n'.join(errors))
+
+        with self._lock:
+            return collections.OrderedDict((host_name, self._addresses[host_name]) for host_name in host_names)
+
+
+def docker_run_detached(host_connection, container_config, resolved_hosts=[], resolver=None):
     """
     Executes the docker run command for a container on a given container host.
 
     resolved_hosts:     A list of hosts machine names that are accessed by the container.
                         This makes sure name resolution of these machines works within the container.
+    resolver:           The HostNameResolver that looks up the addresses of the resolved_hosts.
     """
     
     publish_port_args = ''
@@ -92,11 +593,18 @@ def docker_run_detached(host_connection, container_config, resolved_hosts=[]):
     for variable in container_config.envvar_definitions:
         env_args += '--env {0} '.format(variable)
 
+    if resolver is None:
+        resolver = HostNameResolver()
     add_host_args = ''
-    for host in resolved_hosts:
-        ip = socket.gethostbyname(host)
+    for host, ip in resolver.resolve(resolved_hosts).items():
         add_host_args += '--add-host {0}:{1} '.format(host,ip)
 
+    resource_args = ''
+    resources = container_config.resources
+    for option, value in [('--cpus', resources.cpus), ('--cpuset-cpus', resources.cpuset_cpus), ('--cpuset-mems', resources.cpuset_mems), ('--memory', resources.memory), ('--shm-size', resources.shm_size)]:
+        if value is not None:
+            resource_args += '{0} {1} '.format(option, value)
+
     command = (
         'docker run '
         '--detach '
@@ -106,18 +614,128 @@ def docker_run_detached(host_connection, container_config, resolved_hosts=[]):
         + volume_args
         + env_args
         + add_host_args
+        + resource_args
         + container_config.container_image_name
     )
-    host_connection.run_command(command, print_command=True)
+    with changing_docker_host_state(host_connection):
+        host_connection.run_command(command, print_command=True)
+
+def wait_until_healthy(connection, container, timeout):
+    """
+    Returns as soon as the HEALTHCHECK of the container reports that it is healthy.
+    The health events of the container are followed with docker events instead of polling.
+    The events are read from the time at which the current status was inspected, so a
+    change right after the inspection is not missed.
+    An unhealthy container is still waited for, because slow starts can take longer than
+    the start period and the retries of the health check.
+    Containers without a HEALTHCHECK only need to be running.
+    Raises an exception if the container exits or is not healthy after timeout seconds.
+    """
+    output = connection.run_command(
+        "date +%s && docker inspect --format '{{{{.State.Status}}}} {{{{if .State.Health}}}}{{{{.State.Health.Status}}}}{{{{end}}}}' {0}".format(container),
+        idempotent=True
+    )
+    host_time = int(output[0])
+    state, _, health = output[1].partition(' ')
+    if state != 'running':
+        raise Exception('The container {0} on host {1} is not running.'.format(container, connection.info.machine_id))
+    if health and health != 'healthy':
+        print('[{0}] Wait for the container {1} to become healthy.'.format(connection.info.machine_id, container))
+        _wait_for_healthy_event(connection, container, host_time, timeout)
+
 
-def run_commands_in_container(host_connection, container_config, commands, user=None):
+def _wait_for_healthy_event(connection, container, since, timeout):
+    """
+    Returns when the container reports that it is healthy.
+    Raises an exception when the container exits or does not get healthy within timeout seconds.
+    """
+    # The events command ends by itself at the until time.
+    command = "docker events --since {0} --until {1} --filter container={2} --filter event=health_status --filter event=die --format '{{{{.Status}}}}'".format(
+        since, since + timeout, container)
+    lines = connection.iter_command(command)
+    try:
+        for line in lines:
+            if line.stream == STDERR:
+                continue
+            # The status of the health events is "health_status: <status>".
+            status = line.text.rpartition(':')[2].strip()
+            if status == 'healthy':
+                return
+            if status == 'die':
+                raise Exception('The container {0} on host {1} exited while waiting for it to become healthy.'.format(container, connection.info.machine_id))
+    finally:
+        lines.close()
+    raise Exception('The container {0} on host {1} did not become healthy within {2} seconds.'.format(container, connection.info.machine_id, timeout))
+
+
+class ContainerCommandResult:
+    """
+    Data class for the result of one command of a batch that was run in a container.
+    """
+    def __init__(self, command, return_code, output):
+        self.command = command
+        self.return_code = return_code
+        self.output = output                # The lines of the standard and error output of the command.
+
+
+def run_commands_in_container(host_connection, container_config, commands, user=None, stop_on_error=True, print_command=True, print_output=False):
+    """
+    Runs the commands one after another with a single docker exec. The commands are sent as one
+    script to the standard input of a shell in the container. Each command runs in its own
+    sub-shell, so changes of the directory or the environment do not affect the next command.
+    The end of the output of each command is marked with a line that holds its return code.
+
+    Returns a list of ContainerCommandResult objects for the commands that were run.
+    If stop_on_error is set, the remaining commands are skipped when a command fails and
+    a CommandError is raised. Otherwise all commands are run and the return codes must be
+    checked by the caller.
+
+    The user option can be used to run the commands for a different user then
+    the containers default user.
+    """
+    if not commands:
+        return []
+    if not user:
+        user = container_config.container_user
+
+    marker = '__CPF_COMMAND_END_{0}__'.format(uuid.uuid4().hex)
+    script_lines = []
     for command in commands:
-        run_command_in_container(
-            host_connection,
-            container_config,
-            command,
-            user
-        )
+        # The commands must not read the script from the standard input of the shell.
+        script_lines.append('(\n{0}\n) </dev/null 2>&1'.format(command))
+        script_lines.append('code=$?')
+        script_lines.append("printf '%s %s\\n' {0} $code".format(marker))
+        if stop_on_error:
+            script_lines.append('[ $code -eq 0 ] || exit 0')
+    script = '\n'.join(script_lines) + '\n'
+
+    if print_command:
+        for command in commands:
+            print('[{0}] {1}: {2}'.format(host_connection.info.machine_id, container_config.container_name, command))
+    docker_command = 'docker exec -i --user {0}:{0} {1} sh -s'.format(user, container_config.container_name)
+    output = host_connection.run_command(docker_command, stdin=script.encode('utf-8'))
+
+    results = []
+    lines = []
+    for line in output:
+        index = line.find(marker)
+        if index < 0:
+            lines.append(line)
+            continue
+        # The marker is appended to the last line if the output does not end with a newline.
+        if index > 0:
+            lines.append(line[:index])
+        results.append(ContainerCommandResult(commands[len(results)], int(line[index + len(marker):]), lines))
+        lines = []
+
+    for result in results:
+        if print_output or (stop_on_error and result.return_code != 0):
+            for line in result.output:
+                print('[{0}] {1}'.format(host_connection.info.machine_id, line))
+
+    if stop_on_error and results and results[-1].return_code != 0:
+        raise CommandError(results[-1].command, host_connection.info.machine_id, results[-1].return_code)
+    return results
 
 
 def run_command_in_container(connection, container_config, command, user=None, print_command=True, print_output=False):
@@ -136,72 +754,154 @@ def run_command_in_container(connection, container_config, command, user=None, p
 
 def copy_textfile_to_container(connection, container_conf, source_path, target_path):
     """
-    We first copy the file to host_temp_dir and then to the container.
+    Copies a local text file to the target path in the container.
     """
-    host_file = connection.info.temp_dir.joinpath(source_path.name)
-    fileutil.copy_textfile_from_local_to_linux(connection, source_path, host_file)
-    copy_file_from_host_to_container(connection, container_conf, host_file, target_path)
+    copy_local_files_to_container(connection, container_conf, [(source_path, target_path)])
 
 
-def copy_file_from_host_to_container(host_connection, container_conf, source_file, target_file):
-    run_command_in_container(
-        host_connection,
-        container_conf,
-        'mkdir -p {0}'.format(target_file.parent),
-        print_command=False
-    )
-    host_connection.run_command("docker cp {0} {1}:{2}".format(source_file, container_conf.container_name, target_file))
+def copy_local_files_to_container(connection, container_conf, files, is_text_file=True, user=None):
+    """
+    Copies local files into a container with one command.
+    The files argument is a list of (source_path, target_path) tuples with absolute target paths.
+    The files are packed into a tar archive on the local machine that is piped into a tar
+    process in the container. The process runs as the given user or the default user of the
+    container, so it owns the files and the directories that are created for them.
+    If is_text_file is set, the windows line endings of the files are removed.
+    """
+    if not files:
+        return
+    if not user:
+        user = container_conf.container_user
+    archive = _create_container_files_tar(files, is_text_file)
+    command = 'docker exec -i --user {0}:{0} {1} tar -x -o -f - -C /'.format(user, container_conf.container_name)
+    connection.run_command(command, idempotent=True, stdin=archive)
+
+
+def _create_container_files_tar(files, is_text_file):
+    """
+    Returns the bytes of a tar archive that contains the files with their target paths relative to /.
+    The archive has no entries for the directories, so existing directories keep their owners and modes.
+    """
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w', format=tarfile.GNU_FORMAT) as archive:
+        for source_path, target_path in files:
+            source_path = PurePath(source_path)
+            data = build_context.read_context_file(source_path.parent, source_path.name, is_text_file)
+            info = tarfile.TarInfo(PurePosixPath(target_path).relative_to('/').as_posix())
+            info.size = len(data)
+            info.mode = 0o644
+            archive.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
 
 
 def container_to_container_copy(source_host_connection, source_container_conf, target_host_connection, target_container_conf, source_file, target_file):
     """
     Copies a file from one container to another.
+    The file is streamed without writing it to disk on the way.
     """
-    # copy from source container to source host
-    temp_path_source_host = source_host_connection.info.temp_dir.joinpath(source_file.name)
-    source_host_connection.run_command('docker cp {0}:{1} {2}'.format(source_container_conf.container_name, source_file, temp_path_source_host))
-
-    # copy from source host to target container
-    rtocontainercopy(source_host_connection, target_host_connection, target_container_conf, temp_path_source_host, target_file)
+    _stream_file(
+        source_host_connection,
+        _get_container_read_command(source_container_conf, source_file),
+        target_host_connection,
+        *_get_container_write_commands(target_container_conf, target_file)
+    )
 
 
 def copy_local_textfile_tree_to_container(local_source_dir, container_host_connection, container_config, container_target_dir):
     """
     Copy the contents of a local directory to a container directory.
     """
-    dir_content = fileutil.get_dir_content(local_source_dir)
-    for item in dir_content:
+    files = []
+    for item in fileutil.get_dir_content(local_source_dir):
         source_path = local_source_dir.joinpath(item)
         if os.path.isfile(str(source_path)):
-            target_path = container_target_dir.joinpath(item)
-            copy_textfile_to_container(container_host_connection, container_config, source_path, target_path)
+            files.append((source_path, container_target_dir.joinpath(item)))
+    copy_local_files_to_container(container_host_connection, container_config, files)
 
 
 def rtocontainercopy(source_host_connection, target_host_connection, container_conf, source_file, target_file):
     """
     Copies the source_file from a host machine to the target target path target_file on a container.
+    The file is streamed without writing it to disk on the way.
     """
-    temp_path_container_host = target_host_connection.info.temp_dir.joinpath(source_file.name)
-    fileutil.rtorcopy(source_host_connection.sftp_client, target_host_connection.sftp_client, source_file, temp_path_container_host)
-    copy_file_from_host_to_container(target_host_connection, container_conf, temp_path_container_host, target_file)
+    _stream_file(
+        source_host_connection,
+        'cat ' + shlex.quote(str(source_file)),
+        target_host_connection,
+        *_get_container_write_commands(container_conf, target_file)
+    )
 
 
 def containertorcopy(source_host_connection, container_conf, target_host_connection, source_file, target_file):
     """
     Copies a file from a container to an ssh host.
+    The file is streamed without writing it to disk on the way.
+    Windows hosts get the file over sftp, because they have no posix shell.
     """
-    sftp_client = source_host_connection.sftp_client
-    temp_dir_chost = source_host_connection.info.temp_dir
-    fileutil.guarantee_directory_exists(sftp_client, temp_dir_chost)
-    
-    # delete previously copied key-files
-    full_temp_public_key_file = temp_dir_chost.joinpath(source_file.name)
-    if fileutil.rexists(sftp_client, full_temp_public_key_file):
-        sftp_client.remove(str(full_temp_public_key_file))
+    read_command = _get_container_read_command(container_conf, source_file)
+    if not target_host_connection.info.is_linux_machine():
+        fileutil.write_remote_file(target_host_connection.sftp_client, target_file, _iter_command_data(source_host_connection, read_command))
+        return
+
+    target_file = PurePosixPath(target_file)
+    temp_file = _get_temp_file(target_file)
+    _stream_file(
+        source_host_connection,
+        read_command,
+        target_host_connection,
+        'mkdir -p {0} && cat > {1}'.format(shlex.quote(str(target_file.parent)), shlex.quote(str(temp_file))),
+        'mv {0} {1}'.format(shlex.quote(str(temp_file)), shlex.quote(str(target_file)))
+    )
+
+
+def _get_container_read_command(container_conf, source_file):
+    return 'docker exec --user {0}:{0} {1} cat {2}'.format(container_conf.container_user, container_conf.container_name, shlex.quote(str(source_file)))
+
+
+def _get_container_write_commands(container_conf, target_file):
+    """
+    Returns a command that writes its standard input to a temporary file in the container
+    and a command that renames the temporary file to the target file.
+    The missing directories and the file are created by the default user of the container.
+    """
+    target_file = PurePosixPath(target_file)
+    temp_file = _get_temp_file(target_file)
+    write_script = 'mkdir -p {0} && cat > {1}'.format(shlex.quote(str(target_file.parent)), shlex.quote(str(temp_file)))
+    write_command = 'docker exec -i --user {0}:{0} {1} sh -c {2}'.format(container_conf.container_user, container_conf.container_name, shlex.quote(write_script))
+    rename_command = 'docker exec --user {0}:{0} {1} mv {2} {3}'.format(
+        container_conf.container_user, container_conf.container_name, shlex.quote(str(temp_file)), shlex.quote(str(target_file)))
+    return write_command, rename_command
+
+
+def _get_temp_file(target_file):
+    return target_file.parent.joinpath(target_file.name + '.part')
+
+
+def _stream_file(source_connection, read_command, target_connection, write_command, rename_command):
+    """
+    Pipes the output of the read command into the write command, which writes a temporary file.
+    The rename command moves the temporary file to the target only if all data was written,
+    so a failing read command does not leave an incomplete target file.
+
+    If both commands run on the same host, they are connected with a pipe on that host.
+    Otherwise the local machine relays the output between the hosts. The source channel
+    only receives more data when the chunks were sent on to the target, so the number
+    of bytes that are buffered on the local machine is bounded.
+    """
+    if source_connection.info.machine_id == target_connection.info.machine_id:
+        # pipefail makes the command fail when the file can not be read.
+        source_connection.run_command('bash -c ' + shlex.quote('set -o pipefail; ' + read_command + ' | ' + write_command + ' && ' + rename_command))
+    else:
+        target_connection.run_command(write_command, stdin=_iter_command_data(source_connection, read_command))
+        target_connection.run_command(rename_command)
 
-    # Copy the file from the jenkins home directory to the
-    # jenkins-workspace directory on the host
-    source_host_connection.run_command('docker cp {0}:{1} {2}'.format(container_conf.container_name, str(source_file), str(full_temp_public_key_file)))
 
-    # Then copy it to the repository machine
-    fileutil.rtorcopy(sftp_client, target_host_connection.sftp_client, full_temp_public_key_file, target_file)
\ No newline at end of file
+def _iter_command_data(connection, command):
+    """
+    Yields the bytes of the standard output of the command and prints its error output.
+    """
+    for chunk in connection.iter_command(command, raw_output=True):
+        if chunk.stream == STDERR:
+            print('[{0}] {1}'.format(connection.info.machine_id, chunk.data.decode('utf-8', errors='replace').rstrip()))
+            continue
+        yield chunk.data
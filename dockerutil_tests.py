@@ -0,0 +1,917 @@
+#!/usr/bin/env python3
+"""
+This module contains automated tests for the dockerutil module.
+"""
+
+import unittest
+import tempfile
+import os
+import stat
+import socket
+import tarfile
+import shlex
+
+from dockerutil import *
+from connections import create_connection, CommandError, LocalFileClient, LocalConnectionHolder, ConnectionsHolder
+from connections_tests import get_local_host_info
+import config_data
+import dockerutil
+
+
+def get_example_query_output():
+    return [
+        '{"ID":"0c1d","Image":"jenkins-master-image","Names":"jenkins-master","State":"running","Status":"Up 2 hours"}',
+        '{"ID":"5e6f","Image":"cpf-web-server-image","Names":"MyCPFProject1-web-server","State":"exited","Status":"Exited (0) 2 days ago"}',
+        '----- docker images -----',
+        '{"ID":"a1b2","Repository":"jenkins-master-image","Tag":"latest"}',
+        '{"ID":"c3d4","Repository":"myregistry:5000/jenkins-slave-linux-image","Tag":"1.0"}',
+        '{"ID":"e5f6","Repository":"<none>","Tag":"<none>"}',
+    ]
+
+
+def install_fake_docker(directory, script):
+    """
+    Writes a shell script with the name docker to the directory and puts the directory in front of the PATH.
+    Returns the original PATH.
+    """
+    docker_script = os.path.join(directory, 'docker')
+    with open(docker_script, 'w') as file:
+        file.write('#!/bin/sh\n' + script)
+    os.chmod(docker_script, stat.S_IRWXU)
+    original_path = os.environ['PATH']
+    os.environ['PATH'] = directory + os.pathsep + original_path
+    return original_path
+
+
+# A docker command that keeps the containers and images of a host in the directory FAKE_DOCKER_STATE.
+# Each image is a file that contains the image id. The registry directory next to the host
+# directories holds the images that can be pulled and receives the pushed images.
+FAKE_DOCKER_HOST_SCRIPT = '''
+state="$FAKE_DOCKER_STATE"
+registry="$state/../registry"
+echo "$*" >> "$state/calls"
+file_name() { echo "$1" | tr '/:' '__'; }
+image_file() { echo "$state/images/$(file_name "$1")"; }
+case "$1" in
+    ps) cat "$state/containers" 2>/dev/null || true ;;
+    images) ;;
+    image)
+        if [ "$3" = "--format" ]; then name="$5"; else name="$3"; fi
+        [ -f "$(image_file "$name")" ] || exit 1
+        case "$4" in
+            *Size*) echo "$(cat "$(image_file "$name")") 100" ;;
+            *) cat "$(image_file "$name")" ;;
+        esac ;;
+    tag) cp "$(image_file "$2")" "$(image_file "$3")" ;;
+    push) cp "$(image_file "$2")" "$registry/$(file_name "$2")" ;;
+    pull) cp "$registry/$(file_name "$2")" "$(image_file "$2")" ;;
+    rm)
+        [ "$2" = "-f" ] && shift
+        shift
+        status=0
+        for name in "$@"; do
+            if [ -f "$state/busy-$name" ]; then
+                echo "Error: The container $name is busy" >&2
+                status=1
+            elif grep -q "\\"Names\\":\\"$name\\"" "$state/containers" 2>/dev/null; then
+                grep -v "\\"Names\\":\\"$name\\"" "$state/containers" > "$state/containers.new"
+                mv "$state/containers.new" "$state/containers"
+            else
+                echo "Error: No such container: $name" >&2
+                status=1
+            fi
+        done
+        exit $status ;;
+    save) echo "$2"; cat "$(image_file "$2")" ;;
+    load) read name; cat > "$(image_file "$name")" ;;
+esac
+'''
+
+
+class FakeDockerHostConnection(LocalConnectionHolder):
+    """
+    A local connection whose commands use the given state directory of the fake docker command.
+    """
+    def __init__(self, host_info, state_dir):
+        super().__init__(host_info)
+        self.state_dir = state_dir
+        os.makedirs(os.path.join(state_dir, 'images'), exist_ok=True)
+
+    def iter_command(self, command, **kwargs):
+        return super().iter_command('export FAKE_DOCKER_STATE={0}; {1}'.format(shlex.quote(self.state_dir), command), **kwargs)
+
+    def add_image(self, image_name, image_id):
+        with open(os.path.join(self.state_dir, 'images', image_name.replace('/', '_').replace(':', '_')), 'w') as file:
+            file.write(image_id + '\n')
+
+    def get_image_id(self, image_name):
+        try:
+            with open(os.path.join(self.state_dir, 'images', image_name.replace('/', '_').replace(':', '_'))) as file:
+                return file.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def get_docker_calls(self):
+        try:
+            with open(os.path.join(self.state_dir, 'calls')) as file:
+                return file.read().splitlines()
+        except FileNotFoundError:
+            return []
+
+
+class FakeDockerHosts(ConnectionsHolder):
+    """
+    A ConnectionsHolder whose hosts are FakeDockerHostConnections with state directories below temp_dir.
+    install_fake_docker(temp_dir, FAKE_DOCKER_HOST_SCRIPT) must be called before the hosts are used.
+    """
+    def __init__(self, temp_dir, machine_ids):
+        self._temp_dir = temp_dir
+        os.makedirs(os.path.join(temp_dir, 'registry'), exist_ok=True)
+        super().__init__([get_local_host_info(machine_id) for machine_id in machine_ids], lazy=True)
+
+    def _establish_host_machine_connections(self, host_machine_infos):
+        for info in host_machine_infos:
+            self._connection_holders[info.machine_id] = FakeDockerHostConnection(info, os.path.join(self._temp_dir, info.machine_id))
+
+    def _establish_host_machine_connections_in_parallel(self, host_machine_infos, max_workers):
+        self._establish_host_machine_connections(host_machine_infos)
+
+    def add_registry_image(self, image_name, image_id):
+        with open(os.path.join(self._temp_dir, 'registry', image_name.replace('/', '_').replace(':', '_')), 'w') as file:
+            file.write(image_id + '\n')
+
+    def get_registry_image_id(self, image_name):
+        try:
+            with open(os.path.join(self._temp_dir, 'registry', image_name.replace('/', '_').replace(':', '_'))) as file:
+                return file.read().strip()
+        except FileNotFoundError:
+            return None
+
+
+class TestDockerHostState(unittest.TestCase):
+    """
+    Fixture class for testing the DockerHostState class.
+    """
+    def test_container_queries(self):
+        """
+        Happy case test for the container queries.
+        """
+        # execute
+        sut = DockerHostState(get_example_query_output())
+
+        # verify
+        self.assertTrue(sut.has_container('jenkins-master'))
+        self.assertTrue(sut.has_container('MyCPFProject1-web-server'))
+        self.assertFalse(sut.has_container('jenkins'))
+        self.assertTrue(sut.is_running('jenkins-master'))
+        self.assertFalse(sut.is_running('MyCPFProject1-web-server'))
+        self.assertEqual(sut.get_container(running_only=True), ['jenkins-master'])
+
+
+    def test_image_names_must_match_exactly(self):
+        """
+        Images are only found by their complete name and tag, not by a part of the name.
+        """
+        # execute
+        sut = DockerHostState(get_example_query_output())
+
+        # verify
+        self.assertTrue(sut.has_image('jenkins-master-image'))
+        self.assertTrue(sut.has_image('jenkins-master-image:latest'))
+        self.assertFalse(sut.has_image('jenkins-master'))
+        self.assertFalse(sut.has_image('jenkins-master-image:1.0'))
+        self.assertTrue(sut.has_image('myregistry:5000/jenkins-slave-linux-image:1.0'))
+        self.assertFalse(sut.has_image('myregistry:5000/jenkins-slave-linux-image'))
+
+
+    def test_an_empty_host_has_no_container_and_images(self):
+        """
+        The separator line is the only output on a host without container and images.
+        """
+        # execute
+        sut = DockerHostState(['----- docker images -----'])
+
+        # verify
+        self.assertEqual(sut.get_container(), [])
+        self.assertFalse(sut.has_image('jenkins-master-image'))
+
+
+class FakeQueryConnection:
+    """
+    Returns the example output for the state query and counts the queries.
+    If invalidate_during_query is set, the state of the host is invalidated while the query runs,
+    like another thread that runs a state changing command at the same time.
+    """
+    def __init__(self, invalidate_during_query=False):
+        self.invalidate_during_query = invalidate_during_query
+        self.query_count = 0
+
+    def run_command(self, command, **kwargs):
+        self.query_count += 1
+        if self.invalidate_during_query:
+            invalidate_docker_host_state(self)
+        return get_example_query_output()
+
+
+class TestGetDockerHostState(unittest.TestCase):
+    """
+    Fixture class for testing the get_docker_host_state() function.
+    """
+    def test_snapshot_is_reused(self):
+        """
+        The host is only queried once as long as its state is not invalidated.
+        """
+        # setup
+        connection = FakeQueryConnection()
+
+        # execute
+        get_docker_host_state(connection)
+        state = get_docker_host_state(connection)
+
+        # verify
+        self.assertTrue(state.has_container('jenkins-master'))
+        self.assertEqual(connection.query_count, 1)
+
+
+    def test_query_that_overlaps_an_invalidation_is_not_kept(self):
+        """
+        A snapshot may miss the changes of a command that ran during the query, so it is only
+        returned to the caller of the query and the next call queries the host again.
+        """
+        # setup
+        connection = FakeQueryConnection(invalidate_during_query=True)
+
+        # execute
+        state = get_docker_host_state(connection)
+        get_docker_host_state(connection)
+
+        # verify
+        self.assertTrue(state.has_container('jenkins-master'))
+        self.assertEqual(connection.query_count, 2)
+
+
+class TestRemoveContainers(unittest.TestCase):
+    """
+    Fixture class for testing the remove_containers() function.
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.original_path = install_fake_docker(self.temp_dir.name, FAKE_DOCKER_HOST_SCRIPT)
+        self.connection = FakeDockerHosts(self.temp_dir.name, ['MyHost']).get_connection('MyHost')
+        with open(os.path.join(self.connection.state_dir, 'containers'), 'w') as file:
+            file.write('\n'.join(get_example_query_output()[:2]) + '\n')
+
+
+    def tearDown(self):
+        os.environ['PATH'] = self.original_path
+        self.temp_dir.cleanup()
+
+
+    def test_running_containers_are_stopped_before_removal(self):
+        """
+        Happy case test for removing a running, an exited and a missing container.
+        """
+        # execute
+        remove_containers(self.connection, ['jenkins-master', 'MyCPFProject1-web-server', 'jenkins'], stop_timeout=10)
+
+        # verify
+        calls = [call for call in self.connection.get_docker_calls() if not call.startswith(('ps', 'images'))]
+        self.assertEqual(calls, [
+            'stop -t 10 jenkins-master',
+            'rm -f jenkins-master MyCPFProject1-web-server',
+        ])
+
+
+    def test_containers_are_killed_without_stop_timeout(self):
+        """
+        Without a stop timeout no docker stop command is run.
+        """
+        # execute
+        remove_containers(self.connection, ['jenkins-master'])
+
+        # verify
+        calls = [call for call in self.connection.get_docker_calls() if not call.startswith(('ps', 'images'))]
+        self.assertEqual(calls, ['rm -f jenkins-master'])
+
+
+    def test_containers_removed_by_an_interrupted_run_are_ignored(self):
+        """
+        docker rm fails for containers that are already gone when it is run again after a lost connection.
+        """
+        # setup
+        get_docker_host_state(self.connection)
+        os.remove(os.path.join(self.connection.state_dir, 'containers'))
+
+        # execute
+        remove_containers(self.connection, ['jenkins-master', 'MyCPFProject1-web-server'])
+
+        # verify
+        self.assertIn('rm -f jenkins-master MyCPFProject1-web-server', self.connection.get_docker_calls())
+
+
+    def test_failing_removal_of_existing_containers_raises(self):
+        """
+        The error of docker rm is raised when a container still exists afterwards.
+        """
+        # setup
+        open(os.path.join(self.connection.state_dir, 'busy-MyCPFProject1-web-server'), 'w').close()
+
+        # execute and verify
+        with self.assertRaises(CommandError):
+            remove_containers(self.connection, ['jenkins-master', 'MyCPFProject1-web-server'])
+
+
+    def test_nothing_is_run_for_missing_containers(self):
+        """
+        Only the state query is run when none of the containers exist.
+        """
+        # execute
+        remove_containers(self.connection, ['jenkins', 'MyCPFProject2-web-server'], stop_timeout=10)
+
+        # verify
+        self.assertEqual(self.connection.get_docker_calls(), [
+            "ps -a --format {{json .}}",
+            "images --format {{json .}}",
+        ])
+
+
+class TestDistributeImage(unittest.TestCase):
+    """
+    Fixture class for testing the distribute_image() function.
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.original_path = install_fake_docker(self.temp_dir.name, FAKE_DOCKER_HOST_SCRIPT)
+        self.hosts = FakeDockerHosts(self.temp_dir.name, ['MySourceHost', 'MyHost2', 'MyHost3'])
+
+
+    def tearDown(self):
+        os.environ['PATH'] = self.original_path
+        self.temp_dir.cleanup()
+
+
+    def test_image_is_streamed_to_outdated_hosts(self):
+        """
+        Happy case test for distributing an image to one host without the image and one up to date host.
+        """
+        # setup
+        self.hosts.get_connection('MySourceHost').add_image('jenkins-slave-linux-image', 'sha256:1111')
+        self.hosts.get_connection('MyHost3').add_image('jenkins-slave-linux-image', 'sha256:1111')
+
+        # execute
+        distribute_image(self.hosts, 'jenkins-slave-linux-image', 'MySourceHost', ['MySourceHost', 'MyHost2', 'MyHost3'])
+
+        # verify
+        self.assertEqual(self.hosts.get_connection('MyHost2').get_image_id('jenkins-slave-linux-image'), 'sha256:1111')
+        self.assertIn('load', self.hosts.get_connection('MyHost2').get_docker_calls())
+        self.assertNotIn('load', self.hosts.get_connection('MyHost3').get_docker_calls())
+        self.assertNotIn('load', self.hosts.get_connection('MySourceHost').get_docker_calls())
+        self.assertEqual(self.hosts.get_connection('MySourceHost').get_docker_calls().count('save jenkins-slave-linux-image'), 1)
+
+
+    def test_missing_source_image_raises(self):
+        """
+        An image can not be distributed when it does not exist on the source host.
+        """
+        # execute and verify
+        with self.assertRaises(Exception):
+            distribute_image(self.hosts, 'jenkins-slave-linux-image', 'MySourceHost', ['MyHost2'])
+        self.assertEqual(self.hosts.get_connection('MyHost2').get_docker_calls(), [])
+
+
+class TestRegistry(unittest.TestCase):
+    """
+    Fixture class for testing the functions that move images through the registry.
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.original_path = install_fake_docker(self.temp_dir.name, FAKE_DOCKER_HOST_SCRIPT)
+        self.hosts = FakeDockerHosts(self.temp_dir.name, ['MyMaster', 'MySlave1', 'MySlave2'])
+
+
+    def tearDown(self):
+        os.environ['PATH'] = self.original_path
+        self.temp_dir.cleanup()
+
+
+    def test_push_and_pull_image(self):
+        """
+        Happy case test for moving an image from one host to another.
+        """
+        # setup
+        master = self.hosts.get_connection('MyMaster')
+        slave = self.hosts.get_connection('MySlave1')
+        master.add_image('jenkins-slave-linux-image', 'sha256:1111')
+
+        # execute
+        push_image_to_registry(master, 'jenkins-slave-linux-image', 'myregistry:5000')
+        pull_image_from_registry(slave, 'jenkins-slave-linux-image', 'myregistry:5000')
+
+        # verify
+        self.assertEqual(master.get_docker_calls(), [
+            'tag jenkins-slave-linux-image myregistry:5000/jenkins-slave-linux-image:latest',
+            'push myregistry:5000/jenkins-slave-linux-image:latest',
+        ])
+        self.assertEqual(slave.get_docker_calls(), [
+            'pull myregistry:5000/jenkins-slave-linux-image:latest',
+            'tag myregistry:5000/jenkins-slave-linux-image:latest jenkins-slave-linux-image',
+        ])
+        self.assertEqual(self.hosts.get_registry_image_id('myregistry:5000/jenkins-slave-linux-image:latest'), 'sha256:1111')
+        self.assertEqual(slave.get_image_id('jenkins-slave-linux-image'), 'sha256:1111')
+
+
+    def test_distribute_image_with_registry_skips_up_to_date_hosts(self):
+        """
+        Hosts that already have the image with the same id do not pull it.
+        """
+        # setup
+        self.hosts.get_connection('MyMaster').add_image('jenkins-slave-linux-image', 'sha256:1111')
+        self.hosts.get_connection('MySlave2').add_image('jenkins-slave-linux-image', 'sha256:1111')
+
+        # execute
+        distribute_image_with_registry(self.hosts, 'jenkins-slave-linux-image', 'MyMaster', ['MyMaster', 'MySlave1', 'MySlave2'], 'myregistry:5000')
+
+        # verify
+        self.assertEqual(self.hosts.get_connection('MySlave1').get_image_id('jenkins-slave-linux-image'), 'sha256:1111')
+        self.assertNotIn('pull myregistry:5000/jenkins-slave-linux-image:latest', self.hosts.get_connection('MySlave2').get_docker_calls())
+        self.assertNotIn('pull myregistry:5000/jenkins-slave-linux-image:latest', self.hosts.get_connection('MyMaster').get_docker_calls())
+
+
+    def test_base_images_are_pulled_upstream_only_once(self):
+        """
+        The first host pulls a missing base image from upstream and pushes it to the registry.
+        The other hosts get it from the registry. Images that are built by the same builds are not pulled.
+        """
+        # setup
+        with open(os.path.join(self.temp_dir.name, 'DockerfileBase'), 'w') as file:
+            file.write('FROM ubuntu:20.04\n')
+        with open(os.path.join(self.temp_dir.name, 'DockerfileDerived'), 'w') as file:
+            file.write('FROM my-base-image\n')
+        self.hosts.add_registry_image('ubuntu:20.04', 'sha256:2222')
+        image_builds = [
+            ImageBuild('MySlave1', 'my-base-image', self.temp_dir.name, 'DockerfileBase', [], ['DockerfileBase']),
+            ImageBuild('MySlave1', 'my-derived-image', self.temp_dir.name, 'DockerfileDerived', [], ['DockerfileDerived']),
+            ImageBuild('MySlave2', 'my-base-image', self.temp_dir.name, 'DockerfileBase', [], ['DockerfileBase']),
+        ]
+
+        # execute
+        dockerutil._pull_base_images_through_registry(self.hosts, image_builds[:2], 'myregistry:5000')
+        dockerutil._pull_base_images_through_registry(self.hosts, image_builds[2:], 'myregistry:5000')
+
+        # verify
+        self.assertEqual(self.hosts.get_connection('MySlave1').get_docker_calls(), [
+            'image inspect ubuntu:20.04',
+            'pull myregistry:5000/ubuntu:20.04',
+            'pull ubuntu:20.04',
+            'tag ubuntu:20.04 myregistry:5000/ubuntu:20.04',
+            'push myregistry:5000/ubuntu:20.04',
+        ])
+        self.assertEqual(self.hosts.get_connection('MySlave2').get_docker_calls(), [
+            'image inspect ubuntu:20.04',
+            'pull myregistry:5000/ubuntu:20.04',
+            'tag myregistry:5000/ubuntu:20.04 ubuntu:20.04',
+        ])
+        self.assertEqual(self.hosts.get_connection('MySlave2').get_image_id('ubuntu:20.04'), 'sha256:2222')
+
+
+class TestPlanImageBuilds(unittest.TestCase):
+    """
+    Fixture class for testing the plan_image_builds function.
+    """
+    def test_each_image_is_built_once_per_host(self):
+        """
+        Containers that share a host and an image need only one build.
+        """
+        # setup
+        image_builds = [
+            ImageBuild('MyMaster', 'cpf-web-server-image', '/source', 'DockerfileCPFWebServer', [], ['DockerfileCPFWebServer']),
+            ImageBuild('MyLinuxSlave', 'cpf-web-server-image', '/source', 'DockerfileCPFWebServer', [], ['DockerfileCPFWebServer']),
+            ImageBuild('MyMaster', 'cpf-web-server-image', '/source', 'DockerfileCPFWebServer', [], ['DockerfileCPFWebServer']),
+            ImageBuild('MyMaster', 'jenkins-slave-linux-image', '/source', 'DockerfileJenkinsSlaveLinux', [], ['DockerfileJenkinsSlaveLinux']),
+        ]
+
+        # execute
+        planned_builds = plan_image_builds(image_builds)
+
+        # verify
+        self.assertEqual(
+            [(build.machine_id, build.image_name) for build in planned_builds],
+            [('MyMaster', 'cpf-web-server-image'), ('MyLinuxSlave', 'cpf-web-server-image'), ('MyMaster', 'jenkins-slave-linux-image')]
+        )
+
+
+    def test_conflicting_builds_are_rejected(self):
+        """
+        Two builds of the same image on one host must not have different inputs.
+        """
+        # setup
+        image_builds = [
+            ImageBuild('MyMaster', 'cpf-web-server-image', '/source', 'DockerfileCPFWebServer', [], ['DockerfileCPFWebServer']),
+            ImageBuild('MyMaster', 'cpf-web-server-image', '/source', 'DockerfileCPFWebServer', ['VERSION=2'], ['DockerfileCPFWebServer']),
+        ]
+
+        # execute
+        self.assertRaises(Exception, plan_image_builds, image_builds)
+
+
+class TestRunCommandsInContainer(unittest.TestCase):
+    """
+    Fixture class for testing the run_commands_in_container() function.
+    The docker command is replaced with a script that runs the shell of the docker exec command on the local machine.
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.original_path = install_fake_docker(self.temp_dir.name, 'while [ "$1" != "sh" ]; do shift; done\nexec "$@"\n')
+
+        self.connection = create_connection(get_local_host_info())
+        self.container_config = config_data.ContainerConfig()
+        self.container_config.container_name = 'MyContainer'
+        self.container_config.container_user = 'jenkins'
+
+
+    def tearDown(self):
+        os.environ['PATH'] = self.original_path
+        self.temp_dir.cleanup()
+
+
+    def test_returns_the_output_and_return_code_of_each_command(self):
+        """
+        Happy case test for running a batch of commands.
+        """
+        # execute
+        results = run_commands_in_container(self.connection, self.container_config, ['echo first', 'echo second; echo error >&2', 'cd /; printf $(pwd)'], print_command=False)
+
+        # verify
+        self.assertEqual([result.return_code for result in results], [0, 0, 0])
+        self.assertEqual(results[0].output, ['first'])
+        self.assertEqual(results[1].output, ['second', 'error'])
+        self.assertEqual(results[2].output, ['/'])
+
+
+    def test_stops_at_the_first_failing_command(self):
+        """
+        The remaining commands are skipped and the failing command is raised.
+        """
+        # execute
+        with self.assertRaises(CommandError) as context:
+            run_commands_in_container(self.connection, self.container_config, ['echo first', 'exit 3', 'echo third'], print_command=False)
+
+        # verify
+        self.assertEqual(context.exception.command, 'exit 3')
+        self.assertEqual(context.exception.return_code, 3)
+
+
+    def test_runs_all_commands_if_errors_are_not_stopping(self):
+        """
+        The return codes of all commands are returned when stop_on_error is not set.
+        """
+        # execute
+        results = run_commands_in_container(self.connection, self.container_config, ['exit 3', 'read line; echo $?'], stop_on_error=False, print_command=False)
+
+        # verify
+        self.assertEqual([result.return_code for result in results], [3, 0])
+        self.assertEqual(results[1].output, ['1'])
+
+
+class TestCopyLocalFilesToContainer(unittest.TestCase):
+    """
+    Fixture class for testing the copy_local_files_to_container() function.
+    The docker command is replaced with a script that writes its arguments and the
+    archive that it gets on its standard input to the temp directory.
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.original_path = install_fake_docker(self.temp_dir.name, (
+            'echo "$*" > ' + self.temp_dir.name + '/arguments\n'
+            'cat > ' + self.temp_dir.name + '/archive.tar\n'
+        ))
+        self.connection = create_connection(get_local_host_info())
+        self.container_config = config_data.ContainerConfig()
+        self.container_config.container_name = 'MyContainer'
+        self.container_config.container_user = 'jenkins'
+
+
+    def tearDown(self):
+        os.environ['PATH'] = self.original_path
+        self.temp_dir.cleanup()
+
+
+    def test_files_are_extracted_by_one_tar_process(self):
+        """
+        Happy case test for copying text files with windows line endings.
+        """
+        # setup
+        source_dir = os.path.join(self.temp_dir.name, 'source')
+        os.mkdir(source_dir)
+        with open(os.path.join(source_dir, 'script.sh'), 'wb') as file:
+            file.write(b'echo bla\r\necho blub\r\n')
+        with open(os.path.join(source_dir, 'my config.xml'), 'wb') as file:
+            file.write(b'<config/>')
+
+        # execute
+        copy_local_files_to_container(self.connection, self.container_config, [
+            (os.path.join(source_dir, 'script.sh'), '/home/jenkins/bin/script.sh'),
+            (os.path.join(source_dir, 'my config.xml'), '/var/jenkins_home/my config.xml'),
+        ], user='root')
+
+        # verify
+        with open(os.path.join(self.temp_dir.name, 'arguments')) as file:
+            self.assertEqual(file.read().strip(), 'exec -i --user root:root MyContainer tar -x -o -f - -C /')
+        with tarfile.open(os.path.join(self.temp_dir.name, 'archive.tar')) as archive:
+            members = {member.name : member for member in archive.getmembers()}
+            self.assertEqual(sorted(members.keys()), ['home/jenkins/bin/script.sh', 'var/jenkins_home/my config.xml'])
+            self.assertEqual(archive.extractfile(members['home/jenkins/bin/script.sh']).read(), b'echo bla\necho blub\n')
+            self.assertEqual(members['var/jenkins_home/my config.xml'].mode, 0o644)
+
+
+    def test_nothing_is_run_without_files(self):
+        """
+        No docker command is needed for an empty list of files.
+        """
+        # execute
+        copy_local_files_to_container(self.connection, self.container_config, [])
+
+        # verify
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir.name, 'arguments')))
+
+
+class FakeWindowsConnection:
+    """
+    A connection to a Windows host whose sftp client works on the local file system.
+    """
+    def __init__(self):
+        self.info = config_data.HostMachineInfo({
+            config_data.KEY_MACHINE_ID : 'MyWindowsHost',
+            config_data.KEY_HOST : 'localhost',
+            config_data.KEY_USER : 'fritz',
+            config_data.KEY_OSTYPE : 'Windows',
+            config_data.KEY_TEMPDIR : 'C:/temp',
+        })
+        self.sftp_client = LocalFileClient()
+
+
+class TestCopyFilesBetweenContainersAndHosts(unittest.TestCase):
+    """
+    Fixture class for testing the functions that stream files between containers and hosts.
+    The docker command is replaced with a script that runs the command of docker exec on the local machine.
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.original_path = install_fake_docker(self.temp_dir.name, (
+            'shift\n'
+            '[ "$1" = "-i" ] && shift\n'
+            'shift 3\n'
+            'exec "$@"\n'
+        ))
+        self.source_connection = create_connection(get_local_host_info('MySourceHost'))
+        self.target_connection = create_connection(get_local_host_info('MyTargetHost'))
+        self.container_config = config_data.ContainerConfig()
+        self.container_config.container_name = 'MyContainer'
+        self.container_config.container_user = 'jenkins'
+        self.source_file = PurePosixPath(self.temp_dir.name).joinpath('source', 'id_rsa.pub')
+        os.mkdir(str(self.source_file.parent))
+        with open(str(self.source_file), 'w') as file:
+            file.write('my key\n')
+
+
+    def tearDown(self):
+        os.environ['PATH'] = self.original_path
+        self.temp_dir.cleanup()
+
+
+    def read_file(self, path):
+        with open(str(path)) as file:
+            return file.read()
+
+
+    def test_files_are_copied_on_one_host_and_between_hosts(self):
+        """
+        Happy case test for copying a file from a container to a host and back into a container.
+        """
+        # setup
+        host_file = PurePosixPath(self.temp_dir.name).joinpath('host dir', 'key.pub')
+        container_file = PurePosixPath(self.temp_dir.name).joinpath('container', '.ssh', 'key.pub')
+
+        # execute
+        containertorcopy(self.source_connection, self.container_config, self.target_connection, self.source_file, host_file)
+        rtocontainercopy(self.target_connection, self.target_connection, self.container_config, host_file, container_file)
+
+        # verify
+        self.assertEqual(self.read_file(host_file), 'my key\n')
+        self.assertEqual(self.read_file(container_file), 'my key\n')
+        self.assertEqual(sorted(os.listdir(str(container_file.parent))), ['key.pub'])
+
+
+    def test_failing_reads_keep_the_old_target_file(self):
+        """
+        The target is only replaced when the source file could be read completely.
+        """
+        # setup
+        target_file = PurePosixPath(self.temp_dir.name).joinpath('target', 'key.pub')
+        os.mkdir(str(target_file.parent))
+        with open(str(target_file), 'w') as file:
+            file.write('old key\n')
+        missing_file = self.source_file.parent.joinpath('missing')
+
+        # execute
+        with self.assertRaises(CommandError):
+            containertorcopy(self.source_connection, self.container_config, self.target_connection, missing_file, target_file)
+        with self.assertRaises(CommandError):
+            container_to_container_copy(self.target_connection, self.container_config, self.target_connection, self.container_config, missing_file, target_file)
+
+        # verify
+        self.assertEqual(self.read_file(target_file), 'old key\n')
+
+
+    def test_windows_hosts_get_the_file_over_sftp(self):
+        """
+        The file is written with the sftp client of the windows host.
+        """
+        # setup
+        target_connection = FakeWindowsConnection()
+        target_file = PurePosixPath(self.temp_dir.name).joinpath('windows', 'key.pub')
+
+        # execute
+        containertorcopy(self.source_connection, self.container_config, target_connection, self.source_file, target_file)
+        with self.assertRaises(CommandError):
+            containertorcopy(self.source_connection, self.container_config, target_connection, self.source_file.parent.joinpath('missing'), target_file)
+
+        # verify
+        self.assertEqual(self.read_file(target_file), 'my key\n')
+        self.assertEqual(os.listdir(str(target_file.parent)), ['key.pub'])
+
+
+class TestWaitUntilHealthy(unittest.TestCase):
+    """
+    Fixture class for testing the wait_until_healthy() function.
+    The docker command is replaced with a script that prints the status of the FAKE_INSPECT
+    variable and the events of the FAKE_EVENTS variable.
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.original_path = install_fake_docker(self.temp_dir.name, 'if [ "$1" = "inspect" ]; then echo "$FAKE_INSPECT"; else printf "$FAKE_EVENTS"; fi\n')
+        self.connection = create_connection(get_local_host_info())
+
+
+    def tearDown(self):
+        os.environ['PATH'] = self.original_path
+        os.environ.pop('FAKE_INSPECT', None)
+        os.environ.pop('FAKE_EVENTS', None)
+        self.temp_dir.cleanup()
+
+
+    def test_returns_when_the_healthy_event_arrives(self):
+        """
+        Happy case test for a container that is still starting.
+        """
+        # setup
+        os.environ['FAKE_INSPECT'] = 'running starting'
+        os.environ['FAKE_EVENTS'] = 'health_status: healthy\\n'
+
+        # execute
+        wait_until_healthy(self.connection, 'MyContainer', 10)
+
+
+    def test_containers_without_health_check_only_need_to_run(self):
+        """
+        The events are not followed for containers that have no HEALTHCHECK.
+        """
+        # setup
+        os.environ['FAKE_INSPECT'] = 'running '
+        os.environ['FAKE_EVENTS'] = ''
+
+        # execute
+        wait_until_healthy(self.connection, 'MyContainer', 10)
+
+        os.environ['FAKE_INSPECT'] = 'exited '
+        self.assertRaises(Exception, wait_until_healthy, self.connection, 'MyContainer', 10)
+
+
+    def test_unhealthy_containers_are_waited_for(self):
+        """
+        A slow start can exceed the retries of the health check, so unhealthy is not an error.
+        """
+        # setup
+        os.environ['FAKE_INSPECT'] = 'running unhealthy'
+        os.environ['FAKE_EVENTS'] = 'health_status: unhealthy\\nhealth_status: healthy\\n'
+
+        # execute
+        wait_until_healthy(self.connection, 'MyContainer', 10)
+
+
+    def test_raises_if_the_container_does_not_become_healthy(self):
+        """
+        The exit of the container and the end of the events before the timeout are errors.
+        """
+        # setup
+        os.environ['FAKE_INSPECT'] = 'running starting'
+
+        # execute
+        os.environ['FAKE_EVENTS'] = 'health_status: unhealthy\\ndie\\nhealth_status: healthy\\n'
+        self.assertRaises(Exception, wait_until_healthy, self.connection, 'MyContainer', 10)
+        os.environ['FAKE_EVENTS'] = 'health_status: unhealthy\\n'
+        self.assertRaises(Exception, wait_until_healthy, self.connection, 'MyContainer', 10)
+
+
+class TestBuildDockerImage(unittest.TestCase):
+    """
+    Fixture class for testing the build_docker_image() function.
+    The docker command is replaced with a script that keeps the ids of the pulled images
+    and the context hash labels of the built images as files in the temp directory.
+    Like the real docker build, the fake build pulls the base image ubuntu:20.04 if it is missing.
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.original_path = install_fake_docker(self.temp_dir.name, (
+            'state_dir=' + self.temp_dir.name + '\n'
+            'if [ "$1" = "image" ]; then\n'
+            '  case "$4" in *Labels*) file="$state_dir/label-$5";; *) file="$state_dir/id-$5";; esac\n'
+            '  [ -f "$file" ] && cat "$file"\n'
+            'elif [ "$1" = "pull" ]; then\n'
+            '  echo "sha256:$2" > "$state_dir/id-$2"\n'
+            '  echo "pull $2" >> "$state_dir/calls"\n'
+            'elif [ "$1" = "build" ]; then\n'
+            '  cat > /dev/null\n'
+            '  [ -f "$state_dir/id-ubuntu:20.04" ] || echo "sha256:ubuntu:20.04" > "$state_dir/id-ubuntu:20.04"\n'
+            '  while [ $# -gt 0 ]; do\n'
+            '    case "$1" in -t) name="$2";; --label) label="$2";; esac\n'
+            '    shift\n'
+            '  done\n'
+            '  echo "${label#*=}" > "$state_dir/label-$name"\n'
+            '  echo "build $name" >> "$state_dir/calls"\n'
+            'fi\n'
+        ))
+        self.connection = create_connection(get_local_host_info())
+        self.context_dir = os.path.join(self.temp_dir.name, 'context')
+        os.mkdir(self.context_dir)
+        with open(os.path.join(self.context_dir, 'Dockerfile'), 'w') as file:
+            file.write('FROM ubuntu:20.04\nRUN true\n')
+
+
+    def tearDown(self):
+        os.environ['PATH'] = self.original_path
+        self.temp_dir.cleanup()
+
+
+    def test_missing_base_images_do_not_cause_a_second_build(self):
+        """
+        The base images are pulled before the context hash is computed, so the hash
+        is the same in the next run.
+        """
+        # execute
+        build_docker_image(self.connection, 'my-image', self.context_dir, 'Dockerfile', [], ['Dockerfile'])
+        build_docker_image(self.connection, 'my-image', self.context_dir, 'Dockerfile', [], ['Dockerfile'])
+
+        # verify
+        with open(os.path.join(self.temp_dir.name, 'calls')) as file:
+            calls = file.read().splitlines()
+        self.assertEqual(calls, ['pull ubuntu:20.04', 'build my-image'])
+
+
+class TestHostNameResolver(unittest.TestCase):
+    """
+    Fixture class for testing the HostNameResolver class.
+    """
+    def setUp(self):
+        self.resolved_names = []
+
+
+    def _resolve(self, host_name):
+        self.resolved_names.append(host_name)
+        if host_name.startswith('unknown'):
+            raise socket.gaierror('Name or service not known')
+        return '192.168.0.' + str(len(host_name))
+
+
+    def test_each_name_is_resolved_once(self):
+        """
+        Happy case test for resolving names of multiple containers.
+        """
+        # setup
+        sut = HostNameResolver(self._resolve)
+
+        # execute
+        first_addresses = sut.resolve(['MyMaster', 'MyRepository', 'MyMaster'])
+        second_addresses = sut.resolve(['MyRepository'])
+
+        # verify
+        self.assertEqual(list(first_addresses.items()), [('MyMaster', '192.168.0.8'), ('MyRepository', '192.168.0.12')])
+        self.assertEqual(second_addresses, {'MyRepository' : '192.168.0.12'})
+        self.assertEqual(sorted(self.resolved_names), ['MyMaster', 'MyRepository'])
+
+
+    def test_all_unknown_names_are_reported_together(self):
+        """
+        The error lists every name that can not be resolved.
+        """
+        # setup
+        sut = HostNameResolver(self._resolve)
+
+        # execute
+        with self.assertRaises(Exception) as context:
+            sut.resolve(['unknown1', 'MyMaster', 'unknown2'])
+
+        # verify
+        self.assertIn('unknown1', str(context.exception))
+        self.assertIn('unknown2', str(context.exception))
+        self.assertEqual(sut.resolve(['MyMaster']), {'MyMaster' : '192.168.0.8'})
@@ -9,6 +9,7 @@ import platform
 from pathlib import PureWindowsPath, PurePosixPath, PurePath
 
 from connections import ConnectionHolder
+import tracing
 
 
 _SCRIPT_DIR = PurePath(os.path.dirname(os.path.realpath(__file__)))
@@ -19,9 +20,10 @@ def clear_rdirectory(sftp_client, directory):
     This functions deletes the given directory and all its content and recreates it.
     It does it on the given machine.
     """
-    if rexists(sftp_client, directory):
-        rrmtree(sftp_client, directory)
-    rmakedirs(sftp_client, directory)
+    with tracing.span('clear ' + str(directory), 'sftp', _get_machine_id(sftp_client)):
+        if rexists(sftp_client, directory):
+            rrmtree(sftp_client, directory)
+        rmakedirs(sftp_client, directory)
 
 
 def rexists(sftp_client, path):
@@ -71,29 +73,6 @@ def guarantee_directory_exists(sftp_client, dir_path):
         rmakedirs(sftp_client, dir_path)
 
 
-def copy_local_files_to_host(connection, source_dir, context_dir, text_files, binary_files=[]):
-    """
-    context_dir is the directory on the host that is used as a build context for the container.
-    source_dir is the absolute directory on the machine executing the script that contains the files
-    required for building the container.
-    """
-    source_dir = PurePath(source_dir)
-
-    # copy text files to the host
-    for file_path in text_files:
-        source_path = source_dir.joinpath(file_path)
-        target_path = context_dir.joinpath(file_path)
-        # Copy the file.
-        copy_textfile_from_local_to_linux(connection, source_path, target_path)
-
-    # copy binary files to the host
-    for file_path in binary_files:
-        source_path = source_dir.joinpath(file_path)
-        target_path = context_dir.joinpath(file_path)
-        # Copy the file.
-        copy_file_from_local_to_remote(connection.sftp_client, source_path, target_path)
-
-
 def copy_textfile_from_local_to_linux(connection, source_path, target_path):
     """
     This function ensures that the file-endings of the text-file are set to linux
@@ -103,7 +82,7 @@ def copy_textfile_from_local_to_linux(connection, source_path, target_path):
     
     # Remove \r from file from windows line endings if the script is executed on windows.
     if platform.system() == 'Windows':
-        temp_file = target_path.parent.joinpath('temp.txt')
+        temp_file = target_path.parent.joinpath(target_path.name + '.temp')
         format_line_endings_command = "tr -d '\r' < '{0}' > '{1}' && mv {1} {0}".format(str(target_path), str(temp_file))
         connection.run_command(format_line_endings_command)
 
@@ -112,19 +91,40 @@ def copy_file_from_local_to_remote(sftp_client, source_path, target_path):
     """
     Copies a file to a host machine defined by connection, without changing it.
     """
-    # make sure a directory for the target file exists
-    rmakedirs(sftp_client, target_path.parent)
-    sftp_client.put( str(source_path), str(target_path) )
+    with tracing.span('put ' + str(target_path), 'sftp', _get_machine_id(sftp_client), os.path.getsize(str(source_path))):
+        # make sure a directory for the target file exists
+        rmakedirs(sftp_client, target_path.parent)
+        sftp_client.put( str(source_path), str(target_path) )
+
+
+def write_remote_file(sftp_client, target_path, chunks):
+    """
+    Writes the bytes chunks to a remote file.
+    The data is written to a temporary file that replaces the target file when all chunks are written,
+    so an error of the chunks iterable does not leave an incomplete target file.
+    """
+    temp_path = target_path.parent.joinpath(target_path.name + '.part')
+    with tracing.span('put ' + str(target_path), 'sftp', _get_machine_id(sftp_client)) as span:
+        rmakedirs(sftp_client, target_path.parent)
+        try:
+            with sftp_client.open(str(temp_path), 'wb') as file:
+                for data in chunks:
+                    file.write(data)
+                    span.bytes_transferred += len(data)
+        except Exception:
+            sftp_client.remove(str(temp_path))
+            raise
+        # sftp can not rename a file to the name of an existing file.
+        if rexists(sftp_client, target_path):
+            sftp_client.remove(str(target_path))
+        sftp_client.rename(str(temp_path), str(target_path))
 
 
-def rtorcopy(source_sftp_client, target_sftp_client, source_file, target_file):
+def _get_machine_id(sftp_client):
     """
-    Copy a file from one remote machine to another.
+    Returns the id of the host of the sftp client if it is known.
     """
-    local_temp_file = _SCRIPT_DIR.joinpath(source_file.name)
-    source_sftp_client.get(str(source_file), str(local_temp_file))
-    target_sftp_client.put(str(local_temp_file), str(target_file))
-    os.remove(str(local_temp_file))
+    return getattr(sftp_client, 'machine_id', '')
 
 
 def get_dir_content(directory):
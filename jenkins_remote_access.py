@@ -5,6 +5,8 @@ This module provides functionality to execute commands on a jenkins server over
 import requests
 import time
 
+import tracing
+
 
 class JenkinsRESTAccessor:
     """
@@ -27,22 +29,19 @@ class JenkinsRESTAccessor:
         """
         Returns when the jenkins instance is fully operable after a restart.
         Fully operable means that the crumb request must work.
+        The http server of jenkins must already accept connections, which is
+        ensured by waiting for the health check of the container.
         """
         print("----- Wait for jenkins to come online")
-        # We have to wait a little or we get python exceptions.
-        # This is ugly, because it can still fail on slower machines.
-        time.sleep(10)
         crumb_text = "Jenkins-Crumb"
 
-        text = ''
         waited_time = 0
         time_delta = 1
-        while crumb_text not in text:
-            text = requests.get(self._crumb_request, auth=self._authentication).text
-            waited_time += time_delta
-            time.sleep(time_delta)
+        while crumb_text not in self._get(self._crumb_request).text:
             if waited_time > max_time:
                 raise Exception("Timeout while waiting for jenkins to get ready.")
+            time.sleep(time_delta)
+            waited_time += time_delta
         self._crumb = self._get_jenkins_crumb()
 
 
@@ -67,7 +66,7 @@ class JenkinsRESTAccessor:
 
 
     def _get_jenkins_crumb(self):
-        request = requests.get(self._crumb_request, auth=self._authentication)
+        request = self._get(self._crumb_request)
         request.raise_for_status()
         return request.text
 
@@ -93,10 +92,24 @@ class JenkinsRESTAccessor:
         crumb_header = {crumb_parts[0] : crumb_parts[1]}
         script_data = {'script' : script}
 
-        response = requests.post(url, auth=self._authentication, headers=crumb_header, data=script_data)
+        response = self._post(url, crumb_header, script_data)
         response.raise_for_status()
 
 
+    def _get(self, url):
+        with tracing.span('GET ' + url, 'rest', self._url) as span:
+            response = requests.get(url, auth=self._authentication)
+            span.bytes_transferred = len(response.content)
+        return response
+
+
+    def _post(self, url, headers, data):
+        with tracing.span('POST ' + url, 'rest', self._url) as span:
+            response = requests.post(url, auth=self._authentication, headers=headers, data=data)
+            span.bytes_transferred = len(response.content) + sum(len(str(value)) for value in data.values())
+        return response
+
+
     def _approve_jenkins_script_signature(self, script_signature):
         """
         Runs a groovy script over the jenkins groovy console, that approves the commands
@@ -13,8 +13,13 @@ _SCRIPT_DIR = PurePath(os.path.dirname(os.path.realpath(__file__)))
 sys.path.append(str(_SCRIPT_DIR))
 
 
+from build_context_tests import *
 from config_data_tests import *
+from connections_tests import *
+from cpu_allocation_tests import *
+from dockerutil_tests import *
 from hook_config_tests import *
+from tracing_tests import *
 
 if __name__ == '__main__':
     unittest.main()
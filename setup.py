@@ -5,6 +5,8 @@ This script removes and adds and starts all docker container of the CMakeProject
 Arguments:
 1. - The path to a configuration json file.
 (An empty file can be generated with the createEmptyconfig_files.py script)
+--trace-file - An optional file to which the durations of the remote operations are written
+in the Chrome trace event format.
 
 \todo Setting up the windows slaves needs to be automated. Can we use a windows container technology that does not conflict with
 the VMWare virtual machines? 
@@ -20,10 +22,12 @@ import shutil
 import io
 import json
 import pprint
-import time
 import paramiko
 import socket
 import getpass
+import functools
+import collections
+import argparse
 
 # Add the script path to the python path
 _SCRIPT_DIR = PurePath(os.path.dirname(os.path.realpath(__file__)))
@@ -31,12 +35,14 @@ sys.path.append(str(_SCRIPT_DIR))
 
 import cpfmachines_version
 import config_data
+import tracing
 
 from jenkins_remote_access import JenkinsRESTAccessor
 from connections import ConnectionsHolder
 
 import dockerutil
 import fileutil
+import cpu_allocation
 
 
 
@@ -48,6 +54,14 @@ _JENKINS_VERSION = '2.319.2'
 # This is currently manually computed with "cmake -E sha256sum jenkins.war"
 _JENKINS_SHA256 = '020c8db10469e20e22e68c81e7e83bf35ccb6a435b712c4b643851949e75a553'
 _JENKINS_BASE_IMAGE = 'jenkins-image-' + _JENKINS_VERSION
+# The base image of the jenkins slave image. This must be the image in the FROM line of DockerfileJenkinsSlaveLinux.
+_JENKINS_SLAVE_BASE_IMAGE = 'ubuntu:20.04'
+# The repository prefix of the images that hold the installed files of the tools that are compiled from source.
+_TOOLCHAIN_IMAGE_PREFIX = 'cpf-toolchain-'
+# The seconds that a started container gets to pass its health check.
+_CONTAINER_READY_TIMEOUT = 300
+# The seconds that the ssh server of a windows slave gets to accept the key of the master after its keys were updated.
+_WINDOWS_SSH_SERVER_READY_TIMEOUT = 30
 
 # Files
 _PUBLIC_KEY_FILE_POSTFIX = '_ssh_key.rsa.pub'
@@ -85,10 +99,29 @@ def configure_file(source_file, dest_file, replacement_dictionary):
     config_file.close()
 
 
-def main(config_file):
+def main(config_file, trace_file=None, use_shell_sessions=False):
     """
     Entry point of the script.
+
+    trace_file: If given, the durations of the remote operations are written to this file
+                in the Chrome trace event format.
+    use_shell_sessions: If set, the commands on Linux hosts are run in one long-lived shell
+                per host instead of opening a new ssh channel for each command.
     """
+    try:
+        _run_setup(config_file, use_shell_sessions)
+    finally:
+        tracer = tracing.get_tracer()
+        print()
+        print('##### Time spent in the setup phases #####')
+        print()
+        tracer.print_phase_summary()
+        if trace_file:
+            tracer.write_chrome_trace(trace_file)
+            print('The trace of the setup run was written to ' + str(trace_file))
+
+
+def _run_setup(config_file, use_shell_sessions):
     # read configuration file
     print('----- Read configuration file ' + config_file)
     config_file = PurePath(config_file)
@@ -97,33 +130,46 @@ def main(config_file):
     _get_https_repository_passwords(config)
 
     print('----- Establish ssh connections to host machines')
-    connections = ConnectionsHolder(config.host_machine_infos)
+    with tracing.phase('connect'):
+        connections = ConnectionsHolder(config.host_machine_infos, parallel=True, use_shell_sessions=use_shell_sessions)
 
     # Create the object that does the work.
     controller = MachinesController(config, connections)
 
     # prepare environment
     print('----- Cleanup existing docker container and shared directories')
-    controller.prepare_host_environment()
+    with tracing.phase('prepare_host_environment'):
+        controller.prepare_host_environment()
+
+    if config.docker_registry_config:
+        print('----- Start the docker registry on host ' + config.docker_registry_config.machine_id)
+        with tracing.phase('start_docker_registry'):
+            controller.start_docker_registry()
 
     # build container
     print("----- Build jenkins base image on host " + config.jenkins_master_host_config.machine_id)
-    controller.build_jenkins_base()
+    with tracing.phase('build_jenkins_base'):
+        controller.build_jenkins_base()
     print("----- Build and start container {0} on host {1}".format(config.jenkins_master_host_config.container_conf.container_name, config.jenkins_master_host_config.machine_id))
-    controller.build_and_start_jenkins_master()
+    with tracing.phase('build_and_start_jenkins_master'):
+        controller.build_and_start_jenkins_master()
     print("----- Build and start the web-server containers")
-    controller.build_and_start_web_servers()
+    with tracing.phase('build_and_start_web_servers'):
+        controller.build_and_start_web_servers()
     print("----- Build and start the docker SLAVE containers")
-    controller.build_and_start_jenkins_linux_slaves()
+    with tracing.phase('build_and_start_jenkins_linux_slaves'):
+        controller.build_and_start_jenkins_linux_slaves()
 
     # setup ssh accesses
     print( '----- Setup access_rights' )
-    controller.setup_access_rights()
+    with tracing.phase('setup_access_rights'):
+        controller.setup_access_rights()
 
     # configure jenkins
     if not config.jenkins_config.use_unconfigured_jenkins:
         print("----- Configure the jenkins master server.")
-        controller.configure_jenkins_master(config_file)
+        with tracing.phase('configure_jenkins_master'):
+            controller.configure_jenkins_master(config_file)
 
     print()
     print('----- Successfully startet jenkins master, build slaves and the documentation server.')
@@ -141,6 +187,7 @@ class MachinesController:
     def __init__(self, config, connections):
         self.config = config
         self.connections = connections
+        self.host_name_resolver = dockerutil.HostNameResolver()    # Keeps the addresses that are added to the hosts files of the containers.
 
 
     def prepare_host_environment(self):
@@ -151,13 +198,39 @@ class MachinesController:
         self._remove_all_container()
         self._clear_directories()
 
+        # Resolving all names that are added to the hosts files of the containers at the beginning
+        # reports unknown names before anything is built.
+        resolved_hosts = self._get_slave_machine_host_names()
+        resolved_hosts.update(self._get_web_server_host_names())
+        resolved_hosts.update(self._get_accessible_repository_host_names())
+        self.host_name_resolver.resolve(sorted(resolved_hosts))
+
+
+    def start_docker_registry(self):
+        """
+        Starts the private registry that is used to distribute the images to the hosts.
+        """
+        registry_config = self.config.docker_registry_config
+        connection = self.connections.get_connection(registry_config.machine_id)
+        dockerutil.start_registry(connection, registry_config)
+
+
+    def _get_registry_address(self):
+        """
+        Returns the address under which the hosts reach the private registry or
+        an empty string if no registry is used.
+        """
+        registry_config = self.config.docker_registry_config
+        if not registry_config:
+            return ''
+        host_info = self.config.get_host_info(registry_config.machine_id)
+        return '{0}:{1}'.format(host_info.host_name, registry_config.port)
+
 
     def build_jenkins_base(self):
         """
         This builds the base image of the jenkins-master container.
         """
-        connection = self._get_jenkins_master_host_connection()
-
         # crate the build-context on the host
         source_dir = _SCRIPT_DIR.joinpath('../JenkinsciDocker')
         docker_file = '17/debian/bullseye/hotspot/Dockerfile'
@@ -175,14 +248,16 @@ class MachinesController:
         ]
 
         # Create the jenkins base image. This is required to customize the jenkins version.
-        dockerutil.build_docker_image(
-            connection,
+        machine_id = self.config.jenkins_master_host_config.machine_id
+        image_build = dockerutil.ImageBuild(
+            machine_id,
             _JENKINS_BASE_IMAGE,
             source_dir,
             docker_file,
             ['JENKINS_VERSION=' + _JENKINS_VERSION, 'JENKINS_SHA=' + _JENKINS_SHA256, 'TARGETARCH=amd64'],
             files
         )
+        dockerutil.build_images(self.connections, [image_build], operation_name='Building the jenkins base image', registry_address=self._get_registry_address())
 
 
     def build_and_start_jenkins_master(self):
@@ -200,20 +275,28 @@ class MachinesController:
             'buildCMake.sh',
         ]
 
+        # The tools that are compiled from source are built in their own images first.
+        machine_id = self.config.jenkins_master_host_config.machine_id
+        git_toolchain_build = self._get_toolchain_image_build(machine_id, 'buildGit.sh', _JENKINS_BASE_IMAGE)
+        cmake_toolchain_build = self._get_toolchain_image_build(machine_id, 'buildCMake.sh', _JENKINS_BASE_IMAGE)
+        build_args = [
+            'JENKINS_BASE_IMAGE=' + _JENKINS_BASE_IMAGE,
+            'GIT_TOOLCHAIN_IMAGE=' + git_toolchain_build.image_name,
+            'CMAKE_TOOLCHAIN_IMAGE=' + cmake_toolchain_build.image_name,
+        ]
+
         # Create the container image
-        dockerutil.build_docker_image(
-            connection,
-            container_image,
-            _SCRIPT_DIR,
-            docker_file,
-            ['JENKINS_BASE_IMAGE=' + _JENKINS_BASE_IMAGE],
-            files
-        )
+        image_builds = [
+            git_toolchain_build,
+            cmake_toolchain_build,
+            dockerutil.ImageBuild(machine_id, container_image, _SCRIPT_DIR, docker_file, build_args, files),
+        ]
+        dockerutil.build_images(self.connections, image_builds, operation_name='Building the jenkins master image', registry_address=self._get_registry_address())
 
         resolved_hosts = self._get_slave_machine_host_names()
         resolved_hosts.update(self._get_web_server_host_names())
         resolved_hosts.update(self._get_accessible_repository_host_names())
-        dockerutil.docker_run_detached(connection, container_config, resolved_hosts=resolved_hosts)
+        dockerutil.docker_run_detached(connection, container_config, resolved_hosts=resolved_hosts, resolver=self.host_name_resolver)
 
         # Add global gitconfig after mounting the workspace volume, otherwise is gets deleted.
         # Note that the slaves do this in the dockerfile
@@ -257,66 +340,75 @@ class MachinesController:
 
 
     def build_and_start_web_servers(self):
-
+        image_builds = []
+        host_operations = []
         for cpf_job_config in self.config.jenkins_config.cpf_job_configs:
-
             machine_id = cpf_job_config.webserver_config.machine_id
-            if not machine_id:
-                continue
+            if machine_id:
+                image_builds.append(self._get_web_server_image_build(machine_id, cpf_job_config.webserver_config.container_conf))
+                host_operations.append((machine_id, functools.partial(self._start_web_server, cpf_job_config)))
 
-            connection = self.connections.get_connection(machine_id)
-            container_config = cpf_job_config.webserver_config.container_conf
-            container_image = container_config.container_image_name
-                
-            print("----- Build and start the web-server container {0} on host {1}".format(container_config.container_name, machine_id))
-
-            # create build context
-            docker_file = 'DockerfileCPFWebServer'
-            files = [
-                docker_file,
-                'ssh_config',
-                '000-default.conf',
-                'apache2_envvars',
-                'apache2.conf',
-                'supervisord.conf',
-                'web-server-post-receive.in'
-            ]
+        # Web-servers that share a host use the same image.
+        dockerutil.build_images(self.connections, image_builds, operation_name='Building the web-server images', builder_machine_id=self.config.image_builder_machine_id, registry_address=self._get_registry_address())
+        self.connections.run_on_hosts(host_operations, operation_name='Starting the web-servers')
 
-            # build container image
-            dockerutil.build_docker_image(
-                connection,
-                container_image,
-                _SCRIPT_DIR,
-                docker_file, 
-                [],
-                files
-                )
 
-            # start container
-            dockerutil.docker_run_detached(connection, container_config)
+    def _get_web_server_image_build(self, machine_id, container_config):
+        docker_file = 'DockerfileCPFWebServer'
+        files = [
+            docker_file,
+            'ssh_config',
+            '000-default.conf',
+            'apache2_envvars',
+            'apache2.conf',
+            'supervisord.conf',
+            'web-server-post-receive.in'
+        ]
+        return dockerutil.ImageBuild(machine_id, container_config.container_image_name, _SCRIPT_DIR, docker_file, [], files)
 
-            # copy the doxyserach.cgi to the html share
-            """
-            html_share_container = next(iter(container_config.host_volumes.values()))
-            cgi_bin_dir = html_share_container.joinpath('cgi-bin')
-            commands = [
-                'rm -fr ' + str(cgi_bin_dir),
-                'mkdir ' + str(cgi_bin_dir),
-                'mkdir ' + str(cgi_bin_dir) + '/doxysearch.db',
-                'cp -r -f /usr/local/bin/doxysearch.cgi ' + str(cgi_bin_dir),
-            ]
-            dockerutil.run_commands_in_container(
-                connection,
-                container_config,
-                commands
-                )
-            """
+
+    def _start_web_server(self, cpf_job_config, connection):
+
+        machine_id = cpf_job_config.webserver_config.machine_id
+        container_config = cpf_job_config.webserver_config.container_conf
+            
+        print("----- Start the web-server container {0} on host {1}".format(container_config.container_name, machine_id))
+
+        # start container
+        dockerutil.docker_run_detached(connection, container_config)
+        dockerutil.wait_until_healthy(connection, container_config.container_name, _CONTAINER_READY_TIMEOUT)
+
+        # copy the doxyserach.cgi to the html share
+        """
+        html_share_container = next(iter(container_config.host_volumes.values()))
+        cgi_bin_dir = html_share_container.joinpath('cgi-bin')
+        commands = [
+            'rm -fr ' + str(cgi_bin_dir),
+            'mkdir ' + str(cgi_bin_dir),
+            'mkdir ' + str(cgi_bin_dir) + '/doxysearch.db',
+            'cp -r -f /usr/local/bin/doxysearch.cgi ' + str(cgi_bin_dir),
+        ]
+        dockerutil.run_commands_in_container(
+            connection,
+            container_config,
+            commands
+            )
+        """
 
 
     def build_and_start_jenkins_linux_slaves(self):
+        image_builds = []
+        host_operations = []
         for slave_config in self.config.jenkins_slave_configs:
             if self.config.is_linux_machine(slave_config.machine_id):
-                self._build_and_start_jenkins_linux_slave(slave_config.container_conf, slave_config.machine_id)
+                image_builds.extend(self._get_jenkins_linux_slave_image_builds(slave_config.machine_id, slave_config.container_conf))
+                host_operations.append((slave_config.machine_id, functools.partial(self._start_jenkins_linux_slave, slave_config.container_conf)))
+
+        self._assign_automatic_slave_cpusets()
+
+        # Slaves that share a host use the same image.
+        dockerutil.build_images(self.connections, image_builds, operation_name='Building the jenkins slave images', builder_machine_id=self.config.image_builder_machine_id, registry_address=self._get_registry_address())
+        self.connections.run_on_hosts(host_operations, operation_name='Starting the jenkins slaves')
 
 
     def setup_access_rights(self):
@@ -379,21 +471,17 @@ class MachinesController:
     def _remove_all_container(self):
         """
         Stop and remove all containers of the CPF infrastructure.
+        Each host removes its containers with one command and the hosts are processed concurrently.
         """
+        host_containers = collections.OrderedDict()
         for container in self.config.get_all_container():
-            self._stubbornly_remove_container(container)
+            host_containers.setdefault(self.config.get_container_host(container), []).append(container)
 
+        host_operations = []
+        for machine_id, containers in host_containers.items():
+            host_operations.append((machine_id, functools.partial(dockerutil.remove_containers, containers=containers, stop_timeout=self.config.container_stop_timeout)))
 
-    def _stubbornly_remove_container(self, container):
-        """
-        Removes a given docker container even if it is running.
-        If the container does not exist, the function does nothing.
-        """
-        connection = self._get_container_host_connection(container)
-        if dockerutil.container_exists(connection, container):
-            if dockerutil.container_is_running(connection, container):
-                dockerutil.stop_docker_container(connection, container)
-            dockerutil.remove_container(connection, container)
+        self.connections.run_on_hosts(host_operations, operation_name='Removing the container')
 
     def _get_container_host_connection(self, container):
         machine_id = self.config.get_container_host(container)
@@ -402,20 +490,22 @@ class MachinesController:
 
     def _clear_directories(self):
         # the master share directory
-        jenkins_master_host_info = self.config.get_host_info(self.config.jenkins_master_host_config.machine_id)
-        self._clear_directory_on_host(jenkins_master_host_info, self.config.jenkins_master_host_config.jenkins_home_share)
+        host_operations = [
+            (self.config.jenkins_master_host_config.machine_id, functools.partial(self._clear_directory_on_host, self.config.jenkins_master_host_config.jenkins_home_share))
+        ]
 
         # all temporary directories
         for host_info in self.config.host_machine_infos:
-            self._clear_directory_on_host(host_info, host_info.temp_dir)
+            host_operations.append((host_info.machine_id, functools.partial(self._clear_directory_on_host, host_info.temp_dir)))
+
+        self.connections.run_on_hosts(host_operations, operation_name='Clearing the directories')
 
 
-    def _clear_directory_on_host(self, host_config, directory):
+    def _clear_directory_on_host(self, directory, connection):
         try:
-            connection = self.connections.get_connection(host_config.machine_id)
             fileutil.clear_rdirectory(connection.sftp_client, directory)
         except IOError as err:
-            print("Failed to clear the remote directory {0} on host {1}!".format(directory, host_config.host_name))
+            print("Failed to clear the remote directory {0} on host {1}!".format(directory, connection.info.host_name))
             raise
 
 
@@ -423,12 +513,12 @@ class MachinesController:
         return self.connections.get_connection(self.config.jenkins_master_host_config.machine_id)
 
 
-    def _build_and_start_jenkins_linux_slave(self, container_conf, machine_id):
-        
-        connection = self.connections.get_connection(machine_id)
-        container_image = container_conf.container_image_name
+    def _get_jenkins_linux_slave_image_builds(self, machine_id, container_conf):
+        """
+        Returns the builds of the slave image and the toolchain image that it uses in the order in which they must be built.
+        """
+        cmake_toolchain_build = self._get_toolchain_image_build(machine_id, 'buildCMake.sh', _JENKINS_SLAVE_BASE_IMAGE)
 
-        # create build context
         docker_file = 'DockerfileJenkinsSlaveLinux'
         text_files = [
             docker_file,
@@ -439,33 +529,69 @@ class MachinesController:
         binary_files = [
             'agent.jar',
         ]
+        build_args = ['CMAKE_TOOLCHAIN_IMAGE=' + cmake_toolchain_build.image_name]
+        slave_build = dockerutil.ImageBuild(machine_id, container_conf.container_image_name, _SCRIPT_DIR, docker_file, build_args, text_files, binary_files)
+        return [cmake_toolchain_build, slave_build]
+
+
+    def _get_toolchain_image_build(self, machine_id, tool_script, base_image):
+        """
+        Returns the build of the image that holds the installed files of a tool that is compiled by the given script.
+        The image is named after the tool and the base image. Its context hash covers the script and the id of
+        the base image, so the tool is only compiled again when one of them changes.
+        """
+        tool_name = tool_script[len('build'):-len('.sh')].lower()
+        base_image_tag = base_image.replace('/', '-').replace(':', '-')
+        image_name = _TOOLCHAIN_IMAGE_PREFIX + tool_name + ':' + base_image_tag
+        docker_file = 'DockerfileToolchain'
+        build_args = [
+            'BASE_IMAGE=' + base_image,
+            'TOOL_SCRIPT=' + tool_script,
+            'CACHE_ID=' + _TOOLCHAIN_IMAGE_PREFIX + base_image_tag,
+        ]
+        return dockerutil.ImageBuild(machine_id, image_name, _SCRIPT_DIR, docker_file, build_args, [docker_file, tool_script])
 
-        # Build the container.
-        dockerutil.build_docker_image(
-            connection,
-            container_image,
-            _SCRIPT_DIR,
-            docker_file,
-            [],
-            text_files,
-            binary_files
-            )
 
+    def _assign_automatic_slave_cpusets(self):
+        """
+        Splits the cpus of each host evenly between its linux slaves that have the automatic cpuset.
+        Each slave also gets the memory of the NUMA nodes of its cpus.
+        """
+        host_slaves = collections.OrderedDict()
+        for slave_config in self.config.jenkins_slave_configs:
+            if self.config.is_linux_machine(slave_config.machine_id) and slave_config.container_conf.resources.cpuset_cpus == config_data.CPUSET_AUTO:
+                host_slaves.setdefault(slave_config.machine_id, []).append(slave_config)
+        if not host_slaves:
+            return
+
+        host_operations = [(machine_id, cpu_allocation.LSCPU_COMMAND) for machine_id in host_slaves]
+        outputs = self.connections.run_on_hosts(host_operations, operation_name='Reading the cpus of the hosts', idempotent=True)
+        for machine_id, slave_configs in host_slaves.items():
+            cpus = cpu_allocation.parse_lscpu_output(outputs[machine_id][0])
+            for slave_config, cpu_set in zip(slave_configs, cpu_allocation.split_cpus(cpus, len(slave_configs))):
+                slave_config.container_conf.resources.cpuset_cpus = cpu_set.get_cpus_string()
+                slave_config.container_conf.resources.cpuset_mems = cpu_set.get_nodes_string()
+                print('----- The slave container {0} on host {1} runs on the cpus {2}.'.format(slave_config.container_conf.container_name, machine_id, cpu_set.get_cpus_string()))
+
+
+    def _start_jenkins_linux_slave(self, container_conf, connection):
         # Start the container.
         resolved_hosts = self._get_accessible_repository_host_names()
         resolved_hosts.update(self._get_web_server_host_names()) # slaves may need to copy files from the webserver
-        dockerutil.docker_run_detached(connection, container_conf, resolved_hosts=resolved_hosts)
+        dockerutil.docker_run_detached(connection, container_conf, resolved_hosts=resolved_hosts, resolver=self.host_name_resolver)
+        dockerutil.wait_until_healthy(connection, container_conf.container_name, _CONTAINER_READY_TIMEOUT)
 
 
     def _create_rsa_key_file_pairs_on_slave_container(self):
+        host_operations = []
         for slave_config in self.config.jenkins_slave_configs:
             if self.config.is_linux_machine(slave_config.machine_id):
-                connection = self.connections.get_connection(slave_config.machine_id)
-                _create_rsa_key_file_pair_on_container(
-                    connection,
-                    slave_config.container_conf,
-                    PurePosixPath('/home/jenkins')
-                )
+                host_operations.append((
+                    slave_config.machine_id,
+                    functools.partial(_create_rsa_key_file_pair_on_container, container_conf=slave_config.container_conf, container_home_directory=PurePosixPath('/home/jenkins'))
+                ))
+
+        self.connections.run_on_hosts(host_operations, operation_name='Creating the ssh keys of the slaves')
 
 
     def _grant_container_access_to_repositories(self, container_conf, container_home_directory):
@@ -476,8 +602,7 @@ class MachinesController:
             self._register_public_key_file_with_ssh_server(container_conf, container_home_directory, repository_host_config, False)
 
         # Handle repository accesses for https hosts.
-        for repository_host_config in self.config.https_repository_accesses:
-            self._grant_container_access_to_https_repositories(container_conf, container_home_directory, repository_host_config)
+        self._grant_container_access_to_https_repositories(container_conf, container_home_directory, self.config.https_repository_accesses)
         
     
     def _register_public_key_file_with_ssh_server(self, ssh_client_container_config, ssh_client_container_home_directory, ssh_host_config, host_is_container):
@@ -539,25 +664,27 @@ class MachinesController:
         )
 
 
-    def _grant_container_access_to_https_repositories(self, container_conf, container_home_directory, https_repository_host_config):
+    def _grant_container_access_to_https_repositories(self, container_conf, container_home_directory, https_repository_host_configs):
         """
         This function adds the credentials of the given https based repository accesses to the git credential store of that container.
         """
         container_name = container_conf.container_name
         container_host_connection = self._get_container_host_connection(container_name)
 
-        # Add the credentials for the repository to the jenkins-git-credentials file.
+        # Add the credentials for the repositories to the jenkins-git-credentials file.
         credential_file = container_home_directory.joinpath(_GIT_CREDENTIALS_STORE)
-        command = 'echo https://{0}:{1}@{2} >> {3}'.format(
-            https_repository_host_config.user_name,
-            https_repository_host_config.user_password,
-            https_repository_host_config.host_name,
-            credential_file
-        )
-        dockerutil.run_command_in_container(
+        commands = []
+        for https_repository_host_config in https_repository_host_configs:
+            commands.append('echo https://{0}:{1}@{2} >> {3}'.format(
+                https_repository_host_config.user_name,
+                https_repository_host_config.user_password,
+                https_repository_host_config.host_name,
+                credential_file
+            ))
+        dockerutil.run_commands_in_container(
             container_host_connection,
             container_conf,
-            command
+            commands
         )
 
 
@@ -634,7 +761,7 @@ class MachinesController:
         # call the script
         try:
             call_script_command = '{0} {1}'.format(full_script_path_on_slave, slave_host_connection.info.user_password)
-            slave_host_connection.run_command(call_script_command, print_command=True)
+            slave_host_connection.run_command(call_script_command, print_command=True, trace_name=str(full_script_path_on_slave))
         except Exception as err:
             print(
                 "Error: Updating the authorized ssh keys on "
@@ -644,12 +771,11 @@ class MachinesController:
         # clean up the generated script because of the included password
         os.remove(str(full_authorized_keys_script))
 
-        # Wait a little until the bitvise ssh server is ready to accept the key file.
-        # This can possibly fail on slower machines.
-        time.sleep(1)
-
-        # Add the slave to the known hosts
         try:
+            # Wait until the bitvise ssh server accepts the key of the master.
+            _wait_until_key_login_works(master_connection, master_config, slave_host_connection.info.host_name, 22, slave_host_connection.info.user_name, _WINDOWS_SSH_SERVER_READY_TIMEOUT)
+
+            # Add the slave to the known hosts
             _accept_remote_container_host_key(
                 master_connection, 
                 master_config, 
@@ -853,6 +979,7 @@ class MachinesController:
 
         config_file_dir = config_file.parent
         jobs_config_dir = config_data.JENKINS_HOME_JENKINS_MASTER_CONTAINER.joinpath(config_dir)
+        files = []
         for config_item in config_items:
             if config_file_dir:
                 sourceconfig_file = config_file_dir.joinpath(config_item.xml_file)
@@ -860,12 +987,14 @@ class MachinesController:
                 sourceconfig_file = config_item.xml_file
             job_config_dir = jobs_config_dir.joinpath(config_item.name)
             job_config_file = PurePosixPath('config.xml')
-            dockerutil.copy_textfile_to_container(
-                master_connection,
-                self.config.jenkins_master_host_config.container_conf,
-                sourceconfig_file,
-                job_config_dir.joinpath(job_config_file)
-            )
+            files.append((sourceconfig_file, job_config_dir.joinpath(job_config_file)))
+
+        # All files are copied with one command.
+        dockerutil.copy_local_files_to_container(
+            master_connection,
+            self.config.jenkins_master_host_config.container_conf,
+            files
+        )
 
 
     def _restart_jenkins(self):
@@ -873,6 +1002,7 @@ class MachinesController:
         master_container = self.config.jenkins_master_host_config.container_conf.container_name
         dockerutil.stop_docker_container(master_connection, master_container)
         dockerutil.start_docker_container(master_connection, master_container)
+        dockerutil.wait_until_healthy(master_connection, master_container, _CONTAINER_READY_TIMEOUT)
 
 
     def _configure_jenkins_slaves(self):
@@ -1034,6 +1164,20 @@ def _accept_remote_container_host_key(client_container_host_connection, client_c
 
 
 
+def _wait_until_key_login_works(client_container_host_connection, client_container_config, host_name, port, user, timeout):
+    """
+    Returns as soon as the given container can log into the ssh server of the host with its key.
+    The login is retried in the container until the timeout in seconds expires, so the waiting
+    needs only one command. The host key is not stored, this is done by _accept_remote_container_host_key().
+    """
+    login_command = 'ssh -o BatchMode=yes -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o ConnectTimeout=5 -p {0} {1}@{2} exit'.format(port, user, host_name)
+    dockerutil.run_command_in_container(
+        client_container_host_connection,
+        client_container_config,
+        'timeout {0} sh -c "until {1}; do sleep 0.5; done"'.format(timeout, login_command)
+    )
+
+
 def _add_known_ssh_host(client_container_host_connection, client_container_config, ssh_host_name, ssh_port):
     """
     Uses the ssh-keyscan command to add the public key of an ssh server to the known_hosts file of the
@@ -1132,5 +1276,14 @@ def _print_access_summary(config):
 
 
 
+def _parse_arguments():
+    parser = argparse.ArgumentParser(description='Sets up the docker container of the CPF infrastructure.')
+    parser.add_argument('config_file', help='The path to a CPFMachines configuration json file.')
+    parser.add_argument('--trace-file', help='Write the durations of the remote operations to this file in the Chrome trace event format.')
+    parser.add_argument('--shell-sessions', action='store_true', help='Run the commands on Linux hosts in one long-lived shell per host instead of a new ssh channel for each command.')
+    return parser.parse_args()
+
+
 if __name__ == '__main__':
-    sys.exit(main(sys.argv[1]))
+    arguments = _parse_arguments()
+    sys.exit(main(arguments.config_file, arguments.trace_file, arguments.shell_sessions))
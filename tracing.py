@@ -0,0 +1,198 @@
+"""
+This module records how long the remote operations of a setup run take.
+
+The recorded spans can be written to a file in the Chrome trace event format, which can be
+viewed with chrome://tracing or https://ui.perfetto.dev, and summarized per setup phase.
+"""
+
+import json
+import time
+import threading
+import contextlib
+import collections
+
+
+class Span:
+    """
+    Data class that holds the information about one recorded operation.
+    """
+    def __init__(self, name, category, machine_id, phase):
+        self.name = name                    # A description of the operation, e.g. the executed command.
+        self.category = category            # The kind of the operation, e.g. 'command', 'sftp' or 'rest'.
+        self.machine_id = machine_id        # The host on which the operation was executed.
+        self.phase = phase                  # The setup phase that was active when the operation started.
+        self.start_time = 0.0               # Seconds since the start of the tracer.
+        self.duration = 0.0                 # Wall time of the operation in seconds.
+        self.bytes_transferred = 0          # The number of bytes that were sent or received by the operation.
+        self.thread_id = threading.get_ident()
+
+
+class Tracer:
+    """
+    Collects the spans of the operations. The object can be used from multiple threads.
+    """
+    def __init__(self):
+        self._spans = []
+        self._phase = ''
+        self._lock = threading.Lock()
+        self._start_time = time.perf_counter()
+
+
+    @property
+    def spans(self):
+        with self._lock:
+            return list(self._spans)
+
+
+    @property
+    def current_phase(self):
+        return self._phase
+
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        All spans that are started within the context are assigned to the phase with the given name.
+        Phases are global and not per thread, so operations that are run by worker threads
+        belong to the phase that started them.
+        """
+        previous_phase = self._phase
+        self._phase = name
+        with self.span(name, 'phase'):
+            try:
+                yield
+            finally:
+                self._phase = previous_phase
+
+
+    @contextlib.contextmanager
+    def span(self, name, category, machine_id='', bytes_transferred=0):
+        """
+        Records the wall time of the code in the context.
+        The yielded Span object can be used to add the number of transferred bytes.
+        """
+        span = Span(name, category, machine_id, self._phase)
+        span.bytes_transferred = bytes_transferred
+        span.start_time = time.perf_counter() - self._start_time
+        try:
+            yield span
+        finally:
+            span.duration = time.perf_counter() - self._start_time - span.start_time
+            with self._lock:
+                self._spans.append(span)
+
+
+    def get_chrome_trace(self):
+        """
+        Returns the spans as a dictionary in the Chrome trace event format.
+        Each host is shown as a process and each thread as a thread of that process.
+        """
+        spans = self.spans
+        process_ids = {}
+        thread_ids = {}
+        events = []
+
+        for span in spans:
+            process_name = span.machine_id if span.machine_id else 'controller'
+            if process_name not in process_ids:
+                process_ids[process_name] = len(process_ids) + 1
+                events.append({'name' : 'process_name', 'ph' : 'M', 'pid' : process_ids[process_name], 'args' : {'name' : process_name}})
+            if span.thread_id not in thread_ids:
+                thread_ids[span.thread_id] = len(thread_ids) + 1
+
+            events.append({
+                'name' : span.name,
+                'cat' : span.category,
+                'ph' : 'X',
+                'ts' : span.start_time * 1e6,
+                'dur' : span.duration * 1e6,
+                'pid' : process_ids[process_name],
+                'tid' : thread_ids[span.thread_id],
+                'args' : {
+                    'phase' : span.phase,
+                    'bytes' : span.bytes_transferred,
+                }
+            })
+
+        return {'traceEvents' : events, 'displayTimeUnit' : 'ms'}
+
+
+    def write_chrome_trace(self, file_path):
+        with open(str(file_path), 'w') as file:
+            json.dump(self.get_chrome_trace(), file)
+
+
+    def get_phase_summary(self):
+        """
+        Returns a list with one PhaseSummary object for each phase in the order in which the phases were started.
+        The operation time is the sum of the wall times of the operations of a phase, which can be
+        larger than the duration of the phase when operations run concurrently.
+        """
+        summaries = collections.OrderedDict()
+        spans = sorted(self.spans, key=lambda span: span.start_time)
+
+        for span in spans:
+            if span.category == 'phase':
+                summaries.setdefault(span.name, PhaseSummary(span.name)).duration += span.duration
+
+        for span in spans:
+            if span.category == 'phase':
+                continue
+            summary = summaries.setdefault(span.phase, PhaseSummary(span.phase))
+            summary.operations += 1
+            summary.operation_time += span.duration
+            summary.bytes_transferred += span.bytes_transferred
+
+        return list(summaries.values())
+
+
+    def print_phase_summary(self):
+        summaries = self.get_phase_summary()
+        if not summaries:
+            return
+
+        name_width = max(len('Phase'), max(len(summary.name) for summary in summaries))
+        row_format = '{0:<' + str(name_width) + '} {1:>10} {2:>12} {3:>15} {4:>12}'
+        print(row_format.format('Phase', 'Wall [s]', 'Operations', 'Op. time [s]', 'MiB'))
+        for summary in summaries:
+            print(row_format.format(
+                summary.name,
+                '{0:.1f}'.format(summary.duration),
+                summary.operations,
+                '{0:.1f}'.format(summary.operation_time),
+                '{0:.1f}'.format(summary.bytes_transferred / (1024 * 1024))
+            ))
+
+
+class PhaseSummary:
+    """
+    Data class that holds the accumulated values of the spans of one phase.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.duration = 0.0
+        self.operations = 0
+        self.operation_time = 0.0
+        self.bytes_transferred = 0
+
+
+# The tracer that records the operations of the current process.
+_TRACER = Tracer()
+
+
+def get_tracer():
+    return _TRACER
+
+
+def span(name, category, machine_id='', bytes_transferred=0):
+    """
+    Records a span with the tracer of the process.
+    """
+    return _TRACER.span(name, category, machine_id, bytes_transferred)
+
+
+def phase(name):
+    """
+    Sets the current phase of the tracer of the process.
+    """
+    return _TRACER.phase(name)
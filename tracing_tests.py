@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+This module contains automated tests for the tracing module.
+"""
+
+import unittest
+import threading
+
+from tracing import *
+
+
+class TestTracer(unittest.TestCase):
+    """
+    Fixture class for testing the Tracer class.
+    """
+    def test_spans_are_assigned_to_the_current_phase(self):
+        """
+        Spans get the phase that is active when they are started.
+        """
+        # setup
+        sut = Tracer()
+
+        # execute
+        with sut.span('before', 'command', 'MyMaster'):
+            pass
+        with sut.phase('build'):
+            with sut.span('docker build', 'command', 'MyMaster') as span:
+                span.bytes_transferred = 100
+
+        # verify
+        spans = {span.name : span for span in sut.spans}
+        self.assertEqual(spans['before'].phase, '')
+        self.assertEqual(spans['docker build'].phase, 'build')
+        self.assertEqual(spans['docker build'].machine_id, 'MyMaster')
+        self.assertEqual(spans['docker build'].bytes_transferred, 100)
+        self.assertEqual(spans['build'].category, 'phase')
+        self.assertEqual(sut.current_phase, '')
+
+
+    def test_spans_of_worker_threads_belong_to_the_phase_of_the_caller(self):
+        """
+        Operations that are run concurrently by the fan-out functions must be assigned to the calling phase.
+        """
+        # setup
+        sut = Tracer()
+
+        # execute
+        with sut.phase('prepare'):
+            with sut.span('outer', 'command'):
+                worker = threading.Thread(target=self._record_span, args=(sut,))
+                worker.start()
+                worker.join()
+
+        # verify
+        spans = {span.name : span for span in sut.spans}
+        self.assertEqual(spans['worker'].phase, 'prepare')
+
+
+    def _record_span(self, tracer):
+        with tracer.span('worker', 'command', 'MyLinuxSlave'):
+            pass
+
+
+    def test_phase_summary_accumulates_the_spans_of_each_phase(self):
+        """
+        Happy case test for the phase summary.
+        """
+        # setup
+        sut = Tracer()
+
+        # execute
+        with sut.phase('prepare'):
+            with sut.span('a', 'command', 'MyMaster', 10):
+                pass
+            with sut.span('b', 'sftp', 'MyLinuxSlave', 20):
+                pass
+        with sut.phase('build'):
+            with sut.span('c', 'command', 'MyMaster', 5):
+                pass
+
+        # verify
+        summaries = sut.get_phase_summary()
+        self.assertEqual([summary.name for summary in summaries], ['prepare', 'build'])
+        self.assertEqual(summaries[0].operations, 2)
+        self.assertEqual(summaries[0].bytes_transferred, 30)
+        self.assertEqual(summaries[1].operations, 1)
+        self.assertEqual(summaries[1].bytes_transferred, 5)
+        self.assertTrue(summaries[0].duration >= summaries[0].operation_time)
+
+
+    def test_chrome_trace_contains_a_process_for_each_host(self):
+        """
+        The hosts are shown as processes in the trace viewer.
+        """
+        # setup
+        sut = Tracer()
+        with sut.span('a', 'command', 'MyMaster'):
+            pass
+        with sut.span('b', 'command', 'MyLinuxSlave'):
+            pass
+        with sut.span('c', 'command', 'MyMaster'):
+            pass
+
+        # execute
+        trace = sut.get_chrome_trace()
+
+        # verify
+        process_names = [event['args']['name'] for event in trace['traceEvents'] if event['ph'] == 'M']
+        self.assertEqual(process_names, ['MyMaster', 'MyLinuxSlave'])
+        complete_events = [event for event in trace['traceEvents'] if event['ph'] == 'X']
+        self.assertEqual(len(complete_events), 3)
+        self.assertEqual(complete_events[0]['pid'], complete_events[2]['pid'])
+        self.assertNotEqual(complete_events[0]['pid'], complete_events[1]['pid'])